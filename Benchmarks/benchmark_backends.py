@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Benchmark of backing up to a slow target, using a LatencyTarget in place of a network share.
+
+Builds a tree of small files and backs it up through a LatencyTarget wrapping a local
+directory, reporting the time taken and the number of round trips for each number of
+workers. The incremental run that follows, where every file is unchanged, shows the cost of
+the stat_many lookups alone.
+
+Run from the project root with ` python3 Benchmarks/benchmark_backends.py --latency 0.005 `.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import click
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from backend import Backup, LatencyTarget, LocalTarget  # pylint: disable=wrong-import-position
+
+MEGABYTE = 1024 * 1024
+
+
+def make_tree(source: str, files: int, per_directory: int = 100):
+    """Fill the source with small files, per_directory to a directory."""
+    for number in range(files):
+        directory = f"{source}/dir{number // per_directory}"
+        if number % per_directory == 0:
+            os.mkdir(directory)
+        with open(f"{directory}/file{number}.txt", "wb") as file:
+            file.write(bytes(1024))
+
+
+def timed_backup(source: str, target: str, workers: int, latency: float, bandwidth: float, incremental: bool) -> dict:
+    """Back up through a new LatencyTarget, returning the seconds taken and round trips made."""
+    backend = LatencyTarget(LocalTarget(target), latency=latency, bandwidth=bandwidth)
+    start = time.perf_counter()
+    result = Backup(source, target, overwrite=True, incremental=incremental, workers=workers, target_backend=backend).transfer_files()
+    return {
+        "seconds": round(time.perf_counter() - start, 3),
+        "round_trips": backend.round_trips,
+        "files_transferred": result["files_transferred"]
+    }
+
+
+@click.command()
+@click.option("--files", type=click.IntRange(min=1), default=1000, help="Number of files in the tree")
+@click.option("--latency", type=float, default=0.005, help="Seconds added to each round trip")
+@click.option("--bandwidth", type=float, default=None, help="Bandwidth of the target in MB/s")
+@click.option("--workers", "worker_counts", type=click.IntRange(min=1), multiple=True, default=[1, 8, 32], help="Numbers of workers to try")
+def main(files, latency, bandwidth, worker_counts):
+    """Run the benchmark."""
+    bandwidth = bandwidth * MEGABYTE if bandwidth else None
+    with tempfile.TemporaryDirectory() as directory:
+        source = f"{directory}/source"
+        os.mkdir(source)
+        make_tree(source, files)
+
+        for workers in worker_counts:
+            target = f"{directory}/target{workers}"
+            os.mkdir(target)
+            print({
+                "workers": workers,
+                "full": timed_backup(source, target, workers, latency, bandwidth, incremental=False),
+                "incremental": timed_backup(source, target, workers, latency, bandwidth, incremental=True)
+            })
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Benchmark of the content-defined chunking used by the "chunked" target format.
+
+Writes a file of random bytes and splits it with chunk_file(), reporting the MB/s of one
+process. Chunking is timed with numpy finding the boundaries, if it is installed, and
+hashing a byte at a time in Python, as it does without numpy. Both must give the same chunks.
+
+Run from the project root with ` python3 Benchmarks/benchmark_chunking.py --size 64 `.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import click
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import backend  # pylint: disable=wrong-import-position
+
+MEGABYTE = 1024 * 1024
+
+
+def timed_chunking(path: str, size: int) -> tuple:
+    """Chunk the file, returning the chunks and the MB/s."""
+    start = time.perf_counter()
+    chunks = backend.chunk_file(path, *backend.Backup.CHUNK_SIZES)
+    return chunks, round(size / MEGABYTE / (time.perf_counter() - start), 1)
+
+
+@click.command()
+@click.option("--size", type=click.IntRange(min=1), default=16, help="Size of the file to chunk in MB")
+@click.option("--python_size", type=click.IntRange(min=1), default=4, help="MB of the file to chunk without numpy, which is far slower")
+def main(size, python_size):
+    """Run the benchmark."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/data.bin"
+        with open(path, "wb") as file:
+            file.write(random.Random(0).randbytes(size * MEGABYTE))
+
+        if backend.gear_boundaries(b"", 0) is None:
+            print({"approach": "numpy", "error": "numpy is not installed"})
+        else:
+            _, speed = timed_chunking(path, size * MEGABYTE)
+            print({"approach": "numpy", "size_mb": size, "mb_per_second": speed})
+
+        # The same chunks as with numpy, over the start of the file.
+        with open(path, "r+b") as file:
+            file.truncate(python_size * MEGABYTE)
+        fast, _ = timed_chunking(path, python_size * MEGABYTE)
+        gear_boundaries = backend.gear_boundaries
+        backend.gear_boundaries = lambda data, mask: None
+        try:
+            slow, speed = timed_chunking(path, python_size * MEGABYTE)
+        finally:
+            backend.gear_boundaries = gear_boundaries
+        print({"approach": "python", "size_mb": python_size, "mb_per_second": speed, "same_chunks": fast == slow})
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
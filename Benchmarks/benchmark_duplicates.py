@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Benchmark of finding the next free "(n)" name for the Duplicate condition.
+
+Compares the old approach, which probed "(1)", "(2)", ... with a stat each until one was
+free, against TargetIndex.next_duplicate(), which parses the directory listing once.
+
+Run from the project root with ` python3 Benchmarks/benchmark_duplicates.py `.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from backend import TargetIndex  # pylint: disable=wrong-import-position
+
+
+def probe_duplicate(path: str) -> str:
+    """The previous implementation: stat each candidate name until one is free."""
+    stem, suffix = os.path.splitext(path)
+    number = 1
+    while os.path.exists(f"{stem} ({number}){suffix}"):
+        number = number + 1
+    return f"{stem} ({number}){suffix}"
+
+
+def make_versions(directory: str, versions: int) -> str:
+    """Fill the directory with a file and the given number of "(n)" copies of it."""
+    for number in range(1, versions + 1):
+        open(f"{directory}/file ({number}).txt", "w", encoding="utf-8").close()
+    path = f"{directory}/file.txt"
+    open(path, "w", encoding="utf-8").close()
+    return path
+
+
+def benchmark(versions: int, new_copies: int = 100) -> dict:
+    """Time allocating new_copies more names for a file that already has the given versions."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_versions(directory, versions)
+
+        start = time.perf_counter()
+        for _ in range(new_copies):
+            new_path = probe_duplicate(path)
+            open(new_path, "w", encoding="utf-8").close()
+        probing = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_versions(directory, versions)
+
+        start = time.perf_counter()
+        index = TargetIndex()
+        for _ in range(new_copies):
+            new_path = index.next_duplicate(path)
+            index.add(new_path, 0)
+            open(new_path, "w", encoding="utf-8").close()
+        indexed = time.perf_counter() - start
+
+    return {
+        "versions": versions,
+        "new_copies": new_copies,
+        "probing_seconds": round(probing, 4),
+        "index_seconds": round(indexed, 4),
+        "speedup": round(probing / indexed, 1)
+    }
+
+
+if __name__ == "__main__":
+    for number_of_versions in (1000, 10000):
+        print(benchmark(number_of_versions))
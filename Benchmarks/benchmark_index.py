@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Benchmark of the memory and speed of FileIndex against holding paths as Python objects.
+
+Builds a synthetic tree listing of the given number of entries, 1000 to a directory, and
+holds it three ways: a list of absolute path strings (as list_files used to return), a
+dict of relative path -> (size, mtime_ns, inode) (as the manifest used to be loaded) and a
+FileIndex. For each, the memory held after building (from tracemalloc), the time to build
+it and the time to look up every entry are reported.
+
+Run from the project root with ` python3 Benchmarks/benchmark_index.py --entries 1000000 `.
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import click
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from backend import FileIndex  # pylint: disable=wrong-import-position
+
+MEGABYTE = 1024 * 1024
+SOURCE = "/home/user/Documents"
+
+
+def entries(count: int):
+    """Generates (relative_path, size, mtime_ns, inode) for a tree of count entries."""
+    for number in range(count):
+        yield f"projects/project{number // 1000}/src/module_{number}.py", number * 7, 1_700_000_000_000_000_000 + number, 1_000_000 + number
+
+
+def build_list(count: int) -> list:
+    """The previous list_files() approach: a list of absolute paths."""
+    return [f"{SOURCE}/{relative_path}" for relative_path, _, _, _ in entries(count)]
+
+
+def build_dict(count: int) -> dict:
+    """The previous manifest approach: a dict of relative path -> signature."""
+    return {relative_path: (size, mtime_ns, inode) for relative_path, size, mtime_ns, inode in entries(count)}
+
+
+def build_index(count: int) -> FileIndex:
+    """The entries added to a FileIndex."""
+    index = FileIndex()
+    for entry in entries(count):
+        index.add(*entry)
+    index.finish()
+    return index
+
+
+def lookup_list(paths: list, count: int):
+    """Membership checks against the list, through a set as the old code would have had to."""
+    paths = set(paths)
+    for relative_path, _, _, _ in entries(count):
+        assert f"{SOURCE}/{relative_path}" in paths
+
+
+def lookup_dict(records: dict, count: int):
+    """Signature lookups in the dict."""
+    for relative_path, _, _, _ in entries(count):
+        assert records.get(relative_path) is not None
+
+
+def lookup_index(index: FileIndex, count: int):
+    """Signature lookups in the index."""
+    for relative_path, _, _, _ in entries(count):
+        assert index.get(relative_path) is not None
+
+
+def benchmark(name: str, build, lookup, count: int) -> dict:
+    """Measure the memory held by and the speed of one approach."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    structure = build(count)
+    built = time.perf_counter() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    lookup(structure, count)
+    looked_up = time.perf_counter() - start
+    return {
+        "approach": name,
+        "entries": count,
+        "memory_mb": round(held / MEGABYTE, 1),
+        "bytes_per_entry": round(held / count, 1),
+        "build_seconds": round(built, 3),
+        "lookup_seconds": round(looked_up, 3)
+    }
+
+
+@click.command()
+@click.option("--entries", "count", type=click.IntRange(min=1), default=100_000, help="Number of entries in the tree")
+def main(count):
+    """Run the benchmark."""
+    for name, build, lookup in (
+        ("list", build_list, lookup_list),
+        ("dict", build_dict, lookup_dict),
+        ("index", build_index, lookup_index)
+    ):
+        print(benchmark(name, build, lookup, count))
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
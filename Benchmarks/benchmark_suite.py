@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Benchmark suite for Backup.transfer_files() and Backup.empty_directory().
+
+Builds synthetic source trees, backs each one up into a fresh target and reports files/s,
+MB/s, peak RSS and read/write syscall counts. Each scenario runs in its own process so the
+peak RSS and syscall counts belong to that scenario alone.
+
+Results are written to a JSON file, and can be compared against an earlier one:
+
+    python3 Benchmarks/benchmark_suite.py --output baseline.json
+    python3 Benchmarks/benchmark_suite.py --output new.json --baseline baseline.json
+
+The default scale of 0.01 runs in seconds. A scale of 1 builds the full sized trees
+(1M tiny files, 3 files of 2 GB, ...), so make sure there is enough space in --work_dir.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from backend import Backup  # pylint: disable=wrong-import-position
+
+MEGABYTE = 1024 * 1024
+CONDITIONS = {
+    # Name: (overwrite, overwrite_condition) of the second run over a pre-populated target.
+    "overwrite_all": (True, "Target Empty"),
+    "recently_modified": (True, "Recently Modified"),
+    "ignore": (False, "Ignore"),
+    "duplicate": (False, "Duplicate")
+}
+
+
+def write_file(path: str, size: int, chunk: bytes = b""):
+    """Write a file of the given size by repeating chunk."""
+    with open(path, "wb") as file:
+        while size > 0:
+            written = file.write(chunk[:size] if chunk else b"x" * size)
+            size = size - written
+
+
+def tiny_files(source: str, scale: float):
+    """1M files of 100 bytes, 1000 to a directory."""
+    for number in range(max(1, int(1_000_000 * scale))):
+        directory = f"{source}/dir{number // 1000}"
+        if number % 1000 == 0:
+            os.mkdir(directory)
+        write_file(f"{directory}/file{number}.txt", 100)
+
+
+def large_files(source: str, scale: float):
+    """Three files of 2 GB."""
+    chunk = os.urandom(MEGABYTE)
+    for number in range(3):
+        write_file(f"{source}/large{number}.bin", max(MEGABYTE, int(2048 * MEGABYTE * scale)), chunk)
+
+
+def deep_nesting(source: str, scale: float):
+    """A chain of 1000 nested directories with 10 small files in each."""
+    directory = source
+    for depth in range(max(1, int(1000 * scale))):
+        directory = f"{directory}/level{depth}"
+        os.mkdir(directory)
+        for number in range(10):
+            write_file(f"{directory}/file{number}.txt", 1024)
+
+
+def wide_directory(source: str, scale: float):
+    """One directory holding 200k small files."""
+    for number in range(max(1, int(200_000 * scale))):
+        write_file(f"{source}/file{number}.txt", 1024)
+
+
+def mixed_tree(source: str, scale: float):
+    """A home-directory like tree used for the pre-populated target scenarios."""
+    for number in range(max(1, int(100 * scale * 10))):
+        directory = f"{source}/project{number}"
+        os.makedirs(f"{directory}/src")
+        for file_number in range(20):
+            write_file(f"{directory}/src/module{file_number}.py", 4096)
+        write_file(f"{directory}/data.bin", 256 * 1024)
+
+
+GENERATORS = {
+    "tiny_files": tiny_files,
+    "large_files": large_files,
+    "deep_nesting": deep_nesting,
+    "wide_directory": wide_directory
+}
+
+
+def tree_size(directory: str) -> tuple:
+    """The number of files and total bytes beneath a directory."""
+    files = 0
+    size = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            files = files + 1
+            size = size + os.stat(os.path.join(root, name), follow_symlinks=False).st_size
+    return files, size
+
+
+def syscalls() -> dict:
+    """Read and write syscall counts for this process, from /proc/self/io."""
+    try:
+        with open("/proc/self/io", encoding="utf-8") as file:
+            fields = dict(line.split(": ") for line in file.read().splitlines())
+        return {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+    except (OSError, KeyError):
+        return {"read": 0, "write": 0}
+
+
+def measure(function) -> dict:
+    """Run function, returning its result with the wall time and syscalls it used."""
+    before = syscalls()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    after = syscalls()
+    return {
+        "result": result,
+        "seconds": seconds,
+        "syscalls": {key: after[key] - before[key] for key in after}
+    }
+
+
+def rates(files: int, size: int, seconds: float) -> dict:
+    """Throughput figures for a measured phase."""
+    seconds = max(seconds, 1e-9)
+    return {
+        "seconds": round(seconds, 4),
+        "files_per_second": round(files / seconds, 1),
+        "mb_per_second": round(size / MEGABYTE / seconds, 2)
+    }
+
+
+def run_scenario(name: str, work_dir: str, scale: float, workers: int, queue):
+    """Build one scenario, back it up and empty the target. Run in a child process."""
+    with tempfile.TemporaryDirectory(dir=work_dir) as directory, \
+            open(os.devnull, "w", encoding="utf-8") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        source = f"{directory}/source"
+        target = f"{directory}/target"
+        os.mkdir(source)
+        os.mkdir(target)
+
+        if name in GENERATORS:
+            GENERATORS[name](source, scale)
+            backup = Backup(source, target, workers=workers)
+        else:
+            # Pre-populate the target with a first backup, then time the second one.
+            mixed_tree(source, scale)
+            Backup(source, target, overwrite=True, workers=workers).transfer_files()
+            overwrite, condition = CONDITIONS[name]
+            backup = Backup(source, target, overwrite=overwrite, overwrite_condition=condition, workers=workers)
+
+        files, size = tree_size(source)
+        transfer = measure(backup.transfer_files)
+        empty = measure(lambda: backup.empty_directory(target))
+
+        queue.put({
+            "files": files,
+            "bytes": size,
+            "files_transferred": transfer["result"]["files_transferred"],
+            "transfer": {
+                **rates(files, size, transfer["seconds"]),
+                "syscalls": transfer["syscalls"]
+            },
+            "empty_directory": {
+                **rates(files, 0, empty["seconds"]),
+                "syscalls": empty["syscalls"]
+            },
+            # ru_maxrss is in kilobytes on Linux.
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        })
+
+
+def git_commit() -> str:
+    """The commit being benchmarked, if this is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Lines describing the change in throughput of each scenario against the baseline."""
+    lines = []
+    for name, result in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        for phase in ("transfer", "empty_directory"):
+            old = previous[phase]["files_per_second"]
+            new = result[phase]["files_per_second"]
+            change = (new - old) / old * 100 if old else 0.0
+            flag = "  REGRESSION" if change < -threshold else ""
+            lines.append(f"{name:>18} {phase:>15}: {old:>12.1f} -> {new:>12.1f} files/s ({change:+.1f}%){flag}")
+    return lines
+
+
+@click.command()
+@click.option("--scale", type=float, default=0.01, help="Fraction of the full sized trees to build")
+@click.option("--workers", type=click.IntRange(min=1), default=1, help="Number of copy workers passed to Backup")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice([*GENERATORS, *CONDITIONS]), help="Only run these scenarios")
+@click.option("--work_dir", type=click.Path(exists=True, file_okay=False), default=None, help="Where to build the trees")
+@click.option("--output", type=click.Path(dir_okay=False), default="benchmark_results.json", help="JSON file to write the results to")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), default=None, help="Earlier results to compare against")
+@click.option("--threshold", type=float, default=10.0, help="Percentage slowdown reported as a regression")
+def main(scale, workers, scenarios, work_dir, output, baseline, threshold):  # pylint: disable=too-many-arguments
+    """Run the benchmark suite."""
+    results = {
+        "commit": git_commit(),
+        "scale": scale,
+        "workers": workers,
+        "scenarios": {}
+    }
+
+    for name in scenarios or [*GENERATORS, *CONDITIONS]:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_scenario, args=(name, work_dir, scale, workers, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise click.ClickException(f"The {name} scenario failed.")
+        result = queue.get()
+        results["scenarios"][name] = result
+        print(
+            f"{name:>18}: {result['files']} files, "
+            f"{result['transfer']['files_per_second']} files/s, {result['transfer']['mb_per_second']} MB/s, "
+            f"peak RSS {result['peak_rss_mb']} MB"
+        )
+
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+
+    if baseline is not None:
+        with open(baseline, encoding="utf-8") as file:
+            lines = compare(results, json.load(file), threshold)
+        print("\n".join(lines))
+        if any(line.endswith("REGRESSION") for line in lines):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
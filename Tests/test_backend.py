@@ -1,13 +1,20 @@
 import sys
 import pathlib
 import os
+import errno
 import pytest
+import json
+import logging
+import random
+import shutil
+import tarfile
+import time
 from datetime import datetime
 
 # Adds "backend" to be a location that the interpretter searches for modules.
 sys.path.append("./backend") 
 
-from backend import Backup
+from backend import setup_logging, flush_logs, Backup, TargetIndex, FileCopier, IgnoreRules, Snapshots, ChunkStore, chunk_file, DeltaTransfer, ConcurrencyTuner, BackupPlan, SmallFilePipeline, FileIndex, LocalTarget, LatencyTarget, Manifest
 
 
 
@@ -110,6 +117,200 @@ def test_output():
 
 
 
+def test_list_files(tmp_path):
+    """Test the list_files() walker in backend.py."""
+    fill_source(10, tmp_path)
+    ignored_directory = tmp_path / "IgnoredDirectory"
+    os.makedirs(ignored_directory / "Nested")
+    fill_source(10, ignored_directory / "Nested")
+    os.mkdir(tmp_path / "Kept")
+    fill_source(5, tmp_path / "Kept")
+
+    backend = Backup(tmp_path, "./Tests/Test_Target", ignored_directories=[str(ignored_directory)])
+    listed = [relative_path for _, relative_path in backend.list_files()]
+
+    # Nothing beneath the ignored directory is visited.
+    assert len(listed) == 16
+    assert not any(path.startswith("IgnoredDirectory") for path in listed)
+
+    # Directories come before their contents.
+    assert listed.index("Kept") < listed.index("Kept/file0.txt")
+
+
+def test_list_files_unreadable(tmp_path, monkeypatch):
+    """Test that symlink loops and unreadable directories are skipped rather than ending the walk."""
+    source = tmp_path / "Source"
+    os.makedirs(source / "Folder")
+    (source / "Folder" / "file.txt").write_text("file")
+    os.symlink(".", source / "loop")
+    os.symlink("..", source / "Folder" / "parent")
+    os.mkdir(source / "Locked")
+    (source / "Locked" / "secret.txt").write_text("secret")
+
+    scandir = os.scandir
+    def locked_scandir(path):
+        if str(path).endswith("Locked"):
+            raise PermissionError(13, "Permission denied", str(path))
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", locked_scandir)
+    listed = sorted(relative_path for _, relative_path in Backup(source, tmp_path).list_files())
+
+    assert listed == ["Folder", "Folder/file.txt", "Locked"]
+
+
+def test_ignore_rules(tmp_path):
+    """Test the IgnoreRules matching of exact paths, extensions and patterns."""
+    rules = IgnoreRules(
+        tmp_path,
+        ignored_ext=["png"],
+        ignored_files=[f"{tmp_path}/Notes/secret.txt"],
+        ignored_directories=[f"{tmp_path}/Cache/"],
+        patterns=["# Comment", "*.tmp", "**/node_modules", "build/", "/docs/*.md", "file[!0-4].txt"]
+    )
+
+    assert rules.match("Cache", "Cache", True) == "directory"
+    assert rules.match("Notes/secret.txt", "secret.txt", False) == "file"
+    assert rules.match("Notes/image.png", "image.png", False) == "ext"
+    assert rules.match("a/b/scratch.tmp", "scratch.tmp", False) == "pattern"
+    assert rules.match("a/b/node_modules", "node_modules", True) == "pattern"
+    assert rules.match("a/build", "build", True) == "pattern"
+    assert rules.match("docs/readme.md", "readme.md", False) == "pattern"
+    assert rules.match("file7.txt", "file7.txt", False) == "pattern"
+
+    # Directory-only and anchored patterns do not match anything else.
+    assert rules.match("a/build", "build", False) is None
+    assert rules.match("a/docs/readme.md", "readme.md", False) is None
+    assert rules.match("file2.txt", "file2.txt", False) is None
+    assert rules.match("Notes", "Notes", True) is None
+
+    # Negated patterns re-include what earlier patterns ignored, and the last match decides.
+    rules = IgnoreRules(tmp_path, patterns=["*.log", "!keep.log", "logs/keep.log", "\\!important"])
+    assert rules.match("debug.log", "debug.log", False) == "pattern"
+    assert rules.match("keep.log", "keep.log", False) is None
+    assert rules.match("logs/keep.log", "keep.log", False) == "pattern"
+    assert rules.match("!important", "!important", False) == "pattern"
+    assert rules.match("important", "important", False) is None
+
+
+def test_list_files_backupignore(tmp_path):
+    """Test that patterns in .backupignore prune the walk."""
+    fill_source(3, tmp_path)
+    os.makedirs(tmp_path / "project" / "node_modules" / "package")
+    fill_source(3, tmp_path / "project" / "node_modules" / "package")
+    open(tmp_path / "scratch.tmp", "w").close()
+    with open(tmp_path / ".backupignore", "w") as file:
+        file.write("**/node_modules\n*.tmp\n")
+
+    backend = Backup(tmp_path, "./Tests/Test_Target")
+    listed = [relative_path for _, relative_path in backend.list_files()]
+    assert sorted(listed) == ["file0.txt", "file1.txt", "file2.txt", "project"]
+
+
+def test_target_index(tmp_path):
+    """Test the TargetIndex used for existence checks in the target."""
+    fill_source(3, tmp_path)
+    index = TargetIndex()
+
+    assert index.exists(f"{tmp_path}/file0.txt")
+    assert not index.exists(f"{tmp_path}/file3.txt")
+    assert index.stat(f"{tmp_path}/file0.txt")[0] == 0
+    assert index.stat(f"{tmp_path}/file3.txt") is None
+
+    # Files written during the run are answered from memory.
+    index.add(f"{tmp_path}/file3.txt", 5)
+    assert index.exists(f"{tmp_path}/file3.txt")
+    assert not os.path.exists(f"{tmp_path}/file3.txt")
+
+    # New directories are known to be empty without scanning them.
+    index.created(f"{tmp_path}/New")
+    assert index.exists(f"{tmp_path}/New")
+    assert not index.exists(f"{tmp_path}/New/file0.txt")
+
+
+def test_file_index():
+    """Test looking up entries and deriving their paths in a FileIndex."""
+    index = FileIndex()
+    index.add("b.txt", 2, 20, 200)
+    index.add("a.txt", 1, 10, 100)
+    index.add("Folder/é.txt", 3, -30, 300)
+    index.add("Folder/Sub/c.txt", 4, 40, 400)
+    index.finish()
+
+    assert len(index) == 4
+    assert index.get("a.txt") == (1, 10, 100)
+    assert index.get("Folder/é.txt") == (3, -30, 300)
+    assert index.get("Folder/Sub/c.txt") == (4, 40, 400)
+    assert index.get("Folder/c.txt") is None
+    assert "Missing/a.txt" not in index
+    assert "b.txt" in index
+    assert [index.path(number) for number in range(len(index))] == ["a.txt", "b.txt", "Folder/é.txt", "Folder/Sub/c.txt"]
+    assert index.total_size() == 10
+
+    # A directory's entries must arrive together.
+    with pytest.raises(ValueError):
+        index.add("Folder/late.txt")
+
+
+def test_next_duplicate(tmp_path):
+    """Test the "(n)" names chosen for the Duplicate condition."""
+    for name in ["report.txt", "report (1).txt", "report (4).txt", "archive.tar.gz", "Makefile"]:
+        open(tmp_path / name, "w").close()
+    index = TargetIndex()
+
+    # The next number follows the highest existing one.
+    assert index.next_duplicate(f"{tmp_path}/report.txt") == f"{tmp_path}/report (5).txt"
+    index.add(f"{tmp_path}/report (5).txt", 0)
+    assert index.next_duplicate(f"{tmp_path}/report.txt") == f"{tmp_path}/report (6).txt"
+
+    # Only the final suffix is split off, and names without one still get a number.
+    assert index.next_duplicate(f"{tmp_path}/archive.tar.gz") == f"{tmp_path}/archive.tar (1).gz"
+    assert index.next_duplicate(f"{tmp_path}/Makefile") == f"{tmp_path}/Makefile (1)"
+
+
+def test_file_copier(tmp_path):
+    """Test each FileCopier strategy and the fallback between them."""
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(3 * FileCopier.BUFFER_SIZE + 7))
+    os.chmod(source, 0o640)
+    copier = FileCopier()
+
+    for strategy in FileCopier.STRATEGIES:
+        target = tmp_path / f"{strategy}.bin"
+        try:
+            with open(source, "rb") as source_file, open(target, "wb") as target_file:
+                getattr(copier, strategy)(source_file.fileno(), target_file.fileno(), source.stat().st_size)
+        except OSError:
+            assert strategy in ("reflink", "copy_file_range")  # Depends on the filesystem.
+            continue
+        assert target.read_bytes() == source.read_bytes()
+
+    # The first strategy that works is used, and permission bits are kept.
+    strategy, allocated = copier.copy(source, tmp_path / "copy.bin")
+    assert strategy in FileCopier.STRATEGIES
+    assert allocated >= source.stat().st_size
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert (tmp_path / "copy.bin").stat().st_mode & 0o777 == 0o640
+    assert list(copier.selected.values()) == [FileCopier.STRATEGIES.index(strategy)]
+
+    # A short sendfile copy is an error rather than a truncated file.
+    with open(source, "rb") as source_file, open(tmp_path / "short.bin", "wb") as target_file:
+        with pytest.raises(OSError):
+            copier.sendfile(source_file.fileno(), target_file.fileno(), source.stat().st_size + 1)
+
+    # EINVAL moves only the one file on to the next strategy, while EXDEV demotes the strategy for later files too.
+    def failing_reflink(source_fd, target_fd, size):
+        raise OSError(failure, "Reflink failed.")
+    copier = FileCopier()
+    copier.reflink = failing_reflink
+    failure = errno.EINVAL
+    assert copier.copy(source, tmp_path / "einval.bin")[0] != "reflink"
+    assert not copier.selected
+    failure = errno.EXDEV
+    assert copier.copy(source, tmp_path / "exdev.bin")[0] != "reflink"
+    assert list(copier.selected.values())[0] >= 1
+    assert (tmp_path / "exdev.bin").read_bytes() == source.read_bytes()
+
+
 def test_transfer_files():
     good_source = "Tests/Test_Source"
     good_target = "Tests/Test_Target"
@@ -226,3 +427,874 @@ def test_transfer_files():
 
     backend.empty_directory(good_source)
     backend.empty_directory(good_target)
+
+
+def test_transfer_files_workers(tmp_path):
+    """Test transfer_files() with a pool of copy workers."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Nested" / "Deeper")
+    os.mkdir(target)
+    fill_source(20, source)
+    fill_source(20, source / "Nested")
+    fill_source(20, source / "Nested" / "Deeper")
+
+    backend = Backup(source, target, workers=8)
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 60
+    assert len(os.listdir(target / "Nested" / "Deeper")) == 20
+
+    # Existing files are skipped exactly as with a single worker.
+    fill_source(25, source)
+    backend = Backup(source, target, overwrite_condition="Ignore", workers=8)
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 5
+
+    # Invalid number of workers.
+    with pytest.raises(SystemExit):
+        Backup(source, target, workers=0)
+
+
+def test_transfer_files_incremental(tmp_path):
+    """Test that the manifest skips files unchanged since the last backup."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    fill_source(10, source)
+
+    backend = Backup(source, target, overwrite=True, incremental=True)
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 10
+    assert result["files_unchanged"] == 0
+
+    # Nothing changed, so nothing is copied.
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 0
+    assert result["files_unchanged"] == 10
+
+    # Only the modified file is copied.
+    with open(source / "file3.txt", "w") as file:
+        file.write("changed")
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 1
+    assert result["files_unchanged"] == 9
+
+    # Emptying the target also removes the manifest.
+    backend.empty_directory(target)
+    assert len(os.listdir(target)) == 0
+
+
+def test_transfer_files_incremental_undecodable(tmp_path):
+    """Test that the manifest records file names that are not valid UTF-8."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    for folder in (b"", b"/Folder"):
+        with open(os.fsencode(source) + folder + b"/caf\xe9.txt", "wb") as file:
+            file.write(b"coffee")
+        (pathlib.Path(os.fsdecode(os.fsencode(source) + folder)) / "tea.txt").write_text("tea")
+
+    backend = Backup(source, target, overwrite=True, incremental=True)
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 4
+    with open(os.fsencode(target) + b"/Folder/caf\xe9.txt", "rb") as file:
+        assert file.read() == b"coffee"
+
+    result = backend.transfer_files()
+    assert result["files_transferred"] == 0
+    assert result["files_unchanged"] == 4
+
+
+def test_transfer_files_duplicate(tmp_path):
+    """Test that the Duplicate condition keeps every version of a file."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    fill_source(5, source)
+
+    for _ in range(3):
+        result = Backup(source, target, overwrite_condition="Duplicate").transfer_files()
+        assert result["files_transferred"] == 5
+
+    assert sorted(os.listdir(target))[:3] == ["file0 (1).txt", "file0 (2).txt", "file0.txt"]
+    assert len(os.listdir(target)) == 15
+
+
+def test_transfer_files_metrics(tmp_path):
+    """Test the metrics in the result and their export for monitoring."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Ignored")
+    os.mkdir(target)
+    fill_source(10, source)
+    fill_source(3, source / "Ignored")
+    open(source / "image.png", "w").close()
+
+    backend = Backup(
+        source, target, ignored_ext=[".png"], ignored_directories=[source / "Ignored"],
+        metrics_file=tmp_path / "metrics.jsonl"
+    )
+    result = backend.transfer_files()
+    metrics = result["metrics"]
+    assert metrics["files_skipped"] == {"ignored_ext": 1, "ignored_directory": 1}
+    assert metrics["bytes_copied"] == 0
+    assert len(metrics["slowest_files"]) == 10
+    assert sum(metrics["throughput_histogram_mb_per_second"].values()) == 10
+    assert set(metrics["phase_seconds"]) == {"scan", "ignore", "decide", "mkdir", "copy", "wait"}
+
+    # Existing files are counted as skipped, and the Prometheus textfile is written.
+    backend = Backup(source, target, overwrite_condition="Ignore", metrics_file=tmp_path / "backup.prom")
+    result = backend.transfer_files()
+    assert result["metrics"]["files_skipped"]["already_exists"] == 10
+    prometheus = (tmp_path / "backup.prom").read_text()
+    assert 'automated_backup_files_skipped{reason="already_exists"} 10' in prometheus
+
+    lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["files_transferred"] == 10
+
+
+def test_progress(tmp_path, capsys):
+    """Test that the progress bar is only drawn when asked for or in a terminal."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    with open(source / "file.txt", "w") as file:
+        file.write("x" * 2048)
+
+    # Output is captured, so stdout is not a terminal.
+    backend = Backup(source, target, overwrite=True)
+    assert not backend.progress
+    backend.transfer_files()
+    assert capsys.readouterr().out == ""
+
+    # Progress is counted in bytes when the bar is drawn.
+    Backup(source, target, overwrite=True, progress=True).transfer_files()
+    assert "2KiB" in capsys.readouterr().out
+
+
+def test_transfer_files_resume(tmp_path, monkeypatch):
+    """Test that an interrupted backup can be resumed from its journal."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    fill_source(10, source)
+
+    # Interrupt the backup on the sixth copy.
+    copy_file = Backup.copy_file
+    copies = []
+    def interrupted_copy(self, file, destination):
+        if len(copies) == 5:
+            raise KeyboardInterrupt
+        copies.append(file)
+        return copy_file(self, file, destination)
+    monkeypatch.setattr(Backup, "copy_file", interrupted_copy)
+    with pytest.raises(KeyboardInterrupt):
+        Backup(source, target, overwrite_condition="Duplicate").transfer_files()
+    monkeypatch.undo()
+
+    # Only finished files are in the target, and the journal is left to resume from.
+    assert sorted(os.listdir(target)) == sorted([".automated_backup_journal"] + [os.path.basename(file) for file in copies])
+
+    result = Backup(source, target, overwrite_condition="Duplicate", resume=True).transfer_files()
+    assert result["files_transferred"] == 5
+    assert result["metrics"]["files_skipped"]["copied_before_resume"] == 5
+    assert sorted(os.listdir(target)) == sorted(os.listdir(source))
+
+    # Partial copies left by a run that was killed are removed by the next one, even if their file has gone.
+    os.makedirs(target / "Gone")
+    (target / "Gone" / ".file0.txt.backup-partial").write_text("half")
+    (target / ".file0.txt.backup-partial").write_text("half")
+    (target / ".automated_backup_journal").write_text("")
+    Backup(source, target, overwrite_condition="Duplicate").transfer_files()
+    assert not [name for name in os.listdir(target) if name.startswith(".")]
+    assert os.listdir(target / "Gone") == []
+
+
+def test_transfer_files_snapshot(tmp_path):
+    """Test snapshots that hardlink unchanged files to the previous one."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Nested")
+    os.mkdir(target)
+    fill_source(5, source)
+    fill_source(5, source / "Nested")
+
+    first = Backup(source, target, snapshot=True).transfer_files()
+    assert first["files_transferred"] == 10
+    assert first["files_linked"] == 0
+
+    # Date the first snapshot a day earlier so the daily retention keeps both.
+    first["snapshot"] = f"{target}/2024-01-01_000000"
+    os.rename(os.path.join(target, os.listdir(target)[0]), first["snapshot"])
+
+    with open(source / "Nested" / "file2.txt", "w") as file:
+        file.write("changed")
+    second = Backup(source, target, snapshot=True).transfer_files()
+    assert second["files_transferred"] == 1
+    assert second["files_linked"] == 9
+    assert second["snapshot"] != first["snapshot"]
+
+    # Unchanged files share an inode, changed ones do not.
+    assert os.stat(f"{first['snapshot']}/file0.txt").st_ino == os.stat(f"{second['snapshot']}/file0.txt").st_ino
+    assert os.stat(f"{first['snapshot']}/Nested/file2.txt").st_ino != os.stat(f"{second['snapshot']}/Nested/file2.txt").st_ino
+    with open(f"{second['snapshot']}/Nested/file2.txt") as file:
+        assert file.read() == "changed"
+
+
+def test_snapshots_expired(tmp_path):
+    """Test the daily and weekly snapshot retention policy."""
+    # Two snapshots a day for 30 days, starting on a Monday.
+    for day in range(30):
+        for hour in ("080000", "200000"):
+            date = datetime(2024, 1, 1).toordinal() + day
+            os.mkdir(tmp_path / f"{datetime.fromordinal(date).strftime('%Y-%m-%d')}_{hour}")
+    snapshots = Snapshots(tmp_path)
+
+    expired = snapshots.expired(keep_daily=3, keep_weekly=3)
+    kept = sorted(set(snapshots.names) - {path.name for path in expired})
+    # The last 3 days, plus the newest of the week before.
+    assert kept == ["2024-01-21_200000", "2024-01-28_200000", "2024-01-29_200000", "2024-01-30_200000"]
+
+    snapshots.prune(keep_daily=3, keep_weekly=3)
+    assert sorted(os.listdir(tmp_path)) == kept
+
+
+def test_chunk_file(tmp_path):
+    """Test that content-defined chunk boundaries survive an insertion."""
+    data = random.Random(0).randbytes(1024 * 1024)
+    (tmp_path / "original.bin").write_bytes(data)
+    (tmp_path / "inserted.bin").write_bytes(data[:1000] + b"inserted" + data[1000:])
+
+    original = chunk_file(str(tmp_path / "original.bin"), *Backup.CHUNK_SIZES, read_size=100000)
+    inserted = chunk_file(str(tmp_path / "inserted.bin"), *Backup.CHUNK_SIZES)
+    assert sum(length for _, length in original) == len(data)
+    assert all(length <= Backup.CHUNK_SIZES[2] for _, length in original)
+
+    # Only the chunks around the insertion change.
+    assert len(set(inserted) - set(original)) <= 2
+    assert len(set(inserted) & set(original)) >= len(original) - 2
+
+
+def test_chunk_file_numpy(tmp_path, monkeypatch):
+    """Test that finding boundaries with numpy gives the same chunks as hashing a byte at a time."""
+    pytest.importorskip("numpy")
+    data = random.Random(4).randbytes(700 * 1024) + bytes(300 * 1024) + random.Random(5).randbytes(500 * 1024)
+    (tmp_path / "data.bin").write_bytes(data)
+    chunked = [chunk_file(str(tmp_path / "data.bin"), *sizes, read_size=100000) for sizes in (Backup.CHUNK_SIZES, (0, 6, 512))]
+
+    monkeypatch.setattr(sys.modules[chunk_file.__module__], "gear_boundaries", lambda data, mask: None)
+    assert chunk_file(str(tmp_path / "data.bin"), *Backup.CHUNK_SIZES, read_size=100000) == chunked[0]
+    assert chunk_file(str(tmp_path / "data.bin"), 0, 6, 512, read_size=100000) == chunked[1]
+
+
+def test_transfer_files_chunked(tmp_path):
+    """Test backing up to and restoring from the deduplicating chunk store."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    restored = tmp_path / "Restored"
+    os.makedirs(source / "Copies")
+    os.mkdir(target)
+    data = os.urandom(512 * 1024)
+    (source / "image.bin").write_bytes(data)
+    (source / "Copies" / "renamed.bin").write_bytes(data)
+    (source / "Copies" / "small.txt").write_bytes(b"hello")
+
+    # A dry run counts the files but creates no store.
+    result = Backup(source, target, target_format="chunked", dry_run=True).transfer_files()
+    assert result["plan"] == {"files_to_copy": 3, "bytes_to_copy": 2 * len(data) + 5}
+    assert os.listdir(target) == []
+
+    result = Backup(source, target, target_format="chunked").transfer_files()
+    assert result["files_transferred"] == 3
+    assert result["bytes_read"] == 2 * len(data) + 5
+    assert result["bytes_written"] == len(data) + 5
+    assert result["dedup_ratio"] > 1.9
+
+    # Unchanged files are not chunked again.
+    result = Backup(source, target, target_format="chunked").transfer_files()
+    assert result["files_transferred"] == 0
+    result = Backup(source, target, target_format="chunked", dry_run=True).transfer_files()
+    assert result["files_unchanged"] == 3
+
+    store = ChunkStore(target)
+    assert store.restore(restored, "Copies/*") == 2
+    store.close()
+    assert (restored / "Copies" / "renamed.bin").read_bytes() == data
+    assert (restored / "Copies" / "small.txt").read_bytes() == b"hello"
+    assert not (restored / "image.bin").exists()
+
+    # Options the chunked format cannot carry out are refused rather than ignored.
+    for option in ({"verify": True}, {"resume": True}, {"delta_threshold": 0}, {"metrics_file": tmp_path / "m.json"}):
+        with pytest.raises(SystemExit):
+            Backup(source, target, target_format="chunked", **option)
+    assert Backup.unsupported_options("chunked", verify=True, pipeline=False, bandwidth_limit=None) == ["verify"]
+    assert Backup.unsupported_options("mirror", verify=True) == []
+
+
+def test_transfer_files_chunked_undecodable(tmp_path):
+    """Test that the chunk store records and restores file names that are not valid UTF-8."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    with open(os.fsencode(source) + b"/caf\xe9.txt", "wb") as file:
+        file.write(b"coffee")
+    (source / "tea.txt").write_text("tea")
+
+    result = Backup(source, target, target_format="chunked").transfer_files()
+    assert result["files_transferred"] == 2
+    result = Backup(source, target, target_format="chunked", overwrite=True).transfer_files()
+    assert result["files_transferred"] == 0
+
+    store = ChunkStore(target)
+    assert store.restore(tmp_path / "Restored", "caf*") == 1
+    store.close()
+    with open(os.fsencode(tmp_path) + b"/Restored/caf\xe9.txt", "rb") as file:
+        assert file.read() == b"coffee"
+
+
+def test_chunk_store_claims(tmp_path, monkeypatch):
+    """Test that chunks are claimed until written, and released again if their write fails."""
+    data = random.Random(1).randbytes(256 * 1024)
+    (tmp_path / "a.bin").write_bytes(data)
+    chunks = chunk_file(str(tmp_path / "a.bin"), *Backup.CHUNK_SIZES)
+    store = ChunkStore(tmp_path / "Store")
+    new = store.new_chunks(chunks)
+    assert store.new_chunks(chunks) == []  # Another file with the same content leaves them to the first.
+    assert not store.complete(chunks)
+
+    store.release(new)
+    assert store.new_chunks(chunks) == new
+    store.write_chunks(str(tmp_path / "a.bin"), new)
+    store.written(new)
+    assert store.complete(chunks)
+    store.close()
+
+    # A failed write leaves nothing recorded, so the next run writes every chunk.
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    (source / "a.bin").write_bytes(data)
+    (source / "b.bin").write_bytes(data)
+    def failing_write(self, file, new):
+        raise OSError("Target full.")
+    monkeypatch.setattr(ChunkStore, "write_chunks", failing_write)
+    with pytest.raises(OSError):
+        Backup(source, target, target_format="chunked").transfer_files()
+    monkeypatch.undo()
+
+    result = Backup(source, target, target_format="chunked", overwrite=True).transfer_files()
+    assert result["files_transferred"] == 2
+    assert result["bytes_written"] == len(data)
+    store = ChunkStore(target)
+    assert store.restore(tmp_path / "Restored") == 2
+    store.close()
+    assert (tmp_path / "Restored" / "a.bin").read_bytes() == (tmp_path / "Restored" / "b.bin").read_bytes() == data
+
+
+def test_delta_transfer(tmp_path):
+    """Test that a delta copy rebuilds the file and only writes what changed."""
+    data = random.Random(1).randbytes(20 * 64 * 1024)
+    changed = data[:100000] + b"inserted" + data[100000:500000] + bytes(5000) + data[505000:]
+    (tmp_path / "source.bin").write_bytes(changed)
+    (tmp_path / "target.bin").write_bytes(data)
+
+    delta = DeltaTransfer(tmp_path)
+    literal, matched = delta.copy(str(tmp_path / "source.bin"), str(tmp_path / "target.bin"))
+    assert (tmp_path / "target.bin").read_bytes() == changed
+    assert literal + matched == len(changed)
+    # The insertion and the overwritten range each cost at most two blocks.
+    assert literal <= 4 * delta.block_size
+
+    # The signatures of the new file are cached, so an unchanged file is entirely matched.
+    literal, matched = delta.copy(str(tmp_path / "source.bin"), str(tmp_path / "target.bin"))
+    assert matched == len(changed) // delta.block_size * delta.block_size
+    delta.close()
+
+
+def test_transfer_files_delta(tmp_path):
+    """Test transfer_files() updating large files by delta."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    data = random.Random(2).randbytes(10 * 64 * 1024)
+    (source / "large.bin").write_bytes(data)
+    (source / "small.txt").write_bytes(b"small")
+    with open(os.fsencode(source) + b"/caf\xe9.bin", "wb") as file:  # Not valid UTF-8.
+        file.write(data)
+
+    backend = Backup(source, target, overwrite=True, delta_threshold=64 * 1024)
+    result = backend.transfer_files()
+    assert result["copy_strategies"].get("delta", 0) == 0
+
+    (source / "large.bin").write_bytes(data[:1000] + b"x" + data[1001:])
+    with open(os.fsencode(source) + b"/caf\xe9.bin", "r+b") as file:
+        file.write(b"y")
+    result = backend.transfer_files()
+    assert result["copy_strategies"]["delta"] == 2
+    assert result["metrics"]["bytes_copied"] <= 2 * 64 * 1024 + 5
+    assert (target / "large.bin").read_bytes() == (source / "large.bin").read_bytes()
+
+
+def test_transfer_files_delta_empty(tmp_path):
+    """Test that a delta_threshold of 0 copies files that are, or replace, empty files in full."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    (source / "filled.txt").write_bytes(b"now has data")
+    (source / "emptied.txt").write_bytes(b"")
+    (target / "filled.txt").write_bytes(b"")
+    (target / "emptied.txt").write_bytes(b"had data")
+    for name in ("filled.txt", "emptied.txt"):
+        os.utime(target / name, (1, 1))  # Older than the source, so both are overwritten.
+
+    result = Backup(source, target, overwrite=True, delta_threshold=0).transfer_files()
+    assert result["copy_strategies"].get("delta", 0) == 0
+    assert (target / "filled.txt").read_bytes() == b"now has data"
+    assert (target / "emptied.txt").read_bytes() == b""
+
+
+def test_transfer_files_verify(tmp_path):
+    """Test transfer_files() with verify and the standalone verify_files()."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    (source / "a.txt").write_bytes(b"a" * 5000)
+    (source / "b.txt").write_bytes(b"b" * 5000)
+    (source / "Folder" / "c.txt").write_bytes(b"c" * 5000)
+    with open(os.fsencode(source) + b"/caf\xe9.txt", "wb") as file:  # Not valid UTF-8.
+        file.write(b"coffee")
+
+    result = Backup(source, target, verify=True).transfer_files()
+    assert result["verify"] == {"files_verified": 4, "hashes_reused": 0, "mismatches": []}
+
+    # Damage two of the copies.
+    (target / "a.txt").write_bytes(b"x" * 5000)
+    (target / "Folder" / "c.txt").write_bytes(b"c" * 10)
+    result = Backup(source, target).verify_files(workers=2)
+    assert result["files_verified"] == 3
+    assert result["hashes_reused"] == 3  # Every source file was hashed by the first run.
+    assert sorted(result["mismatches"], key=lambda mismatch: mismatch["path"]) == [
+        {"path": "Folder/c.txt", "reason": "size"},
+        {"path": "a.txt", "reason": "content"}
+    ]
+
+
+def test_verify_files_targets(tmp_path):
+    """Test verify_files() against snapshots, a chunk store and a missing target."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    (source / "a.txt").write_bytes(b"a" * 5000)
+    (source / "b.txt").write_bytes(b"b" * 5000)
+
+    Backup(source, target, snapshot=True).transfer_files()
+    (source / "b.txt").write_bytes(b"c" * 5000)
+    Backup(source, target, snapshot=True).transfer_files()
+    result = Backup(source, target).verify_files()
+    assert result["files_verified"] == 2
+    assert result["mismatches"] == []
+
+    with pytest.raises(SystemExit):
+        Backup(source, tmp_path / "Missing").verify_files()
+
+    os.mkdir(tmp_path / "Chunked")
+    Backup(source, tmp_path / "Chunked", target_format="chunked").transfer_files()
+    with pytest.raises(SystemExit):
+        Backup(source, tmp_path / "Chunked").verify_files()
+
+
+def test_transfer_files_auto_tune(tmp_path, monkeypatch):
+    """Test that auto tuning runs more copies at once against a high-latency target."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    fill_source(300, source)
+
+    # Stands in for a network share, where each file takes 10ms however many are in flight.
+    copy_file = Backup.copy_file
+    def slow_copy(self, file, destination):
+        time.sleep(0.01)
+        return copy_file(self, file, destination)
+    monkeypatch.setattr(Backup, "copy_file", slow_copy)
+    monkeypatch.setattr(ConcurrencyTuner, "INTERVAL", 0.05)
+
+    result = Backup(source, target, auto_tune=True, max_workers=32).transfer_files()
+    assert result["files_transferred"] == 300
+    assert result["concurrency"]["peak"] >= 8
+    assert sorted(os.listdir(target)) == sorted(os.listdir(source))
+
+
+def test_transfer_files_bandwidth_limit(tmp_path):
+    """Test that the bandwidth limit holds back the copies."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    for number in range(10):
+        (source / f"file{number}.bin").write_bytes(bytes(100 * 1024))
+
+    start = time.perf_counter()
+    Backup(source, target, workers=4, bandwidth_limit=2 * 1024 * 1024).transfer_files()
+    # The first 900KiB have to be started before the last file can be, at 2MiB/s.
+    assert time.perf_counter() - start >= 0.4
+
+
+def test_setup_logging(tmp_path, monkeypatch):
+    """Test that buffered log records are written by flush_logs() and on a timer, not only on errors."""
+    root = logging.getLogger()
+    monkeypatch.setattr(root, "handlers", [])
+    listener = setup_logging(str(tmp_path / "flushed.log"), flush_interval=60)
+    logging.info("written by flush_logs")
+    while not listener.queue.empty():
+        time.sleep(0.01)
+    time.sleep(0.1)  # Lets the listener hand the record to the buffer.
+    assert not (tmp_path / "flushed.log").exists()
+    flush_logs()
+    assert "written by flush_logs" in (tmp_path / "flushed.log").read_text()
+
+    root.handlers = []
+    setup_logging(str(tmp_path / "timed.log"), flush_interval=0.1)
+    logging.info("written by the timer")
+    time.sleep(0.5)
+    assert "written by the timer" in (tmp_path / "timed.log").read_text()
+
+
+def test_watch(tmp_path, monkeypatch):
+    """Test that watch() backs up only what changed after the first transfer, with one manifest for the batches."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    fill_source(5, source)
+    opened = []
+    manifest_init = Manifest.__init__
+    def counted_init(self, *args, **kwargs):
+        opened.append(self)
+        manifest_init(self, *args, **kwargs)
+    monkeypatch.setattr(Manifest, "__init__", counted_init)
+
+    results = Backup(source, target, overwrite=True, incremental=True, ignore_patterns=["*.tmp"]).watch(debounce=0.1)
+    assert next(results)["files_transferred"] == 5
+
+    (source / "file0.txt").write_text("changed")
+    (source / "Folder" / "new.txt").write_text("new")
+    os.makedirs(source / "New" / "Nested")
+    (source / "New" / "Nested" / "deep.txt").write_text("deep")
+    (source / "ignored.tmp").write_text("tmp")
+    result = next(results)
+    assert result["files_transferred"] == 3
+    assert (target / "file0.txt").read_text() == "changed"
+    assert (target / "Folder" / "new.txt").read_text() == "new"
+    assert (target / "New" / "Nested" / "deep.txt").read_text() == "deep"
+
+    # The new directory is watched too.
+    (source / "New" / "Nested" / "later.txt").write_text("later")
+    assert next(results)["files_transferred"] == 1
+    assert (target / "New" / "Nested" / "later.txt").exists()
+    assert len(opened) == 2  # The first transfer's, then the one kept open for every batch.
+    assert "New/Nested/later.txt" in Manifest(target).records  # Written after the batch.
+    results.close()
+
+
+def test_transfer_files_mirror(tmp_path):
+    """Test that mirror removes files no longer in the source, unless too many would go."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    fill_source(10, source)
+    (source / "Folder" / "nested.txt").write_text("nested")
+    (source / "keep.tmp").write_text("ignored")
+    Backup(source, target, incremental=True).transfer_files()
+    (target / "keep.tmp").write_text("ignored files are never removed")
+
+    os.remove(source / "file0.txt")
+    os.rename(source / "file1.txt", source / "renamed.txt")
+    shutil.rmtree(source / "Folder")
+
+    result = Backup(source, target, overwrite=True, dry_run=True, mirror=True, ignore_patterns=["*.tmp"]).transfer_files()
+    assert sorted(result["mirror"]["orphans"]) == ["Folder", "file0.txt", "file1.txt"]
+    assert result["mirror"]["files_orphaned"] == 3
+    assert not result["mirror"]["removed"]
+    assert (target / "file0.txt").exists()
+
+    result = Backup(source, target, overwrite=True, mirror=True, ignore_patterns=["*.tmp"]).transfer_files()
+    assert result["mirror"]["removed"]
+    assert sorted(os.listdir(target)) == sorted(os.listdir(source) + [".automated_backup_manifest.sqlite"])
+
+    # An emptied source would remove everything, which is over the threshold.
+    Backup(source, target).empty_directory(source)
+    result = Backup(source, target, overwrite=True, mirror=True, ignore_patterns=["*.tmp"]).transfer_files()
+    assert result["mirror"]["aborted"]
+    assert (target / "renamed.txt").exists()
+
+
+def test_transfer_files_mirror_returned(tmp_path):
+    """Test that a file removed by mirror is copied again when it comes back unchanged."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    fill_source(5, source)
+    (source / "Folder" / "nested.txt").write_text("nested")
+    Backup(source, target, incremental=True).transfer_files()
+
+    # Moved out of the source, then back, keeping the same size, mtime and inode.
+    os.rename(source / "file0.txt", tmp_path / "file0.txt")
+    os.rename(source / "Folder", tmp_path / "Folder")
+    result = Backup(source, target, overwrite=True, mirror=True, mirror_threshold=1).transfer_files()
+    assert result["mirror"]["removed"]
+    assert not (target / "file0.txt").exists()
+    os.rename(tmp_path / "file0.txt", source / "file0.txt")
+    os.rename(tmp_path / "Folder", source / "Folder")
+
+    result = Backup(source, target, overwrite=True, incremental=True, mirror=True, mirror_threshold=1).transfer_files()
+    assert result["files_transferred"] == 2
+    assert result["files_unchanged"] == 4
+    assert (target / "file0.txt").exists()
+    assert (target / "Folder" / "nested.txt").read_text() == "nested"
+
+    # The same through an incremental mirror, which has the manifest open.
+    os.rename(source / "file1.txt", tmp_path / "file1.txt")
+    Backup(source, target, overwrite=True, incremental=True, mirror=True, mirror_threshold=1).transfer_files()
+    os.rename(tmp_path / "file1.txt", source / "file1.txt")
+    result = Backup(source, target, overwrite=True, incremental=True).transfer_files()
+    assert result["files_transferred"] == 1
+    assert (target / "file1.txt").exists()
+
+    # A manifest kept open, as by watch(), stops treating forgotten paths as unchanged at once.
+    manifest = Manifest(target, track_updates=True)
+    entries = {entry.name: entry for entry in os.scandir(source / "Folder")}
+    assert manifest.unchanged("Folder/nested.txt", entries["nested.txt"])
+    manifest.forget(["Folder"])
+    assert not manifest.unchanged("Folder/nested.txt", entries["nested.txt"])
+    manifest.close()
+
+
+def test_plan(tmp_path):
+    """Test making, saving, limiting and executing a backup plan."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder")
+    os.mkdir(target)
+    for number in range(4):
+        (source / f"file{number}.txt").write_bytes(bytes(1000))
+    (source / "Folder" / "nested.txt").write_bytes(bytes(500))
+    (target / "file0.txt").write_bytes(b"old")
+
+    backend = Backup(source, target, overwrite_condition="Duplicate", incremental=True)
+    plan = backend.plan()
+    assert os.listdir(target) == ["file0.txt"]  # Planning writes nothing.
+    assert sorted((operation.kind, operation.destination) for operation in plan.operations if operation.kind != "copy") == [
+        ("duplicate", "file0 (1).txt"), ("mkdir", "")
+    ]
+    summary = plan.summary()
+    assert summary["files_to_copy"] == 5
+    assert summary["bytes_to_copy"] == 4500
+    assert summary["estimated_seconds"] is None  # Nothing has been measured yet.
+
+    # A dry run only makes the plan.
+    result = Backup(source, target, overwrite_condition="Duplicate", dry_run=True).transfer_files()
+    assert result["plan"]["files_to_copy"] == 5
+    assert result["files_transferred"] == 0
+
+    plan.save(tmp_path / "plan.jsonl")
+    loaded = BackupPlan.load(tmp_path / "plan.jsonl")
+    assert loaded.operations == plan.operations
+    limited = loaded.limit(2500)
+    assert limited.summary()["bytes_to_copy"] == 2500
+
+    result = backend.execute(limited)
+    assert result["files_transferred"] == 3
+    assert (target / "file0.txt").read_bytes() == b"old"
+
+    # The rest is copied by the next run, whose plan has an estimate from this one.
+    plan = backend.plan()
+    assert plan.summary()["files_to_copy"] == 2
+    assert plan.summary()["estimated_seconds"] is not None
+    assert backend.execute(plan)["files_transferred"] == 2
+
+
+def test_sparse_copy(tmp_path):
+    """Test that sparse files are copied one data extent at a time, keeping their holes."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.mkdir(source)
+    os.mkdir(target)
+    with open(source / "disk.img", "wb") as file:
+        file.seek(4 * 1024 * 1024)
+        file.write(b"data" * 1024)
+        file.truncate(16 * 1024 * 1024)  # A hole at the end too.
+    if (source / "disk.img").stat().st_blocks * 512 >= 16 * 1024 * 1024:
+        pytest.skip("The filesystem does not support sparse files.")
+
+    with open(source / "disk.img", "rb") as file:
+        extents = FileCopier.data_extents(file.fileno(), 16 * 1024 * 1024)
+    assert sum(length for _, length in extents) < 1024 * 1024
+
+    result = Backup(source, target).transfer_files()
+    assert (target / "disk.img").read_bytes() == (source / "disk.img").read_bytes()
+    assert result["bytes_logical"] == 16 * 1024 * 1024
+    assert result["bytes_physical"] < 1024 * 1024
+
+
+def test_transfer_files_pipeline(tmp_path):
+    """Test copying small files through the read-ahead pipeline."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Nested")
+    os.mkdir(target)
+    for number in range(50):
+        (source / "Nested" / f"file{number}.txt").write_bytes(random.Random(number).randbytes(number * 100))
+    (source / "large.bin").write_bytes(bytes(1024 * 1024))
+
+    # A budget of one slot, so every file has to wait for the last to be written.
+    result = Backup(source, target, workers=2, pipeline=True, memory_budget=1).transfer_files()
+    assert result["files_transferred"] == 51
+    assert result["copy_strategies"]["pipelined"] == 50
+    for number in range(50):
+        assert (target / "Nested" / f"file{number}.txt").read_bytes() == (source / "Nested" / f"file{number}.txt").read_bytes()
+    assert (target / "large.bin").stat().st_size == 1024 * 1024
+
+    # A file bigger than a slot is handed to the fallback.
+    pipeline = SmallFilePipeline(lambda file, destination: "fallback", budget=2048, slot_size=1024)
+    assert pipeline.submit(source / "Nested" / "file20.txt", str(target / "copy.txt")).result() == "fallback"
+    assert pipeline.submit(source / "Nested" / "file5.txt", str(target / "copy.txt")).result()[0] == "pipelined"
+    pipeline.close()
+
+    # A fallback that fails frees its slot once only, so later files never share a slot.
+    def failing_fallback(file, destination):
+        raise OSError("fallback failed")
+    pipeline = SmallFilePipeline(failing_fallback, budget=2048, slot_size=1024, readers=2, writers=2)
+    with pytest.raises(OSError):
+        pipeline.submit(source / "Nested" / "file20.txt", str(target / "failed.txt")).result()
+    futures = [pipeline.submit(source / "Nested" / f"file{number}.txt", str(target / f"small{number}.txt")) for number in range(10)]
+    for future in futures:
+        future.result()
+    pipeline.close()
+    assert pipeline.free.qsize() == pipeline.slots
+    for number in range(10):
+        assert (target / f"small{number}.txt").read_bytes() == (source / "Nested" / f"file{number}.txt").read_bytes()
+
+
+def test_transfer_files_backend(tmp_path):
+    """Test backing up through a slow target backend and to a tar archive."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    os.makedirs(source / "Folder" / "Nested")
+    os.mkdir(target)
+    for number in range(5):
+        (source / f"file{number}.txt").write_text(f"content {number}")
+    (source / "Folder" / "Nested" / "deep.txt").write_text("deep")
+
+    # A dry run puts nothing, through a backend or into an archive.
+    backend = LatencyTarget(LocalTarget(target), latency=0.001)
+    result = Backup(source, target, dry_run=True, target_backend=backend).transfer_files()
+    assert result["plan"]["files_to_copy"] == 6
+    assert result["files_transferred"] == 0
+    result = Backup(source, target, dry_run=True, target_format="tar").transfer_files()
+    assert result["plan"]["files_to_copy"] == 6
+    assert os.listdir(target) == []
+
+    backend = LatencyTarget(LocalTarget(target), latency=0.001, bandwidth=10 * 1024 * 1024)
+    result = Backup(source, target, incremental=True, target_backend=backend).transfer_files()
+    assert result["files_transferred"] == 6
+    assert (target / "Folder" / "Nested" / "deep.txt").read_text() == "deep"
+    # One mkdir_many per directory with subdirectories, one stat_many per directory with files and one put per file.
+    assert backend.round_trips == 2 + 2 + 6
+
+    # The second run finds every file unchanged with one stat_many per directory.
+    backend = LatencyTarget(LocalTarget(target), latency=0.001)
+    result = Backup(source, target, overwrite=True, incremental=True, target_backend=backend).transfer_files()
+    assert result["files_transferred"] == 0
+    assert result["files_skipped"] == {"unchanged": 6}
+
+    (source / "file0.txt").write_text("changed")
+    result = Backup(source, target, overwrite_condition="Duplicate", target_backend=LocalTarget(target)).transfer_files()
+    assert (target / "file0 (1).txt").read_text() == "changed"
+
+    # The next copy goes above the highest "(n)", not into a gap, with one listing per directory.
+    (target / "file0 (3).txt").write_text("old")
+    os.remove(target / "file1 (1).txt")
+    backend = LatencyTarget(LocalTarget(target))
+    Backup(source, target, overwrite_condition="Duplicate", target_backend=backend).transfer_files()
+    assert (target / "file0 (4).txt").read_text() == "changed"
+    assert not (target / "file0 (2).txt").exists()
+    assert (target / "file1 (1).txt").read_text() == "content 1"
+    # One mkdir_many per directory with subdirectories, one stat_many and one list_directory per directory with files.
+    assert backend.round_trips == 2 + 2 * 2 + 6
+
+    # Options backends cannot carry out are refused rather than ignored, as is incremental for archives.
+    with pytest.raises(SystemExit):
+        Backup(source, target, verify=True, target_backend=LocalTarget(target))
+    with pytest.raises(SystemExit):
+        Backup(source, target, incremental=True, target_format="tar")
+    assert Backup.unsupported_options("tar.zst", incremental=True, resume=False) == ["incremental"]
+    assert Backup.unsupported_options("mirror", LocalTarget(target), incremental=True, pipeline=True) == ["pipeline"]
+
+    archive_target = tmp_path / "Archive"
+    os.mkdir(archive_target)
+    result = Backup(source, archive_target, target_format="tar").transfer_files()
+    with tarfile.open(result["archive"]) as archive:
+        assert sorted(archive.getnames()) == sorted([
+            "Folder", "Folder/Nested", "Folder/Nested/deep.txt", *(f"file{number}.txt" for number in range(5))
+        ])
+        assert archive.extractfile("file0.txt").read() == b"changed"
+
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_restore(tmp_path, incremental):
+    """Test restoring the newest copy of the files matching a pattern, with and without a manifest."""
+    source = tmp_path / "Source"
+    target = tmp_path / "Target"
+    restored = tmp_path / "Restored"
+    os.makedirs(source / "Folder" / "Nested")
+    os.mkdir(target)
+    (source / "top.txt").write_text("top")
+    (source / "Folder" / "notes.txt").write_text("version 1")
+    (source / "Folder" / "data.log").write_text("log")
+    (source / "Folder" / "Nested" / "deep.txt").write_text("deep")
+
+    Backup(source, target, incremental=incremental).transfer_files()
+    for version in (2, 3):
+        time.sleep(0.01)
+        (source / "Folder" / "notes.txt").write_text(f"version {version}")
+        Backup(source, target, overwrite_condition="Duplicate", incremental=incremental).transfer_files()
+    assert (target / "Folder" / "notes (2).txt").exists()
+
+    result = Backup(restored, target, workers=2).restore(restored, "Folder/*.txt")
+    assert result["files_transferred"] == 2
+    assert (restored / "Folder" / "notes.txt").read_text() == "version 3"
+    assert (restored / "Folder" / "Nested" / "deep.txt").read_text() == "deep"
+    # Restores keep the modification time of the copy restored from.
+    assert os.stat(restored / "Folder" / "notes.txt").st_mtime_ns == os.stat(target / "Folder" / "notes (2).txt").st_mtime_ns
+    assert sorted(os.listdir(restored)) == ["Folder"]
+    assert sorted(os.listdir(restored / "Folder")) == ["Nested", "notes.txt"]
+
+
+def test_restore_duplicate_gap(tmp_path):
+    """Test that the newest copy is restored when the "(n)" numbers have a gap that was filled last."""
+    target = tmp_path / "Target"
+    restored = tmp_path / "Restored"
+    os.mkdir(target)
+    for version, name in enumerate(["notes.txt", "notes (1).txt", "notes (3).txt", "notes (4).txt", "notes (2).txt"], start=1):
+        (target / name).write_text(f"version {version}")
+        os.utime(target / name, ns=(version * 10**9, version * 10**9))
+
+    Backup(restored, target).restore(restored, "notes*")
+    assert (restored / "notes.txt").read_text() == "version 5"
+    assert os.stat(restored / "notes.txt").st_mtime_ns == 5 * 10**9  # Restores keep the backup's modification times.
@@ -0,0 +1,105 @@
+import sys
+import os
+import json
+import pytest
+
+# Adds "backend" to be a location that the interpretter searches for modules.
+sys.path.append("./backend")
+
+from runner import load_jobs, run_jobs, group_by_device, is_due
+
+
+def write_config(path, text):
+    """Write a configuration file and return its path."""
+    path.write_text(text)
+    return str(path)
+
+
+def test_load_jobs(tmp_path):
+    """Test that defaults are applied and mistakes in the configuration are reported."""
+    config = write_config(tmp_path / "jobs.toml", """
+[defaults]
+workers = 2
+incremental = true
+
+[[job]]
+name = "documents"
+source = "~/Documents"
+target = "/mnt/Documents"
+workers = 4
+
+[[job]]
+source = "~/Pictures"
+target = "/mnt/Pictures"
+schedule = "weekly"
+""")
+    jobs, notify = load_jobs(config)
+    assert notify is False
+    assert [job["name"] for job in jobs] == ["documents", "job2"]
+    assert jobs[0]["workers"] == 4
+    assert jobs[1]["workers"] == 2
+    assert jobs[1]["incremental"] is True
+
+    with pytest.raises(ValueError):
+        load_jobs(write_config(tmp_path / "bad.toml", '[[job]]\nsource = "a"\ntarget = "b"\nspeed = 1\n'))
+    with pytest.raises(ValueError):
+        load_jobs(write_config(tmp_path / "bad.toml", '[[job]]\nsource = "a"\n'))
+    with pytest.raises(ValueError):
+        load_jobs(write_config(tmp_path / "bad.toml", '[[job]]\nsource = "a"\ntarget = "b"\nschedule = "monthly"\n'))
+    for schedule in ("true", "0", "[60]", "{ minutes = 60 }"):
+        with pytest.raises(ValueError):
+            load_jobs(write_config(tmp_path / "bad.toml", f'[[job]]\nsource = "a"\ntarget = "b"\nschedule = {schedule}\n'))
+
+
+def test_group_by_device():
+    """Test that jobs sharing a device, directly or through another job, end up in the same lane."""
+    jobs = [{"name": name} for name in ("a", "b", "c", "d")]
+    lanes = group_by_device(jobs, {"a": {1, 2}, "b": {3}, "c": {2, 3}, "d": {4}})
+    assert [[job["name"] for job in lane] for lane in lanes] == [["a", "b", "c"], ["d"]]
+
+
+def test_run_jobs(tmp_path):
+    """Test running several jobs in one process, then skipping them until they are due."""
+    for name in ("One", "Two"):
+        os.makedirs(tmp_path / name / "Source" / "Folder")
+        os.makedirs(tmp_path / name / "Target")
+        (tmp_path / name / "Source" / "Folder" / "file.txt").write_text(name)
+    config = write_config(tmp_path / "jobs.toml", f"""
+[defaults]
+schedule = "daily"
+
+[[job]]
+name = "one"
+source = "{tmp_path / 'One' / 'Source'}"
+target = "{tmp_path / 'One' / 'Target'}"
+
+[[job]]
+name = "two"
+source = "{tmp_path / 'Two' / 'Source'}"
+target = "{tmp_path / 'Two' / 'Target'}"
+incremental = true
+
+[[job]]
+name = "missing"
+source = "{tmp_path / 'Missing'}"
+target = "{tmp_path / 'One' / 'Target'}"
+""")
+    jobs, _ = load_jobs(config)
+    state_file = str(tmp_path / "jobs.state.json")
+
+    report = run_jobs(jobs, state_file)
+    assert report["jobs_completed"] == 2
+    assert report["jobs_failed"] == 1
+    assert report["files_transferred"] == 2
+    assert report["jobs"]["missing"]["error"] == "Source or target directory does not exist."
+    assert (tmp_path / "Two" / "Target" / "Folder" / "file.txt").read_text() == "Two"
+
+    # Only the failed job is due again.
+    with open(state_file, encoding="utf-8") as file:
+        state = json.load(file)
+    assert sorted(state) == ["one", "two"]
+    assert not is_due(jobs[0], state, state["one"] + 60)
+    assert is_due(jobs[0], state, state["one"] + 24 * 60 * 60)
+    report = run_jobs(jobs, state_file)
+    assert report["jobs_not_due"] == 2
+    assert report["jobs_failed"] == 1
@@ -1,27 +1,2248 @@
 #!/usr/bin/env python3
 """Module to backup a directory to a target location."""
+# pylint: disable=too-many-lines
 
 from pathlib import Path
 import os
 import shutil
 import logging
+import logging.handlers
+import queue
+import atexit
+import contextlib
+import signal
 import sys
-import glob
 import time
+import sqlite3
+import re
+import errno
+import stat
+import heapq
+import bisect
+import json
+import hashlib
+import fnmatch
+import zlib
+import mmap
+import threading
+import struct
+import tarfile
+import select
+import ctypes
+import ctypes.util
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 from datetime import datetime
-from alive_progress import alive_bar
+from typing import NamedTuple
 import click
 
-logging.basicConfig(
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    filename='backend_cronjob.log', level=logging.INFO
-)
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where reflinks are never attempted.
+    fcntl = None
 
-class Backup:
+FICLONE = 0x40049409  # ioctl request to reflink a whole file on btrfs, XFS and other CoW filesystems.
+
+
+BUFFERED_LOG_HANDLERS = []  # The handlers setup_logging() buffers records in, for flush_logs().
+
+
+def setup_logging(filename: str = "backend_cronjob.log", buffer_size: int = 1000, flush_interval: float = 5.0):
+    """Send log records through a queue to a listener thread that writes them in batches.
+
+    Logging a record only puts it on the queue, so the copy loop never waits on the log file.
+    The listener buffers up to buffer_size records, flushing straight away on errors. The
+    buffer is also written every flush_interval seconds, so a long-running watch does not
+    hold records back for hours, and whatever is left is written when the interpreter exits.
+    Like logging.basicConfig, nothing is changed if the root logger already has handlers. It
+    is called by the entry points rather than on import, so importing the module has no side
+    effects.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    file_handler = logging.FileHandler(filename, delay=True)
+    file_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    buffered_handler = logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.ERROR, target=file_handler)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, buffered_handler)
+
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    listener.start()
+    BUFFERED_LOG_HANDLERS.append(buffered_handler)
+
+    stopped = threading.Event()
+    def flush_periodically():
+        """Write the buffer out every flush_interval seconds until logging stops."""
+        while not stopped.wait(flush_interval):
+            buffered_handler.flush()
+    threading.Thread(target=flush_periodically, name="log-flush", daemon=True).start()
+
+    def stop():
+        stopped.set()
+        listener.stop()
+        buffered_handler.close()  # Flushes the buffered records to the file.
+        file_handler.close()
+    atexit.register(stop)
+    return listener
+
+
+def flush_logs():
+    """Write out the records buffered by setup_logging(), such as at the end of a backup."""
+    for handler in BUFFERED_LOG_HANDLERS:
+        handler.flush()
+
+
+class NoProgressBar:  # pylint: disable=too-few-public-methods
+    """Stands in for alive_bar when there is no terminal to draw the progress bar on."""
+
+    def __call__(self, count: int = 1):
+        """Ignore progress updates."""
+
+
+
+def database_path(path: str):
+    """A path as stored in SQLite: as text, or as its raw bytes if it is not valid UTF-8 (such as b"caf\\xe9.txt")."""
+    try:
+        path.encode("utf-8")
+    except UnicodeEncodeError:
+        return os.fsencode(path)
+    return path
+
+
+def database_path_str(value) -> str:
+    """A path stored by database_path(), back as a str."""
+    return value if isinstance(value, str) else os.fsdecode(value)
+
+
+class FileIndex:  # pylint: disable=too-many-instance-attributes
+    """Compact index of the entries in a tree, for trees too large to hold as Python objects.
+
+    Directories are interned once into a table of relative paths. Every entry is then a
+    slot in parallel arrays of parent directory id, size, mtime_ns and inode, with the
+    names packed into a single byte string, so an entry costs tens of bytes rather than
+    the few hundred of a path string and tuple in a dict. Full paths are derived from the
+    parent id when they are needed.
+
+    The entries of a directory must be added together, as they are by a directory at a
+    time walk or a query ordered by directory. They are sorted by name when the next
+    directory starts, so a lookup is a binary search over one directory's names.
+    """
+
+    def __init__(self):
+        """Create an empty index."""
+        self.directory_ids = {}  # Relative directory path -> id.
+        self.directories = []  # Id -> relative directory path.
+        self.starts = array("Q")  # Id -> first entry in the directory.
+        self.ends = array("Q")  # Id -> one past the last entry in the directory.
+        self.parents = array("I")
+        self.sizes = array("Q")
+        self.mtimes = array("q")
+        self.inodes = array("Q")
+        self.name_offsets = array("Q", [0])
+        self.names = bytearray()
+        self.current = None  # The directory whose entries are being added.
+        self.pending = []
+
+
+    def __len__(self) -> int:
+        """The number of entries added."""
+        return len(self.sizes) + len(self.pending)
+
+
+    def add(self, relative_path: str, size: int = 0, mtime_ns: int = 0, inode: int = 0):
+        """Add an entry, holding it until the rest of its directory has been added."""
+        directory, _, name = relative_path.rpartition("/")
+        if directory != self.current:
+            self.finish()
+            if directory in self.directory_ids:
+                raise ValueError(f"The entries of {directory!r} were not added together.")
+            self.current = directory
+        self.pending.append((os.fsencode(name), size, mtime_ns, inode))
+
+
+    def finish(self):
+        """Store the entries held for the current directory, sorted by name."""
+        if self.current is None:
+            return
+        directory_id = len(self.directories)
+        self.directory_ids[self.current] = directory_id
+        self.directories.append(self.current)
+        self.starts.append(len(self.sizes))
+
+        self.pending.sort()
+        for name, size, mtime_ns, inode in self.pending:
+            self.parents.append(directory_id)
+            self.sizes.append(size)
+            self.mtimes.append(mtime_ns)
+            self.inodes.append(inode)
+            self.names += name
+            self.name_offsets.append(len(self.names))
+        self.ends.append(len(self.sizes))
+        self.current = None
+        self.pending = []
+
+
+    def name(self, index: int) -> str:
+        """The name of an entry."""
+        return os.fsdecode(bytes(self.names[self.name_offsets[index]:self.name_offsets[index + 1]]))
+
+
+    def path(self, index: int) -> str:
+        """The relative path of an entry, derived from its parent directory."""
+        directory = self.directories[self.parents[index]]
+        return f"{directory}/{self.name(index)}" if directory else self.name(index)
+
+
+    def find(self, relative_path: str) -> int:
+        """The position of an entry in the arrays, or -1 if it is not in the index."""
+        directory, _, name = relative_path.rpartition("/")
+        directory_id = self.directory_ids.get(directory)
+        if directory_id is None:
+            return -1
+
+        name = os.fsencode(name)
+        names = self.names
+        offsets = self.name_offsets
+        low = self.starts[directory_id]
+        high = self.ends[directory_id]
+        while low < high:
+            middle = (low + high) // 2
+            candidate = names[offsets[middle]:offsets[middle + 1]]
+            if candidate < name:
+                low = middle + 1
+            elif candidate > name:
+                high = middle
+            else:
+                return middle
+        return -1
+
+
+    def __contains__(self, relative_path: str) -> bool:
+        """Whether the path has been added."""
+        return self.find(relative_path) >= 0
+
+
+    def get(self, relative_path: str) -> tuple:
+        """The (size, mtime_ns, inode) of an entry, or None if it is not in the index."""
+        index = self.find(relative_path)
+        if index < 0:
+            return None
+        return (self.sizes[index], self.mtimes[index], self.inodes[index])
+
+
+    def total_size(self) -> int:
+        """The total size of the entries."""
+        return sum(self.sizes)
+
+
+class Manifest:
+    """SQLite record of every source file that has been backed up to a target.
+
+    Each row holds the path relative to the source with the size, mtime_ns and inode the
+    file had when it was copied. The whole manifest is read into a FileIndex once, so
+    deciding whether a file is unchanged needs no target-side I/O. New rows are written in
+    batches.
+    """
+    FILENAME = ".automated_backup_manifest.sqlite"
+
+    def __init__(self, target: Path, batch_size: int = 1000, track_updates: bool = False):
+        """Open (or create) the manifest stored in the target directory.
+
+        Args:
+            target (Path): The target directory.
+            batch_size (int): Number of rows to queue before writing them.
+            track_updates (bool): Keep the rows recorded since opening in memory too, so a
+                manifest that stays open across backups, as in watch(), sees its own updates.
+        """
+        self.path = Path(target) / self.FILENAME
+        self.batch_size = batch_size
+        self.pending = []
+        self.updates = {} if track_updates else None  # Relative path -> signature, as the index is read-only.
+        self.forgotten = set()  # Paths removed from the manifest since it was read, when tracking updates.
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER"
+            ") WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS throughput (name TEXT PRIMARY KEY, value REAL) WITHOUT ROWID")
+        # Paths that are not valid UTF-8 are stored as bytes, which are added with the rest of their directory.
+        undecodable = {}
+        for path, *signature in self.connection.execute("SELECT * FROM files WHERE typeof(path) = 'blob'"):
+            path = database_path_str(path)
+            undecodable.setdefault(path.rpartition("/")[0], []).append((path, *signature))
+        # rtrim(path, replace(path, "/", "")) is the directory part of the path, so the rows
+        # of each directory come out together, as the index needs them.
+        self.records = FileIndex()
+        for row in self.connection.execute(
+            "SELECT * FROM files WHERE typeof(path) = 'text' ORDER BY rtrim(path, replace(path, '/', '')), path"
+        ):
+            for extra in undecodable.pop(row[0].rpartition("/")[0], ()):
+                self.records.add(*extra)
+            self.records.add(*row)
+        for rows in undecodable.values():
+            for extra in rows:
+                self.records.add(*extra)
+        self.records.finish()
+
+
+    @classmethod
+    def matching(cls, target: Path, pattern: str) -> list:
+        """The recorded paths matching a glob pattern, or None if the target has no manifest.
+
+        Only the rows starting with the pattern's literal prefix are read, found with the
+        primary key, so the manifest is not loaded as a whole.
+        """
+        path = Path(target) / cls.FILENAME
+        if not path.exists():
+            return None
+        prefix = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+        connection = sqlite3.connect(path)
+        try:
+            rows = connection.execute(
+                "SELECT path FROM files WHERE (path >= ? AND path < ?) OR typeof(path) = 'blob'", (prefix, prefix + "\U0010ffff")
+            )
+            relative_paths = (database_path_str(relative_path) for (relative_path,) in rows)
+            return [relative_path for relative_path in relative_paths if fnmatch.fnmatchcase(relative_path, pattern)]
+        finally:
+            connection.close()
+
+
+    @staticmethod
+    def signature(entry: os.DirEntry) -> tuple:
+        """The (size, mtime_ns, inode) used to decide whether a file has changed."""
+        entry_stat = entry.stat()
+        return (entry_stat.st_size, entry_stat.st_mtime_ns, entry.inode())
+
+
+    def unchanged(self, relative_path: str, entry: os.DirEntry) -> bool:
+        """Whether the file matches the record from the last time it was backed up."""
+        recorded = self.updates.get(relative_path) if self.updates is not None else None
+        if recorded is None:
+            parts = relative_path.split("/")
+            if any("/".join(parts[:end]) in self.forgotten for end in range(1, len(parts) + 1)):
+                return False
+            recorded = self.records.get(relative_path)
+        return recorded == self.signature(entry)
+
+
+    def record(self, relative_path: str, signature: tuple):
+        """Queue a successfully copied file with its (size, mtime_ns, inode), writing the queue once a batch is full."""
+        self.pending.append((database_path(relative_path), *signature))
+        if self.updates is not None:
+            self.updates[relative_path] = tuple(signature)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """Write all queued rows in a single transaction."""
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+
+    @staticmethod
+    def delete_rows(connection: sqlite3.Connection, relative_paths: list):
+        """Delete the rows of the given paths, and of everything beneath those that are directories."""
+        rows = []
+        for relative_path in relative_paths:
+            rows.append((database_path(relative_path), relative_path + "/", relative_path + "0"))  # "0" follows "/".
+            encoded = os.fsencode(relative_path)
+            rows.append((encoded, encoded + b"/", encoded + b"0"))
+        with connection:
+            connection.executemany("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", rows)
+
+
+    def forget(self, relative_paths: list):
+        """Remove paths that are about to be deleted from the target, so they are copied again if they come back."""
+        self.flush()
+        self.delete_rows(self.connection, relative_paths)
+        if self.updates is not None:
+            for relative_path in relative_paths:
+                self.forgotten.add(relative_path)
+                for updated in [path for path in self.updates if path == relative_path or path.startswith(relative_path + "/")]:
+                    del self.updates[updated]
+
+
+    @classmethod
+    def forget_paths(cls, target: Path, relative_paths: list):
+        """As forget(), for a target whose manifest is not open. Does nothing if it has none."""
+        path = Path(target) / cls.FILENAME
+        if not path.exists():
+            return
+        connection = sqlite3.connect(path)
+        try:
+            cls.delete_rows(connection, relative_paths)
+        finally:
+            connection.close()
+
+
+    def throughput(self) -> dict:
+        """The bytes and files per second of the last run, or None before the first."""
+        rates = dict(self.connection.execute("SELECT name, value FROM throughput"))
+        return rates or None
+
+
+    def record_throughput(self, size: int, files: int, seconds: float):
+        """Save the rates of a finished run, for estimating how long the next will take."""
+        if not files or seconds <= 0:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO throughput VALUES (?, ?)",
+                [("bytes_per_second", size / seconds), ("files_per_second", files / seconds)]
+            )
+
+
+    def total_size(self) -> int:
+        """The total size of the files recorded, used as an estimate of the size of the source."""
+        return self.records.total_size()
+
+
+    def close(self):
+        """Flush any queued rows and close the database."""
+        self.flush()
+        self.connection.close()
+
+
+class TargetIndex:
+    """In-memory snapshot of the target, built with one os.scandir per directory.
+
+    Existence and conflict checks are answered from memory, so the number of stat round
+    trips to the target grows with the number of directories rather than files. Names are
+    added as files are written so later decisions in the same run see them.
+    """
+    DUPLICATE_NAME = re.compile(r"^(?P<stem>.*) \((?P<number>\d+)\)(?P<suffix>\.[^.]*)?$")
+
+    def __init__(self, max_directories: int = 64):
+        """Create an empty index holding at most max_directories listings at once."""
+        self.max_directories = max_directories
+        self.directories = {}  # Directory path -> {name: DirEntry or (size, mtime_ns)}.
+        self.duplicates = {}  # Directory path -> {(stem, suffix): highest duplicate number}.
+
+
+    def listing(self, directory: str) -> dict:
+        """The names in a target directory, scanning it the first time it is asked for."""
+        names = self.directories.get(directory)
+        if names is not None:
+            return names
+
+        # The source is walked one directory at a time, so old listings are not needed again.
+        if len(self.directories) >= self.max_directories:
+            oldest = next(iter(self.directories))
+            del self.directories[oldest]
+            self.duplicates.pop(oldest, None)
+
+        try:
+            with os.scandir(directory) as entries:
+                names = {entry.name: entry for entry in entries}
+        except FileNotFoundError:
+            names = {}
+        self.directories[directory] = names
+        return names
+
+
+    def created(self, directory: str):
+        """Record a directory that has just been made, so it is known to be empty."""
+        self.listing(os.path.dirname(directory))[os.path.basename(directory)] = (0, time.time_ns())
+        self.directories[directory] = {}
+
+
+    def exists(self, path: str) -> bool:
+        """Whether the path exists in the target."""
+        return os.path.basename(path) in self.listing(os.path.dirname(path))
+
+
+    def stat(self, path: str) -> tuple:
+        """The (size, mtime_ns) of a path in the target, or None if it does not exist."""
+        name = os.path.basename(path)
+        names = self.listing(os.path.dirname(path))
+        info = names.get(name)
+        if isinstance(info, os.DirEntry):
+            entry_stat = info.stat()
+            info = names[name] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+        return info
+
+
+    def add(self, path: str, size: int):
+        """Record a file that is being written to the target."""
+        directory, name = os.path.split(path)
+        self.listing(directory)[name] = (size, time.time_ns())
+
+        counters = self.duplicates.get(directory)
+        if counters is not None:
+            self.count_duplicate(counters, name)
+
+
+    @classmethod
+    def count_duplicate(cls, counters: dict, name: str):
+        """Raise the counter for the file that name is a "(n)" duplicate of, if it is one."""
+        match = cls.DUPLICATE_NAME.match(name)
+        if match is None:
+            return
+        key = (match["stem"], match["suffix"] or "")
+        counters[key] = max(counters.get(key, 0), int(match["number"]))
+
+
+    def next_duplicate(self, path: str) -> str:
+        """The next free "name (n).ext" path for a file that already exists in the target.
+
+        The counters for a directory are built by parsing its listing once, so finding the
+        next number is a lookup instead of probing "(1)", "(2)", ... in turn. Only the final
+        suffix is split off, and names without one become "name (n)".
+        """
+        directory, name = os.path.split(path)
+        counters = self.duplicates.get(directory)
+        if counters is None:
+            counters = self.duplicates[directory] = {}
+            for existing in self.listing(directory):
+                self.count_duplicate(counters, existing)
+
+        stem, suffix = os.path.splitext(name)
+        number = counters.get((stem, suffix), 0) + 1
+        return f"{directory}/{stem} ({number}){suffix}"
+
+
+def partial_path(destination: str) -> str:
+    """The temporary file a copy is written to before being renamed, so the target never holds a half-written file."""
+    directory, name = os.path.split(destination)
+    return f"{directory}/.{name}.backup-partial"
+
+
+def remove_partials(directory: Path) -> list:
+    """Deletes the partial files left anywhere under directory by copies that were cut short.
+
+    Args:
+        directory (Path): The directory to search, such as the target.
+
+    Returns:
+        list: The paths of the partial files that were removed.
+    """
+    removed = []
+    pending = [str(directory)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.startswith(".") and entry.name.endswith(".backup-partial"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+                        removed.append(entry.path)
+    return removed
+
+
+class FileCopier:
+    """Copies files with the fastest strategy the source and target filesystems support.
+
+    Strategies are tried in the order of STRATEGIES. The first one that works for a pair
+    of filesystems is cached, so later files between them go straight to it. Each strategy
+    copies size bytes from the current offset of the source to the same offset in the
+    target, so sparse files are copied one data extent at a time and keep their holes.
+    """
+    STRATEGIES = ("reflink", "copy_file_range", "sendfile", "userspace")
+    # Errors meaning the strategy is not supported here, rather than that the copy failed.
+    UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM}
+    # Of those, the errors that hold for every file between the two filesystems. Any other
+    # one, such as EINVAL for a special file, only moves this file on to the next strategy.
+    DEMOTE = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOSYS}
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self):
+        """Create a copier with nothing cached."""
+        self.selected = {}  # (source st_dev, target st_dev) -> index into STRATEGIES.
+
+
+    # pylint: disable=too-many-locals
+    def copy(self, file: str, destination: str, preserve_times: bool = False) -> tuple:
+        """Copy the contents and permission bits of file to destination.
+
+        Args:
+            file (str): Path of the file to copy.
+            destination (str): Path to write the copy to.
+            preserve_times (bool): Also give the copy the access and modification times of file.
+
+        Returns:
+            tuple: The name of the strategy that was used, and the bytes the copy takes up on disk.
+        """
+        with open(file, "rb") as source, open(destination, "wb") as target:
+            source_stat = os.fstat(source.fileno())
+            key = (source_stat.st_dev, os.fstat(target.fileno()).st_dev)
+            strategy = first = self.selected.get(key, 0)
+            # Fewer blocks than the size needs means the file has holes.
+            sparse = source_stat.st_blocks * 512 < source_stat.st_size
+            extents = self.data_extents(source.fileno(), source_stat.st_size) if sparse else [(0, source_stat.st_size)]
+
+            while True:
+                name = self.STRATEGIES[strategy]
+                try:
+                    if name == "reflink":
+                        self.reflink(source.fileno(), target.fileno(), source_stat.st_size)
+                    else:
+                        for offset, length in extents:
+                            os.lseek(source.fileno(), offset, os.SEEK_SET)
+                            os.lseek(target.fileno(), offset, os.SEEK_SET)
+                            getattr(self, name)(source.fileno(), target.fileno(), length)
+                        if sparse:
+                            os.ftruncate(target.fileno(), source_stat.st_size)  # Any hole at the end.
+                    break
+                except OSError as error:
+                    if name == "userspace" or error.errno not in self.UNSUPPORTED:
+                        raise
+                    strategy = strategy + 1
+                    if error.errno in self.DEMOTE:
+                        self.selected[key] = strategy
+                    # Start again from the beginning of both files.
+                    os.ftruncate(target.fileno(), 0)
+                    os.lseek(source.fileno(), 0, os.SEEK_SET)
+                    os.lseek(target.fileno(), 0, os.SEEK_SET)
+
+            if strategy == first:
+                self.selected.setdefault(key, strategy)
+            os.fchmod(target.fileno(), stat.S_IMODE(source_stat.st_mode))
+            if preserve_times:
+                os.utime(target.fileno(), ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            allocated = os.fstat(target.fileno()).st_blocks * 512
+        return name, allocated
+
+
+    @staticmethod
+    def data_extents(fd: int, size: int) -> list:
+        """The (offset, length) of each range of a file holding data, found with SEEK_DATA and SEEK_HOLE.
+
+        If the filesystem cannot report holes, the whole file is one extent.
+        """
+        extents = []
+        offset = 0
+        try:
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                except OSError as error:
+                    if error.errno == errno.ENXIO:
+                        break  # Only a hole is left.
+                    raise
+                offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                extents.append((start, offset - start))
+        except (OSError, AttributeError):
+            return [(0, size)]
+        return extents
+
+
+    @staticmethod
+    def reflink(source_fd: int, target_fd: int, size: int):
+        """Share the source's extents with the target, copying no data."""
+        del size
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, "Reflinks are not supported on this platform.")
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+    @staticmethod
+    def copy_file_range(source_fd: int, target_fd: int, size: int):
+        """Copy inside the kernel, letting the filesystem offload it where it can."""
+        if not hasattr(os, "copy_file_range"):
+            raise OSError(errno.ENOSYS, "copy_file_range is not available.")
+        copied = 0
+        while copied < size:
+            sent = os.copy_file_range(source_fd, target_fd, size - copied)
+            if sent == 0:
+                # Some filesystems report success without copying anything.
+                raise OSError(errno.EINVAL, "copy_file_range copied no data.")
+            copied = copied + sent
+
+
+    @staticmethod
+    def sendfile(source_fd: int, target_fd: int, size: int):
+        """Copy inside the kernel without passing the data through userspace."""
+        copied = 0
+        while copied < size:
+            sent = os.sendfile(target_fd, source_fd, None, size - copied)
+            if sent == 0:
+                break
+            copied = copied + sent
+        if copied != size:
+            # The source ended early, most likely because it shrank while being copied.
+            raise OSError(errno.EIO, f"sendfile copied {copied} of {size} bytes.")
+
+
+    def userspace(self, source_fd: int, target_fd: int, size: int):
+        """Plain read and write loop through a reused buffer."""
+        buffer = bytearray(self.BUFFER_SIZE)
+        view = memoryview(buffer)
+        while size > 0:
+            read = os.readv(source_fd, [view[:min(size, self.BUFFER_SIZE)]])
+            if read == 0:
+                break
+            size = size - read
+            written = 0
+            while written < read:
+                written = written + os.write(target_fd, view[written:read])
+
+
+class IgnoreRules:
+    """Compiled ignore rules for the source tree.
+
+    Exact files and directories are normalised to absolute paths once and kept in sets, and
+    extensions in a set, so each check is a single lookup. Gitignore-style patterns such as
+    "*.tmp", "**/node_modules" or "/build/" are compiled into combined regular expressions:
+    patterns without a "/" match the name at any depth, others match the path relative to
+    the source, and a trailing "/" only matches directories. As in gitignore, a pattern
+    starting with "!" re-includes what earlier patterns ignored, and the last pattern that
+    matches decides. Runs of patterns with the same sign share one combined expression.
+    """
+    FILENAME = ".backupignore"
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self,
+            source: Path,
+            ignored_ext: list = (),
+            ignored_files: list = (),
+            ignored_directories: list = (),
+            patterns: list = ()
+        ):
+        """Compile the rules for the given source directory."""
+        self.source = self.normalise(source)
+        self.extensions = {ext if ext.startswith(".") else f".{ext}" for ext in ignored_ext}
+        self.files = {self.normalise(file) for file in ignored_files}
+        self.directories = {self.normalise(directory) for directory in ignored_directories}
+
+        # (negated, name patterns, path patterns) for each run of patterns with the same sign, in
+        # file order. The pattern lists are keyed by whether the pattern is for directories only.
+        groups = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith("\\!"):
+                pattern = pattern[1:]  # An escaped "!" at the start is part of the name.
+            if not groups or groups[-1][0] != negated:
+                groups.append((negated, {False: [], True: []}, {False: [], True: []}))
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                groups[-1][2][directory_only].append(self.translate(pattern.lstrip("/")))
+            else:
+                groups[-1][1][directory_only].append(self.translate(pattern))
+
+        # Checked from the last run back, as later patterns override earlier ones.
+        self.pattern_groups = [
+            (
+                negated,
+                {key: self.combine(value) for key, value in name_patterns.items()},
+                {key: self.combine(value) for key, value in path_patterns.items()},
+            )
+            for negated, name_patterns, path_patterns in reversed(groups)
+        ]
+
+
+    @staticmethod
+    def normalise(path) -> str:
+        """An absolute path without "~", "." or trailing "/" so differently spelled paths match."""
+        return os.path.abspath(os.path.expanduser(path))
+
+
+    @staticmethod
+    def read_patterns(path: Path) -> list:
+        """The lines of an ignore file, or an empty list if it does not exist."""
+        try:
+            with open(path, encoding="utf-8") as file:
+                return file.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+
+    @staticmethod
+    def translate(pattern: str) -> str:
+        """Convert one glob pattern to a regular expression."""
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex = regex + "(?:.*/)?"
+                i = i + 3
+            elif pattern.startswith("**", i):
+                regex = regex + ".*"
+                i = i + 2
+            elif pattern[i] == "*":
+                regex = regex + "[^/]*"
+                i = i + 1
+            elif pattern[i] == "?":
+                regex = regex + "[^/]"
+                i = i + 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                characters = pattern[i + 1:end]
+                if characters.startswith("!"):
+                    characters = "^" + characters[1:]
+                regex = regex + "[" + characters.replace("\\", "\\\\") + "]"
+                i = end + 1
+            else:
+                regex = regex + re.escape(pattern[i])
+                i = i + 1
+        return regex
+
+
+    @staticmethod
+    def combine(regexes: list):
+        """Join regular expressions into one matcher, or None if there are none."""
+        if not regexes:
+            return None
+        return re.compile("(?:" + "|".join(regexes) + ")").fullmatch
+
+
+    def match(self, relative_path: str, name: str, is_dir: bool) -> str:
+        """Checks whether an item in the source is ignored.
+
+        Args:
+            relative_path (str): Path of the item relative to the source.
+            name (str): The last component of the path.
+            is_dir (bool): Whether the item is a directory.
+
+        Returns:
+            str: The reason it is ignored ("directory", "file", "ext" or "pattern"), or None.
+        """
+        if is_dir:
+            if self.directories and f"{self.source}/{relative_path}" in self.directories:
+                return "directory"
+        else:
+            if self.files and f"{self.source}/{relative_path}" in self.files:
+                return "file"
+            if self.extensions and os.path.splitext(name)[1] in self.extensions:
+                return "ext"
+
+        for negated, name_patterns, path_patterns in self.pattern_groups:
+            for directory_only in (False, True) if is_dir else (False,):
+                name_matches = name_patterns[directory_only]
+                path_matches = path_patterns[directory_only]
+                if (name_matches is not None and name_matches(name)) or (path_matches is not None and path_matches(relative_path)):
+                    return None if negated else "pattern"
+        return None
+
+
+class Journal:
+    """Append-only record of the files copied by the current run, kept in the target.
+
+    Completed copies are written in batches. The journal is removed when a run finishes,
+    so if one is found the previous run was interrupted, and a resumed run can skip every
+    file it lists instead of starting again from zero.
+    """
+    FILENAME = ".automated_backup_journal"
+
+    def __init__(self, target: Path, resume: bool = False, batch_size: int = 500):
+        """Open the journal, keeping the files already listed in it if resuming."""
+        self.path = Path(target) / self.FILENAME
+        self.batch_size = batch_size
+        self.pending = []
+        self.file = open(self.path, "a" if resume else "w", encoding="utf-8")  # pylint: disable=consider-using-with
+
+
+    @classmethod
+    def read(cls, target: Path) -> set:
+        """The files listed in the journal in the target, if there is one."""
+        completed = set()
+        try:
+            with open(Path(target) / cls.FILENAME, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        completed.add(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # A line cut short when the run was interrupted.
+        except FileNotFoundError:
+            pass
+        return completed
+
+
+    def record(self, relative_path: str):
+        """Queue a finished copy, writing the queue once a batch is full."""
+        self.pending.append(relative_path)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+
+    def flush(self):
+        """Write the queued copies and make sure they reach the disk."""
+        if not self.pending or self.file.closed:
+            return
+        self.file.write("".join(json.dumps(path) + "\n" for path in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+
+    def close(self):
+        """Flush and close the journal, leaving it in place to resume from."""
+        self.flush()
+        self.file.close()
+
+
+    def finish(self):
+        """Remove the journal once the run has completed."""
+        self.pending = []
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class Snapshots:
+    """Dated snapshot directories inside the target, each a full point-in-time copy.
+
+    Files that have not changed since the previous snapshot are hardlinked to it rather
+    than copied, so a snapshot costs space and time in proportion to what changed.
+    """
+    NAME_FORMAT = "%Y-%m-%d_%H%M%S"
+    NAME = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{6}(_\d{2})?$")  # With a counter if two are made in one second.
+
+    def __init__(self, target: Path):
+        """Find the snapshots already in the target."""
+        self.target = Path(target)
+        with os.scandir(self.target) as entries:
+            self.names = sorted(
+                entry.name for entry in entries if entry.is_dir() and self.NAME.match(entry.name)
+            )
+
+
+    def latest(self) -> Path:
+        """The newest snapshot, or None if there are none."""
+        return self.target / self.names[-1] if self.names else None
+
+
+    def create(self) -> Path:
+        """Make the directory for a new snapshot named after the current time."""
+        name = datetime.now().strftime(self.NAME_FORMAT)
+        number = 0
+        while True:
+            try:
+                os.mkdir(self.target / name)
+                break
+            except FileExistsError:
+                number = number + 1
+                name = f"{name[:17]}_{number:02d}"
+        self.names.append(name)
+        return self.target / name
+
+
+    def expired(self, keep_daily: int, keep_weekly: int) -> list:
+        """The snapshots outside the retention policy.
+
+        The newest snapshot of each of the last keep_daily days, and of each of the last
+        keep_weekly weeks, is kept. The newest snapshot overall is always kept.
+        """
+        keep = set(self.names[-1:])
+        days = {}
+        weeks = {}
+        for name in reversed(self.names):
+            taken = datetime.strptime(name[:17], self.NAME_FORMAT)
+            days.setdefault(taken.date(), name)
+            weeks.setdefault(taken.isocalendar()[:2], name)
+        keep.update(list(days.values())[:keep_daily])
+        keep.update(list(weeks.values())[:keep_weekly])
+        return [self.target / name for name in self.names if name not in keep]
+
+
+    def prune(self, keep_daily: int, keep_weekly: int, workers: int = 4) -> list:
+        """Delete the expired snapshots in parallel, returning their paths."""
+        expired = self.expired(keep_daily, keep_weekly)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(shutil.rmtree, expired))
+        self.names = [name for name in self.names if self.target / name not in expired]
+        return expired
+
+
+# Gear table for the content-defined chunker: one fixed pseudo-random 32-bit value per byte.
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([byte]), digest_size=4).digest(), "little") for byte in range(256)]
+GEAR_WINDOW = 32  # Bytes the gear hash depends on, as each is shifted out of its 32 bits after that.
+
+
+def gear_boundaries(data: bytes, mask: int, segment: int = 64 * 1024) -> list:
+    """The positions in data where the gear hash of the GEAR_WINDOW bytes ending there has none of mask's bits set.
+
+    Worked out for every position of a segment at once with numpy, in five passes that each
+    double the number of bytes the hashes cover. Segments are small enough to stay in the
+    CPU cache. The first GEAR_WINDOW - 1 positions, which have no full window, are left out.
+
+    Returns:
+        list: The positions in order, or None if numpy is not installed.
+    """
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:  # Optional, chunk_file() hashes a byte at a time without it.
+        return None
+    table = numpy.array(GEAR, dtype=numpy.uint32)
+    codes = numpy.frombuffer(data, dtype=numpy.uint8)
+    positions = []
+    for begin in range(0, len(data) - GEAR_WINDOW + 1, segment):
+        hashes = table[codes[begin:begin + segment + GEAR_WINDOW - 1]]
+        width = 1
+        while width < GEAR_WINDOW:
+            hashes[width:] += hashes[:-width] << width  # Wraps at 32 bits, as the rolling hash does.
+            width = width * 2
+        matches = (hashes[GEAR_WINDOW - 1:] & numpy.uint32(mask)) == 0
+        positions.extend((numpy.flatnonzero(matches) + (begin + GEAR_WINDOW - 1)).tolist())
+    return positions
+
+
+def chunk_file(path: str, min_size: int, average_bits: int, max_size: int, read_size: int = 4 * 1024 * 1024) -> list:  # pylint: disable=too-many-locals
+    """Split a file into content-defined chunks with a gear rolling hash.
+
+    A chunk ends where the top average_bits bits of the hash are all zero, so boundaries
+    move with the content and an insertion only changes the chunks around it. The first
+    min_size bytes of each chunk are skipped, and no chunk is longer than max_size.
+    Run in a worker process, as it touches every byte.
+
+    With numpy installed, the places a chunk could end are found for each read at once by
+    gear_boundaries(), leaving only the first GEAR_WINDOW bytes after min_size to hash in
+    Python. Without it every byte is hashed in Python, at around 5 MB/s per core.
+
+    Returns:
+        list: (digest, length) of each chunk in order, the digest being a 16 byte blake2b.
+    """
+    mask = ((1 << average_bits) - 1) << (32 - average_bits)
+    chunks = []
+    boundaries = []  # File offsets from gear_boundaries(), or None without numpy.
+    offset = 0  # File offset of the start of the buffer.
+    with open(path, "rb") as file:
+        buffer = b""
+        finished = False
+        while not finished:
+            data = file.read(read_size)
+            finished = not data
+            context = min(len(buffer), GEAR_WINDOW - 1)  # Bytes kept from the last read that end windows in this one.
+            buffer = buffer + data
+            if data and boundaries is not None:
+                found = gear_boundaries(buffer[len(buffer) - len(data) - context:], mask)
+                if found is None:
+                    boundaries = None
+                else:
+                    base = offset + len(buffer) - len(data) - context
+                    boundaries.extend(base + position for position in found)
+            start = 0
+            while start < len(buffer):
+                if not finished and len(buffer) - start < max_size:
+                    break  # Not enough data to be sure where this chunk ends yet.
+                end = min(start + max_size, len(buffer))
+                cut = end
+                rolling = 0
+                # Past the first GEAR_WINDOW bytes, the rolling hash is the hash gear_boundaries() worked out.
+                scan_end = end if boundaries is None else min(start + min_size + GEAR_WINDOW - 1, end)
+                for position in range(start + min_size, scan_end):
+                    rolling = ((rolling << 1) + GEAR[buffer[position]]) & 0xFFFFFFFF
+                    if not rolling & mask:
+                        cut = position + 1
+                        break
+                else:
+                    if boundaries is not None:
+                        index = bisect.bisect_left(boundaries, offset + scan_end)
+                        if index < len(boundaries) and boundaries[index] < offset + end:
+                            cut = boundaries[index] - offset + 1
+                chunks.append((hashlib.blake2b(buffer[start:cut], digest_size=16).digest(), cut - start))
+                start = cut
+            buffer = buffer[start:]
+            offset = offset + start
+            if boundaries:
+                del boundaries[:bisect.bisect_left(boundaries, offset)]
+    return chunks
+
+
+class ChunkStore:
+    """Deduplicating target format: content-addressed chunks plus a recipe for each file.
+
+    Chunks live in "chunks/<first 2 hex digits>/<hex digest>" inside the target and are
+    only written once, however many files contain them. Recipes, the ordered list of chunk
+    digests making up each file, are kept compactly in an SQLite database alongside.
+    """
+    DATABASE = "store.sqlite"
+    DIGEST_SIZE = 16
+
+    def __init__(self, target: Path):
+        """Open (or create) the store in the target directory."""
+        self.target = Path(target)
+        os.makedirs(self.target / "chunks", exist_ok=True)
+        self.connection = sqlite3.connect(self.target / self.DATABASE, check_same_thread=False)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, size INTEGER) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS recipes ("
+            "path TEXT PRIMARY KEY, size INTEGER, mode INTEGER, mtime_ns INTEGER, chunks BLOB"
+            ") WITHOUT ROWID;"
+        )
+        self.chunks = {digest for (digest,) in self.connection.execute("SELECT digest FROM chunks")}
+        self.writing = set()  # Digests claimed by new_chunks() that are not yet written.
+        self.files = {
+            database_path_str(path): (size, mtime_ns)
+            for path, size, mtime_ns in self.connection.execute("SELECT path, size, mtime_ns FROM recipes")
+        }
+
+
+    def chunk_path(self, digest: bytes) -> Path:
+        """Where a chunk is stored."""
+        name = digest.hex()
+        return self.target / "chunks" / name[:2] / name
+
+
+    def unchanged(self, relative_path: str, entry: os.DirEntry) -> bool:
+        """Whether the stored recipe is for the file as it is now, so it need not be chunked."""
+        source_stat = entry.stat()
+        return self.files.get(relative_path) == (source_stat.st_size, source_stat.st_mtime_ns)
+
+
+    def new_chunks(self, chunks: list) -> list:
+        """The (offset, digest, length) of chunks not yet stored, claiming them so they are written once."""
+        new = []
+        offset = 0
+        for digest, length in chunks:
+            if digest not in self.chunks:
+                self.chunks.add(digest)
+                self.writing.add(digest)
+                new.append((offset, digest, length))
+            offset = offset + length
+        return new
+
+
+    def written(self, new: list):
+        """Mark the chunks claimed for a file as stored, once write_chunks() has succeeded."""
+        self.writing.difference_update(digest for _, digest, _ in new)
+
+
+    def release(self, new: list):
+        """Give up the claim on chunks whose write failed, so another file writes them instead."""
+        for _, digest, _ in new:
+            self.chunks.discard(digest)
+            self.writing.discard(digest)
+
+
+    def complete(self, chunks: list) -> bool:
+        """Whether every chunk of a file is stored, rather than still being written for another file."""
+        return not any(digest in self.writing for digest, _ in chunks)
+
+
+    def write_chunks(self, file: str, new: list) -> int:
+        """Copy the given ranges of file into the store, returning the bytes written. Run by the thread pool."""
+        written = 0
+        with open(file, "rb") as source:
+            for offset, digest, length in new:
+                path = self.chunk_path(digest)
+                os.makedirs(path.parent, exist_ok=True)
+                temporary_path = f"{path}.partial"
+                with open(temporary_path, "wb") as chunk:
+                    chunk.write(os.pread(source.fileno(), length, offset))
+                os.replace(temporary_path, path)
+                written = written + length
+        return written
+
+
+    def add(self, relative_path: str, entry: os.DirEntry, chunks: list, new: list):
+        """Record the recipe of a file whose new chunks have been written."""
+        source_stat = entry.stat()
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?)", [(digest, length) for _, digest, length in new])
+            self.connection.execute(
+                "INSERT OR REPLACE INTO recipes VALUES (?, ?, ?, ?, ?)",
+                (database_path(relative_path), source_stat.st_size, stat.S_IMODE(source_stat.st_mode), source_stat.st_mtime_ns,
+                 b"".join(digest for digest, _ in chunks))
+            )
+        self.files[relative_path] = (source_stat.st_size, source_stat.st_mtime_ns)
+
+
+    # pylint: disable=too-many-arguments
+    def restore_file(self, path: str, size: int, mode: int, mtime_ns: int, recipe: bytes, destination: Path):
+        """Rebuild one file from its chunks."""
+        os.makedirs(destination.parent, exist_ok=True)
+        with open(destination, "wb") as file:
+            for start in range(0, len(recipe), self.DIGEST_SIZE):
+                with open(self.chunk_path(recipe[start:start + self.DIGEST_SIZE]), "rb") as chunk:
+                    shutil.copyfileobj(chunk, file)
+            if file.tell() != size:
+                raise OSError(f"{path} restored as {file.tell()} bytes instead of {size}.")
+        os.chmod(destination, mode)
+        os.utime(destination, ns=(mtime_ns, mtime_ns))
+
+
+    def restore(self, destination: Path, pattern: str = "*", workers: int = 4) -> int:
+        """Rebuild the files matching a glob pattern into destination, returning how many."""
+        recipes = []
+        for path, *row in self.connection.execute("SELECT * FROM recipes"):
+            path = database_path_str(path)
+            if fnmatch.fnmatchcase(path, pattern):
+                recipes.append((path, *row))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda row: self.restore_file(*row, Path(destination) / row[0]), recipes))
+        return len(recipes)
+
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+
+class DeltaTransfer:
+    """rsync-style delta copy of large files that already exist in the target.
+
+    The old target file is described by a signature per block: a weak adler32 checksum
+    and a strong blake2b hash. The source is scanned for those blocks with a rolling
+    adler32, so matches are found at any offset, not just where they were before. The new
+    file is then built in a temporary file from the matched ranges of the old one (with
+    copy_file_range, which network filesystems can do on the server) and the changed bytes
+    from the source, and renamed into place.
+
+    Signatures of every file written this way are cached in the target, so next time the
+    old file does not have to be read back to work them out.
+    """
+    DATABASE = ".automated_backup_signatures.sqlite"
+    MODULUS = 65521  # adler32's modulus.
+
+    def __init__(self, target: Path, block_size: int = 64 * 1024):
+        """Open the signature cache in the target."""
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(Path(target) / self.DATABASE, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, block_size INTEGER, signatures BLOB"
+            ") WITHOUT ROWID"
+        )
+
+
+    def signatures(self, path: str) -> bytes:
+        """The weak (4 bytes) and strong (16 bytes) checksum of each full block of a file."""
+        signatures = bytearray()
+        with open(path, "rb") as file:
+            while True:
+                block = file.read(self.block_size)
+                if len(block) < self.block_size:
+                    break
+                signatures += zlib.adler32(block).to_bytes(4, "little")
+                signatures += hashlib.blake2b(block, digest_size=16).digest()
+        return bytes(signatures)
+
+
+    def cached_signatures(self, path: str, target_stat: os.stat_result) -> bytes:
+        """The signatures of a target file, from the cache if the file has not changed since."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, block_size, signatures FROM signatures WHERE path = ?", (database_path(path),)
+            ).fetchone()
+        if row is not None and row[:3] == (target_stat.st_size, target_stat.st_mtime_ns, self.block_size):
+            return row[3]
+        return self.signatures(path)
+
+
+    def store_signatures(self, path: str, signatures: bytes):
+        """Cache the signatures of a file that has just been written."""
+        target_stat = os.stat(path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)",
+                (database_path(path), target_stat.st_size, target_stat.st_mtime_ns, self.block_size, signatures)
+            )
+
+
+    # pylint: disable=too-many-locals
+    def operations(self, source: mmap.mmap, signatures: bytes) -> list:
+        """The ("copy", old_offset, length) and ("data", source_offset, length) steps that build the new file."""
+        blocks = {}  # Weak checksum -> {strong hash: offset in the old file}.
+        for index in range(0, len(signatures), 20):
+            weak = int.from_bytes(signatures[index:index + 4], "little")
+            blocks.setdefault(weak, {}).setdefault(signatures[index + 4:index + 20], index // 20 * self.block_size)
+
+        size = self.block_size
+        operations = []
+
+        def add(kind: str, offset: int, length: int):
+            # Merges contiguous steps so there are as few copies and writes as possible.
+            if operations and operations[-1][0] == kind and operations[-1][1] + operations[-1][2] == offset:
+                operations[-1] = (kind, operations[-1][1], operations[-1][2] + length)
+            else:
+                operations.append((kind, offset, length))
+
+        def match(weak: int, position: int) -> int:
+            candidates = blocks.get(weak)
+            if candidates is None:
+                return None
+            return candidates.get(hashlib.blake2b(source[position:position + size], digest_size=16).digest())
+
+        position = 0
+        while position + size <= len(source):
+            weak = zlib.adler32(source[position:position + size])
+            old_offset = match(weak, position)
+            if old_offset is not None:
+                add("copy", old_offset, size)
+                position = position + size
+                continue
+
+            # Roll the checksum forward a byte at a time, looking for a block that has moved.
+            low, high = weak & 0xFFFF, weak >> 16
+            start = position
+            limit = min(position + size, len(source) - size)
+            while position < limit:
+                outgoing, incoming = source[position], source[position + size]
+                low = (low - outgoing + incoming) % self.MODULUS
+                high = (high - size * outgoing + low - 1) % self.MODULUS
+                position = position + 1
+                old_offset = match((high << 16) | low, position)
+                if old_offset is not None:
+                    break
+            add("data", start, position - start if old_offset is not None else size)
+            if old_offset is None:
+                position = start + size
+
+        if position < len(source):
+            add("data", position, len(source) - position)
+        return operations
+
+
+    def copy(self, file: str, destination: str) -> tuple:
+        """Update destination to match file, writing only the changed bytes.
+
+        Returns:
+            tuple: The number of bytes taken from the source and from the old file.
+        """
+        temporary_path = partial_path(destination)
+        signatures = self.cached_signatures(destination, os.stat(destination))
+
+        literal = 0
+        matched = 0
+        with open(file, "rb") as source_file, \
+                mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as source, \
+                open(destination, "rb") as old, \
+                open(temporary_path, "wb") as new:
+            for kind, offset, length in self.operations(source, signatures):
+                if kind == "data":
+                    new.write(source[offset:offset + length])
+                    literal = literal + length
+                    continue
+                new.flush()
+                copied = 0
+                try:
+                    while copied < length:
+                        sent = os.copy_file_range(old.fileno(), new.fileno(), length - copied, offset + copied)
+                        if sent == 0:
+                            raise OSError(errno.EINVAL, "copy_file_range copied no data.")
+                        copied = copied + sent
+                except OSError:
+                    new.seek(0, os.SEEK_END)
+                    new.write(os.pread(old.fileno(), length - copied, offset + copied))
+                new.seek(0, os.SEEK_END)
+                matched = matched + length
+            os.fchmod(new.fileno(), stat.S_IMODE(os.fstat(source_file.fileno()).st_mode))
+        os.replace(temporary_path, destination)
+
+        self.store_signatures(destination, self.signatures(file))
+        return literal, matched
+
+
+    def close(self):
+        """Close the signature cache."""
+        self.connection.close()
+
+
+def hash_file(path: str, buffer_size: int = 1024 * 1024, drop_cache: bool = False) -> bytes:
+    """Hash a file with blake2b, reading it into one fixed-size buffer so memory stays flat.
+
+    With drop_cache the file's pages are evicted first, so a file that was just written is
+    read back from the disk or share rather than from the page cache. Run in a worker process.
+
+    Returns:
+        bytes: The 32 byte digest.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        if drop_cache and hasattr(os, "posix_fadvise"):
+            os.fsync(file.fileno())  # Dirty pages cannot be dropped.
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.digest()
+
+
+def hash_pair(source: str, target: str, source_digest: bytes = None) -> tuple:
+    """Hash a source file (unless its digest is already known) and its copy. Run in a worker process."""
+    if source_digest is None:
+        source_digest = hash_file(source)
+    return source_digest, hash_file(target, drop_cache=True)
+
+
+class Verifier:  # pylint: disable=too-many-instance-attributes
+    """Checks that copied files match their source by comparing checksums on a process pool.
+
+    Digests of source files are cached in an SQLite file in the target by path, size and
+    mtime_ns, so a file that has not changed since it was last verified is not read again.
+    The copy in the target is always hashed, as that is the side that can be damaged.
+    """
+    FILENAME = ".automated_backup_hashes.sqlite"
+
+    def __init__(self, target: Path, workers: int = None):
+        """Open (or create) the hash cache in the target directory and start the process pool."""
+        self.connection = sqlite3.connect(Path(target) / self.FILENAME, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest BLOB) WITHOUT ROWID"
+        )
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.max_in_flight = (workers or os.cpu_count() or 1) * 4
+        self.in_flight = {}  # Maps each hashing job to the (relative_path, source, source_stat) being verified.
+        self.pending = []
+        self.verified = 0
+        self.reused = 0
+        self.mismatches = []
+
+
+    def cached(self, source: str, source_stat: os.stat_result) -> bytes:
+        """The digest of the source file from an earlier run, if it has not changed since."""
+        row = self.connection.execute("SELECT size, mtime_ns, digest FROM hashes WHERE path = ?", (database_path(source),)).fetchone()
+        if row is not None and row[:2] == (source_stat.st_size, source_stat.st_mtime_ns):
+            return row[2]
+        return None
+
+
+    def mismatch(self, relative_path: str, reason: str):
+        """Report a file whose copy does not match the source."""
+        logging.error("Verification failed for %s: %s.", relative_path, reason)
+        self.mismatches.append({"path": relative_path, "reason": reason})
+
+
+    def submit(self, relative_path: str, source: str, target: str):
+        """Queue a copied file to be verified, waiting for earlier ones if too many are queued."""
+        try:
+            source_stat = os.stat(source)
+            target_stat = os.stat(target)
+        except FileNotFoundError:
+            self.mismatch(relative_path, "missing")
+            return
+        if source_stat.st_size != target_stat.st_size:
+            self.mismatch(relative_path, "size")  # Truncation is caught without reading either file.
+            return
+
+        source_digest = self.cached(source, source_stat)
+        if source_digest is not None:
+            self.reused = self.reused + 1
+        self.in_flight[self.pool.submit(hash_pair, source, target, source_digest)] = (relative_path, source, source_stat)
+        if len(self.in_flight) >= self.max_in_flight:
+            self.collect(wait(self.in_flight, return_when=FIRST_COMPLETED)[0])
+
+
+    def collect(self, finished):
+        """Compare the digests of finished jobs and queue the source digests to be cached."""
+        for future in finished:
+            relative_path, source, source_stat = self.in_flight.pop(future)
+            try:
+                source_digest, target_digest = future.result()
+            except OSError as error:
+                self.mismatch(relative_path, f"unreadable ({error.strerror})")
+                continue
+            self.verified = self.verified + 1
+            self.pending.append((database_path(source), source_stat.st_size, source_stat.st_mtime_ns, source_digest))
+            if source_digest != target_digest:
+                self.mismatch(relative_path, "content")
+
+
+    def finish(self) -> dict:
+        """Wait for every queued file and return the results."""
+        self.collect(wait(self.in_flight)[0])
+        return {
+            "files_verified": self.verified,
+            "hashes_reused": self.reused,
+            "mismatches": self.mismatches
+        }
+
+
+    def close(self):
+        """Stop the process pool and save the source digests."""
+        self.pool.shutdown(cancel_futures=True)
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", self.pending)
+        self.connection.close()
+
+
+class ConcurrencyTuner:  # pylint: disable=too-many-instance-attributes
+    """Grows or shrinks the number of copies in flight to get the most throughput from the target.
+
+    Throughput and per-file latency are measured over windows of INTERVAL seconds. The limit
+    doubles while throughput keeps rising, then climbs one at a time: it carries on in the
+    same direction while throughput improves and turns around when it falls. When throughput
+    is flat after growing, the target is saturated and the limit steps back down, so a fast
+    local disk settles on a few copies and a high-latency share on many. Throttling by a
+    BandwidthLimiter also flattens throughput, so the limit shrinks to what the cap needs.
+    """
+    INTERVAL = 0.5
+    TOLERANCE = 0.05  # Relative change in throughput treated as no change.
+    FILE_COST = 64 * 1024  # Each file counts as this many bytes too, so small files are not all overhead.
+
+    def __init__(self, initial: int = 1, maximum: int = 64):
+        """Start at initial copies in flight, never going above maximum."""
+        self.limit = max(1, min(initial, maximum))
+        self.maximum = maximum
+        self.peak = self.limit
+        self.direction = 1
+        self.slow_start = True
+        self.previous = None  # Throughput of the last window, in bytes (plus FILE_COST per file) per second.
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+        self.window_files = 0
+        self.window_latency = 0.0
+        self.history = []  # (limit, bytes per second, seconds per file) of each window.
+
+
+    def completed(self, size: int, seconds: float):
+        """Record a finished copy, adjusting the limit at the end of each window."""
+        self.window_bytes = self.window_bytes + size
+        self.window_files = self.window_files + 1
+        self.window_latency = self.window_latency + seconds
+        now = time.perf_counter()
+        if now - self.window_start >= self.INTERVAL:
+            self.adjust(now)
+
+
+    def adjust(self, now: float):
+        """Move the limit according to the throughput of the window just finished."""
+        elapsed = now - self.window_start
+        throughput = (self.window_bytes + self.window_files * self.FILE_COST) / elapsed
+        latency = self.window_latency / self.window_files
+        self.history.append((self.limit, round(self.window_bytes / elapsed), round(latency, 6)))
+        logging.info(
+            "%s copies in flight: %.2f MB/s, %.1f files/s, %.1f ms per file.",
+            self.limit, self.window_bytes / elapsed / 1024 / 1024, self.window_files / elapsed, latency * 1000
+        )
+
+        if self.previous is not None:
+            if throughput < self.previous * (1 - self.TOLERANCE):
+                self.direction = -self.direction  # The last move made things worse.
+                self.slow_start = False
+            elif throughput <= self.previous * (1 + self.TOLERANCE) and self.direction > 0:
+                self.direction = -1  # More copies did not help, so use fewer.
+                self.slow_start = False
+        step = self.limit if self.slow_start else 1
+        self.limit = max(1, min(self.limit + self.direction * step, self.maximum))
+        self.peak = max(self.peak, self.limit)
+
+        self.previous = throughput
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_files = 0
+        self.window_latency = 0.0
+
+
+    def as_dict(self) -> dict:
+        """Summary of the tuning for the result."""
+        return {"final": self.limit, "peak": self.peak, "windows": self.history}
+
+
+class BandwidthLimiter:  # pylint: disable=too-few-public-methods
+    """Holds back new copies so the average rate stays under a number of bytes per second."""
+
+    def __init__(self, limit: float):
+        """Limit to the given bytes per second."""
+        self.limit = limit
+        self.start = time.perf_counter()
+        self.sent = 0
+
+
+    def throttle(self, size: int):
+        """Wait until the bytes already started fit under the limit, then count size as started."""
+        ahead = self.sent / self.limit - (time.perf_counter() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+        self.sent = self.sent + size
+
+
+class TargetBackend:
+    """Where a backup is written, for targets that are not a plain local directory.
+
+    Operations are batched so a target with a slow round trip, such as a network share,
+    pays it once per batch rather than once per file. Paths are relative to the root of
+    the target and use "/" as the separator.
+    """
+
+    def stat_many(self, relative_paths: list) -> list:
+        """The (size, mtime_ns) of each path, or None for those that do not exist."""
+        raise NotImplementedError
+
+
+    def list_directory(self, relative_directory: str) -> list:
+        """The names in a directory, or an empty list if it does not exist."""
+        raise NotImplementedError
+
+
+    def mkdir_many(self, relative_paths: list):
+        """Create directories, parents first. Directories that already exist are left alone."""
+        raise NotImplementedError
+
+
+    def put(self, relative_path: str, source: str) -> int:
+        """Stream a source file to the path, keeping its modification time.
+
+        Returns:
+            int: The number of bytes sent.
+        """
+        raise NotImplementedError
+
+
+    def close(self):
+        """Finish writing the target."""
+
+
+class LocalTarget(TargetBackend):
+    """A directory on a local or mounted filesystem."""
+
+    def __init__(self, root: Path, copier: FileCopier = None):
+        """Write beneath the root directory, copying with the copier."""
+        self.root = Path(root)
+        self.copier = copier or FileCopier()
+
+
+    def stat_many(self, relative_paths: list) -> list:
+        """Answers the paths of each directory from a single scan of it."""
+        listings = {}
+        result = []
+        for relative_path in relative_paths:
+            directory, _, name = relative_path.rpartition("/")
+            if directory not in listings:
+                try:
+                    with os.scandir(self.root / directory) as entries:
+                        listings[directory] = {entry.name: entry for entry in entries}
+                except FileNotFoundError:
+                    listings[directory] = {}
+            entry = listings[directory].get(name)
+            if entry is None:
+                result.append(None)
+            else:
+                entry_stat = entry.stat(follow_symlinks=False)
+                result.append((entry_stat.st_size, entry_stat.st_mtime_ns))
+        return result
+
+
+    def list_directory(self, relative_directory: str) -> list:
+        """Lists the directory with one scan."""
+        try:
+            return os.listdir(self.root / relative_directory)
+        except FileNotFoundError:
+            return []
+
+
+    def mkdir_many(self, relative_paths: list):
+        """Creates each directory, skipping those that exist."""
+        for relative_path in relative_paths:
+            with contextlib.suppress(FileExistsError):
+                os.mkdir(self.root / relative_path)
+
+
+    def put(self, relative_path: str, source: str) -> int:
+        """Copies through a partial file, so an interrupted copy never replaces the old one."""
+        destination = str(self.root / relative_path)
+        temporary_path = partial_path(destination)
+        try:
+            self.copier.copy(source, temporary_path, preserve_times=True)
+            os.replace(temporary_path, destination)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temporary_path)
+            raise
+        return os.path.getsize(destination)
+
+
+class ArchiveTarget(TargetBackend):
+    """A tar archive written as a stream, optionally compressed with zstandard.
+
+    The archive is only ever appended to, so nothing exists in it before a run and puts
+    from several workers are written one at a time. Compression needs the zstandard package.
+    """
+
+    def __init__(self, path: Path, compression: str = None, level: int = 3):
+        """Start writing the archive at path, compressed if compression is "zst"."""
+        compressor = None
+        if compression == "zst":
+            try:
+                import zstandard  # pylint: disable=import-outside-toplevel
+            except ImportError as error:  # Optional, only needed for the "tar.zst" target format.
+                raise ImportError("The zstandard package is needed to write tar.zst archives.") from error
+            compressor = zstandard.ZstdCompressor(level=level)
+        self.path = Path(path)
+        self.file = open(self.path, "wb")  # pylint: disable=consider-using-with
+        self.stream = self.file
+        if compressor is not None:
+            self.stream = compressor.stream_writer(self.file, closefd=False)
+        # Stays open across put() calls until close().
+        self.archive = tarfile.open(  # pylint: disable=consider-using-with
+            fileobj=self.stream, mode="w|", format=tarfile.PAX_FORMAT
+        )
+        self.lock = threading.Lock()
+        self.written = {}  # Relative path -> (size, mtime_ns) of what the archive holds.
+
+
+    def stat_many(self, relative_paths: list) -> list:
+        """Only what has been written to the archive in this run exists."""
+        return [self.written.get(relative_path) for relative_path in relative_paths]
+
+
+    def list_directory(self, relative_directory: str) -> list:
+        """The names written to the directory in this run."""
+        return [
+            relative_path.rpartition("/")[2] for relative_path in list(self.written)
+            if relative_path.rpartition("/")[0] == relative_directory
+        ]
+
+
+    def mkdir_many(self, relative_paths: list):
+        """Adds a directory entry for each path not already in the archive."""
+        with self.lock:
+            for relative_path in relative_paths:
+                if relative_path in self.written:
+                    continue
+                info = tarfile.TarInfo(relative_path)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = time.time()
+                self.archive.addfile(info)
+                self.written[relative_path] = (0, time.time_ns())
+
+
+    def put(self, relative_path: str, source: str) -> int:
+        """Adds the file to the archive, reading it as it is written."""
+        with open(source, "rb") as file:
+            file_stat = os.fstat(file.fileno())
+            info = tarfile.TarInfo(relative_path)
+            info.size = file_stat.st_size
+            info.mtime = file_stat.st_mtime
+            info.mode = file_stat.st_mode & 0o7777
+            with self.lock:
+                self.archive.addfile(info, file)
+                self.written[relative_path] = (file_stat.st_size, file_stat.st_mtime_ns)
+        return file_stat.st_size
+
+
+    def close(self):
+        """Write the end of the archive and flush the compressor."""
+        self.archive.close()
+        if self.stream is not self.file:
+            self.stream.close()
+        self.file.close()
+
+
+class LatencyTarget(TargetBackend):
+    """Wraps another backend, adding a delay to each call and limiting the bandwidth of puts.
+
+    Stands in for a network share in tests and benchmarks. Each call is counted as one round
+    trip, so the effect of batching can be measured without a real server.
+    """
+
+    def __init__(self, backend: TargetBackend, latency: float = 0.0, bandwidth: float = None):
+        """Delay each call to backend by latency seconds, and puts to bandwidth bytes per second."""
+        self.backend = backend
+        self.latency = latency
+        self.limiter = BandwidthLimiter(bandwidth) if bandwidth else None
+        self.lock = threading.Lock()
+        self.round_trips = 0
+
+
+    def round_trip(self, size: int = 0):
+        """Wait as long as a call sending size bytes would take."""
+        with self.lock:
+            self.round_trips = self.round_trips + 1
+            if self.limiter is not None:
+                self.limiter.throttle(size)
+        time.sleep(self.latency)
+
+
+    def stat_many(self, relative_paths: list) -> list:
+        """Stats the paths in one round trip."""
+        self.round_trip()
+        return self.backend.stat_many(relative_paths)
+
+
+    def list_directory(self, relative_directory: str) -> list:
+        """Lists the directory in one round trip."""
+        self.round_trip()
+        return self.backend.list_directory(relative_directory)
+
+
+    def mkdir_many(self, relative_paths: list):
+        """Creates the directories in one round trip."""
+        self.round_trip()
+        self.backend.mkdir_many(relative_paths)
+
+
+    def put(self, relative_path: str, source: str) -> int:
+        """Sends the file in one round trip, held back by the bandwidth limit."""
+        self.round_trip(os.path.getsize(source))
+        return self.backend.put(relative_path, source)
+
+
+    def close(self):
+        """Closes the wrapped backend."""
+        self.backend.close()
+
+
+class SourceWatcher:
+    """Inotify watches on the directories of the source, read as sets of changed relative paths.
+
+    Uses the inotify system calls through ctypes, so it only works on Linux. Each directory
+    needs its own watch, so new directories are reported for the caller to add. If the
+    kernel's event queue overflows, events have been lost and the caller has to rescan.
+    """
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie and the length of the name that follows.
+
+    def __init__(self, source: Path):
+        """Create the inotify instance. Directories are watched with add()."""
+        self.source = Path(source)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "Watching the source needs inotify, which is only available on Linux.")
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories = {}  # Maps each watch descriptor to the relative path of its directory.
+        self.overflowed = False
+
+
+    def add(self, relative_path: str):
+        """Watch a directory. If the watch limit is reached, the next read reports an overflow."""
+        path = os.fsencode(self.source / relative_path if relative_path else self.source)
+        descriptor = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logging.warning("The inotify watch limit was reached, falling back to a full rescan.")
+                self.overflowed = True
+            elif error != errno.ENOENT:  # Removed again before it could be watched.
+                raise OSError(error, os.strerror(error), relative_path)
+            return
+        self.directories[descriptor] = relative_path
+
+
+    def read(self, timeout: float = None) -> tuple:
+        """Wait up to timeout seconds (forever if None) for events.
+
+        Returns:
+            tuple: The changed relative paths, the new directories among them and whether events were lost.
+        """
+        changed = set()
+        new_directories = set()
+        overflowed, self.overflowed = self.overflowed, False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed, new_directories, overflowed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0"))
+                offset = offset + self.EVENT.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflowed = True
+                elif mask & self.IN_IGNORED:
+                    self.directories.pop(descriptor, None)  # The directory was removed.
+                elif descriptor in self.directories and name:
+                    directory = self.directories[descriptor]
+                    relative_path = f"{directory}/{name}" if directory else name
+                    changed.add(relative_path)
+                    if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        new_directories.add(relative_path)
+        return changed, new_directories, overflowed
+
+
+    def close(self):
+        """Remove every watch."""
+        os.close(self.fd)
+
+
+class SmallFilePipeline:  # pylint: disable=too-many-instance-attributes
+    """Copies small files in two stages, so reading some files overlaps with writing others.
+
+    Reader threads read each file whole into a slot of one buffer allocated up front, and
+    writer threads drain the slots into the target. Only as many slots as fit in the memory
+    budget exist, so the readers wait for the writers instead of reading ahead without limit.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, fallback, budget: int = 64 * 1024 * 1024, slot_size: int = 256 * 1024,
+            readers: int = 1, writers: int = 1, preserve_times: bool = False
+        ):
+        """Start the reader and writer threads.
+
+        Args:
+            fallback: Copies a file that turns out to be too big for a slot, like Backup.copy_file().
+            budget (int): Bytes of buffer shared by all the files in the pipeline.
+            slot_size (int): The largest file that can be pipelined.
+        """
+        self.fallback = fallback
+        self.slot_size = slot_size
+        self.preserve_times = preserve_times
+        self.buffer = bytearray(max(1, budget // slot_size) * slot_size)
+        view = memoryview(self.buffer)
+        self.free = queue.SimpleQueue()
+        for start in range(0, len(self.buffer), slot_size):
+            self.free.put(view[start:start + slot_size])
+        self.reads = queue.SimpleQueue()
+        self.writes = queue.SimpleQueue()
+        self.readers = [threading.Thread(target=self.read_stage, daemon=True) for _ in range(readers)]
+        self.writers = [threading.Thread(target=self.write_stage, daemon=True) for _ in range(writers)]
+        for thread in self.readers + self.writers:
+            thread.start()
+
+
+    @property
+    def slots(self) -> int:
+        """How many files can be held at once."""
+        return len(self.buffer) // self.slot_size
+
+
+    def submit(self, file: str, destination: str) -> Future:
+        """Queue a file to be copied, returning a Future for the same result as Backup.copy_file()."""
+        future = Future()
+        self.reads.put((future, file, destination))
+        return future
+
+
+    def read_stage(self):
+        """Read queued files into free slots, waiting for one when the budget is used up."""
+        while True:
+            job = self.reads.get()
+            if job is None:
+                return
+            future, file, destination = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            slot = self.free.get()
+            start = time.perf_counter()
+            try:
+                fd = os.open(file, os.O_RDONLY)
+                try:
+                    source_stat = os.fstat(fd)
+                    length = 0
+                    while length < self.slot_size:
+                        read = os.readv(fd, [slot[length:]])
+                        if read == 0:
+                            break
+                        length = length + read
+                    too_big = length == self.slot_size and os.pread(fd, 1, length)
+                finally:
+                    os.close(fd)
+            except BaseException as error:  # pylint: disable=broad-exception-caught
+                self.free.put(slot)
+                future.set_exception(error)
+                continue
+            if too_big:  # The file has grown since it was planned.
+                self.free.put(slot)  # Freed before the fallback, which may raise.
+                try:
+                    future.set_result(self.fallback(file, destination))
+                except BaseException as error:  # pylint: disable=broad-exception-caught
+                    future.set_exception(error)
+                continue
+            self.writes.put((future, destination, slot, length, source_stat, time.perf_counter() - start))
+
+
+    def write_stage(self):
+        """Write filled slots to the target through a temporary file, then free the slot."""
+        while True:
+            job = self.writes.get()
+            if job is None:
+                return
+            future, destination, slot, length, source_stat, seconds = job
+            start = time.perf_counter()
+            temporary_path = partial_path(destination)
+            try:
+                fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    written = 0
+                    while written < length:
+                        written = written + os.write(fd, slot[written:length])
+                    os.fchmod(fd, stat.S_IMODE(source_stat.st_mode))
+                    if self.preserve_times:
+                        os.utime(fd, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+                    allocated = os.fstat(fd).st_blocks * 512
+                finally:
+                    os.close(fd)
+                os.replace(temporary_path, destination)
+            except BaseException as error:  # pylint: disable=broad-exception-caught
+                with contextlib.suppress(OSError):
+                    os.unlink(temporary_path)
+                future.set_exception(error)
+            else:
+                future.set_result(("pipelined", seconds + time.perf_counter() - start, None, allocated))
+            finally:
+                self.free.put(slot)
+
+
+    def close(self):
+        """Cancel any files not yet read and stop the threads."""
+        while True:
+            try:
+                job = self.reads.get_nowait()
+            except queue.Empty:
+                break
+            job[0].cancel()
+        for _ in self.readers:
+            self.reads.put(None)
+        for thread in self.readers:
+            thread.join()
+        for _ in self.writers:
+            self.writes.put(None)
+        for thread in self.writers:
+            thread.join()
+
+
+class Metrics:
+    """Timings and counters collected while transferring files.
+
+    Phases are cumulative seconds. "copy" is summed over every worker, so with more than
+    one worker it can be larger than the wall-clock time, while "wait" is the time the
+    calling thread spent blocked on the pool.
+    """
+    THROUGHPUT_BUCKETS = (1, 10, 100, 1000)  # Upper bounds in MB/s, with a final unbounded bucket.
+
+    def __init__(self, slowest: int = 10):
+        """Create empty metrics that keep the given number of slowest files."""
+        self.phases = {"scan": 0.0, "ignore": 0.0, "decide": 0.0, "mkdir": 0.0, "copy": 0.0, "wait": 0.0}
+        self.skipped = {}
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.slowest_limit = slowest
+        self.slowest = []  # Min-heap of (seconds, path) so the fastest of the slowest is popped first.
+        self.histogram = [0] * (len(self.THROUGHPUT_BUCKETS) + 1)
+
+
+    def time(self, phase: str, seconds: float):
+        """Add to the time spent in a phase."""
+        self.phases[phase] = self.phases[phase] + seconds
+
+
+    def skip(self, reason: str):
+        """Count a file that was not copied."""
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+
+    def copied(self, path: str, size: int, seconds: float):
+        """Record a finished copy."""
+        self.files_copied = self.files_copied + 1
+        self.bytes_copied = self.bytes_copied + size
+        self.time("copy", seconds)
+
+        if len(self.slowest) < self.slowest_limit:
+            heapq.heappush(self.slowest, (seconds, path))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, path))
+
+        throughput = size / (1024 * 1024) / max(seconds, 1e-9)
+        bucket = 0
+        while bucket < len(self.THROUGHPUT_BUCKETS) and throughput > self.THROUGHPUT_BUCKETS[bucket]:
+            bucket = bucket + 1
+        self.histogram[bucket] = self.histogram[bucket] + 1
+
+
+    def as_dict(self) -> dict:
+        """The metrics as plain values for the result dict."""
+        labels = [f"<={bound}" for bound in self.THROUGHPUT_BUCKETS] + [f">{self.THROUGHPUT_BUCKETS[-1]}"]
+        return {
+            "phase_seconds": {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            "bytes_copied": self.bytes_copied,
+            "files_skipped": dict(self.skipped),
+            "slowest_files": [
+                {"path": path, "seconds": round(seconds, 6)} for seconds, path in sorted(self.slowest, reverse=True)
+            ],
+            "throughput_histogram_mb_per_second": dict(zip(labels, self.histogram))
+        }
+
+
+    def to_prometheus(self, result: dict) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE automated_backup_files_transferred gauge",
+            f"automated_backup_files_transferred {result['files_transferred']}",
+            "# TYPE automated_backup_duration_seconds gauge",
+            f"automated_backup_duration_seconds {result['time_taken']}",
+            "# TYPE automated_backup_bytes_copied gauge",
+            f"automated_backup_bytes_copied {self.bytes_copied}",
+            "# TYPE automated_backup_last_completed_timestamp_seconds gauge",
+            f"automated_backup_last_completed_timestamp_seconds {time.time():.0f}",
+            "# TYPE automated_backup_phase_seconds gauge"
+        ]
+        lines += [f'automated_backup_phase_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in self.phases.items()]
+        lines.append("# TYPE automated_backup_files_skipped gauge")
+        lines += [f'automated_backup_files_skipped{{reason="{reason}"}} {count}' for reason, count in self.skipped.items()]
+        lines.append("# TYPE automated_backup_copy_throughput_mb_per_second histogram")
+        cumulative = 0
+        for bound, count in zip([*self.THROUGHPUT_BUCKETS, "+Inf"], self.histogram):
+            cumulative = cumulative + count
+            lines.append(f'automated_backup_copy_throughput_mb_per_second_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"automated_backup_copy_throughput_mb_per_second_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+    def export(self, path: str, result: dict):
+        """Write the result to a ".prom" textfile for Prometheus, or append it to a JSON-lines file."""
+        if path.endswith(".prom"):
+            # Written then renamed so the textfile collector never reads a partial file.
+            temporary_path = f"{path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as file:
+                file.write(self.to_prometheus(result))
+            os.replace(temporary_path, path)
+        else:
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(result, default=str) + "\n")
+
+
+class Operation(NamedTuple):
+    """One step of a BackupPlan.
+
+    kind is "mkdir", "copy", "duplicate", "link", "skip" or "delete". path is relative to
+    the source (or to the target, for "delete"), and destination is relative to the target,
+    except for "skip" where it holds the reason. size, mtime_ns and inode are of the source
+    file when it was planned, and are what the manifest records once it has been copied.
+    """
+    kind: str
+    path: str
+    size: int = 0
+    mtime_ns: int = 0
+    inode: int = 0
+    destination: str = ""
+
+
+class BackupPlan:
+    """Everything a backup will do, worked out from the metadata of the source and target.
+
+    A plan can be saved as JSON lines, inspected, cut down with limit(), and run later with
+    Backup.execute(). transfer_files() runs plans whose operations are generated lazily, so
+    deciding and copying overlap without holding the whole plan in memory.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, source: Path, target: Path, operations=None, previous: Path = None, snapshot: str = None,
+            mirror: dict = None, throughput: dict = None
+        ):
+        """Create a plan.
+
+        Args:
+            operations: A list of Operations, or an iterator producing them.
+            previous (Path): The snapshot that "link" operations link to.
+            snapshot (str): The existing snapshot a resumed run writes into, rather than a new one.
+            mirror (dict): Report of the files no longer in the source, once known.
+            throughput (dict): The bytes and files per second of the last run, from the manifest.
+        """
+        self.source = Path(source)
+        self.target = Path(target)
+        self.operations = [] if operations is None else operations
+        self.previous = previous
+        self.snapshot = snapshot
+        self.mirror = mirror
+        self.throughput = throughput
+
+
+    def summary(self) -> dict:
+        """Totals of the plan, with the time it should take at the throughput of the last run."""
+        kinds = {}
+        skipped = {}
+        size = 0
+        for operation in self.operations:
+            kinds[operation.kind] = kinds.get(operation.kind, 0) + 1
+            if operation.kind == "skip":
+                skipped[operation.destination] = skipped.get(operation.destination, 0) + 1
+            elif operation.kind in ("copy", "duplicate"):
+                size = size + operation.size
+        files = kinds.get("copy", 0) + kinds.get("duplicate", 0)
+
+        estimate = None
+        if self.throughput:
+            # Whichever of the bytes or the number of files takes longer at the measured rates.
+            estimate = files / self.throughput["files_per_second"]
+            if size and self.throughput["bytes_per_second"]:
+                estimate = max(estimate, size / self.throughput["bytes_per_second"])
+            estimate = round(estimate, 1)
+
+        return {
+            "directories": kinds.get("mkdir", 0),
+            "files_to_copy": files,
+            "files_to_link": kinds.get("link", 0),
+            "files_skipped": skipped,
+            "paths_to_delete": kinds.get("delete", 0),
+            "bytes_to_copy": size,
+            "estimated_seconds": estimate
+        }
+
+
+    def limit(self, max_bytes: int) -> "BackupPlan":
+        """A copy of the plan that stops copying files once max_bytes would be exceeded.
+
+        The files left out are copied by a later run.
+        """
+        operations = []
+        size = 0
+        for operation in self.operations:
+            if operation.kind in ("copy", "duplicate"):
+                if size + operation.size > max_bytes:
+                    continue
+                size = size + operation.size
+            operations.append(operation)
+        return BackupPlan(self.source, self.target, operations, self.previous, self.snapshot, self.mirror, self.throughput)
+
+
+    def save(self, path: str):
+        """Write the plan as JSON lines: the settings and summary, then one operation per line."""
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(json.dumps({
+                "source": str(self.source),
+                "target": str(self.target),
+                "previous": None if self.previous is None else str(self.previous),
+                "snapshot": self.snapshot,
+                "mirror": self.mirror,
+                "throughput": self.throughput,
+                "summary": self.summary()
+            }) + "\n")
+            for operation in self.operations:
+                file.write(json.dumps(operation) + "\n")
+
+
+    @classmethod
+    def load(cls, path: str) -> "BackupPlan":
+        """Read a plan written by save()."""
+        with open(path, encoding="utf-8") as file:
+            header = json.loads(next(file))
+            operations = [Operation(*json.loads(line)) for line in file]
+        previous = None if header["previous"] is None else Path(header["previous"])
+        return cls(
+            header["source"], header["target"], operations, previous, header["snapshot"], header["mirror"], header["throughput"]
+        )
+
+
+class Backup:  # pylint: disable=too-many-public-methods
     """Main class to backup files."""
     # pylint: disable=too-many-instance-attributes, too-many-arguments, dangerous-default-value
-    def __init__(
+    ARCHIVE_FORMATS = {"tar": None, "tar.zst": "zst"}  # Target format -> compression of the ArchiveTarget.
+    # Options that only the mirror format carries out, so the other formats and target backends refuse them.
+    MIRROR_ONLY_OPTIONS = ("resume", "snapshot", "delta_threshold", "verify", "auto_tune", "bandwidth_limit", "pipeline", "metrics_file")
+
+    def __init__(  # pylint: disable=too-many-locals,too-many-statements
             self,
             source: Path,
             target: Path,
@@ -34,7 +2255,32 @@ class Backup:
             ignored_ext: list = [],
             ignored_files: list = [],
             ignored_directories: list = [],
-            dry_run: bool = False
+            dry_run: bool = False,
+            workers: int = 1,
+            incremental: bool = False,
+            ignore_patterns: list = [],
+            ignore_file: Path = None,
+            metrics_file: Path = None,
+            progress: bool = None,
+            resume: bool = False,
+            snapshot: bool = False,
+            keep_daily: int = 7,
+            keep_weekly: int = 4,
+            target_format: str = "mirror",
+            # "mirror": A plain copy of the source.
+            # "chunked": A ChunkStore that stores repeated content only once.
+            # "tar", "tar.zst": A new (compressed) archive of the source in the target.
+            delta_threshold: int = None,
+            verify: bool = False,
+            auto_tune: bool = False,
+            max_workers: int = 64,
+            bandwidth_limit: float = None,
+            mirror: bool = False,
+            mirror_threshold: float = 0.5,
+            pipeline: bool = False,
+            memory_budget: int = 64 * 1024 * 1024,
+            target_backend: TargetBackend = None,
+            preserve_times: bool = False
         ):
         """Initialise the Backup instance."""
         try:
@@ -51,6 +2297,88 @@ class Backup:
         self.ignored_directories = ignored_directories
         self.result = {}
         self.dry_run = dry_run
+        self.target_index = TargetIndex()
+        self.copier = FileCopier()
+
+        if not isinstance(workers, int) or workers < 1:
+            logging.error("The number of workers must be a positive integer.")
+            sys.exit("The number of workers must be a positive integer.")
+        self.workers = workers
+        self.incremental = incremental
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        # Headless runs (e.g. from cron) do not draw the progress bar.
+        self.progress = sys.stdout.isatty() if progress is None else progress
+        self.resume = resume
+        self.snapshot = snapshot
+        # Snapshots keep modification times so the next one can tell which files changed, and restores keep them too.
+        self.preserve_times = preserve_times or snapshot
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+
+        if target_format not in ("mirror", "chunked", *self.ARCHIVE_FORMATS):
+            logging.error("The target format must be 'mirror', 'chunked', 'tar' or 'tar.zst'.")
+            sys.exit("The target format must be 'mirror', 'chunked', 'tar' or 'tar.zst'.")
+        self.target_format = target_format
+        self.target_backend = target_backend  # Written to instead of the target directory, if given.
+        self.delta_threshold = delta_threshold  # Size in bytes from which existing files are updated by delta.
+        self.delta = None
+        self.verify = verify
+        # With auto_tune, the number of copies in flight starts at workers and is tuned up to max_workers.
+        self.auto_tune = auto_tune
+        self.max_workers = max(max_workers, workers)
+        self.bandwidth_limit = bandwidth_limit  # Bytes per second.
+        self.tuner = None
+
+        unsupported = self.unsupported_options(
+            target_format, target_backend, resume=resume, snapshot=snapshot, delta_threshold=delta_threshold,
+            verify=verify, auto_tune=auto_tune, bandwidth_limit=bandwidth_limit, pipeline=pipeline,
+            metrics_file=metrics_file, incremental=incremental
+        )
+        if unsupported:
+            writer = "A target backend" if target_format == "mirror" else f"The {target_format} target format"
+            logging.error("%s cannot be used with %s.", writer, ", ".join(unsupported))
+            sys.exit(f"{writer} cannot be used with {', '.join(unsupported)}.")
+
+        if mirror and (snapshot or target_format != "mirror" or target_backend is not None):
+            logging.error("Mirror cannot be used with snapshots, the chunked or archive formats or a target backend.")
+            sys.exit("Mirror cannot be used with snapshots, the chunked or archive formats or a target backend.")
+        self.mirror = mirror
+        self.mirror_threshold = mirror_threshold  # Largest fraction of the target's files that may be removed.
+        # With pipeline, small files are read ahead into a buffer of memory_budget bytes by a SmallFilePipeline.
+        self.pipeline = pipeline
+        self.memory_budget = memory_budget
+
+        # Patterns come from the options and the ignore file, which defaults to ".backupignore" in the source.
+        if ignore_file is None:
+            ignore_file = self.source / IgnoreRules.FILENAME
+        self.ignore_patterns = list(ignore_patterns) + IgnoreRules.read_patterns(os.path.expanduser(ignore_file))
+        self.ignore_rules = IgnoreRules(
+            self.source, ignored_ext, ignored_files, ignored_directories, self.ignore_patterns
+        )
+
+
+    @classmethod
+    def unsupported_options(cls, target_format: str, target_backend: TargetBackend = None, **options) -> list:
+        """The options that are set but that the target format, or target backend, would not carry out.
+
+        Args:
+            target_format (str): The target format, as for Backup.
+            target_backend (TargetBackend): The target backend, as for Backup.
+            options: Option name -> value, where None and False mean the option is not set.
+
+        Returns:
+            list: The names of the unsupported options, in the order given.
+        """
+        if target_format == "mirror" and target_backend is None:
+            return []
+        unsupported = cls.MIRROR_ONLY_OPTIONS
+        if target_format in cls.ARCHIVE_FORMATS:
+            unsupported = (*unsupported, "incremental")  # Every run writes a new archive.
+        return [
+            name for name, value in options.items()
+            if name in unsupported and value is not None and value is not False
+        ]
 
 
     def check_dir_exists(self) -> bool:
@@ -61,6 +2389,7 @@ class Backup:
         return False
 
 
+    # pylint: disable=too-many-return-statements
     def check_target_ready(self) -> tuple:
         """Checks that the target empty if overwrite is set to false."""
         if not isinstance(self.overwrite, bool):
@@ -70,8 +2399,16 @@ class Backup:
         if self.overwrite:
             return (True, "")
 
+        # Every snapshot or archive is written to a new path, and a chunk store only ever adds chunks.
+        if self.snapshot or self.target_format != "mirror":
+            return (True, "")
+
+        # The target holds the files of the interrupted run being resumed.
+        if self.resume and (self.target / Journal.FILENAME).exists():
+            return (True, "")
+
         # If target is empty
-        if len(os.listdir(self.target)) == 0:
+        if self.target_is_empty():
             return (True, "")
         # If overwrite_condition is "Ignore" or "Duplicate".
         if self.overwrite_condition == "Target Empty":
@@ -83,6 +2420,12 @@ class Backup:
         return (False, "Overwrite is set to 'False' but target directory is not empty.")
 
 
+    def target_is_empty(self) -> bool:
+        """Checks whether the target has no entries, stopping at the first one found."""
+        with os.scandir(self.target) as entries:
+            return next(entries, None) is None
+
+
     def output(self, time_taken: float, count: int) -> dict:
         """Outputs the results to the user."""
         # Check the inputs are valid.
@@ -121,13 +2464,79 @@ class Backup:
             sys.exit(check_target_ready_str)
 
 
-    def list_files(self) -> list:
-        """List all of the files in the source."""
-        # Find all files in the source firectory.
-        source_files = glob.glob(f"{self.source}/**", recursive=True)
-        source_files.pop(0)  # Removes the root directory.
+    # pylint: disable=too-many-locals,too-many-branches
+    def list_files(self, paths: set = None):
+        """Lazily walk the source, yielding (entry, relative_path) for every item.
+
+        Uses os.scandir so the DirEntry type information is reused rather than stat-ing
+        each path again. A directory is always yielded before its contents. Anything matched
+        by the ignore rules is left out, and ignored directories are pruned so nothing
+        beneath them is visited. Directories that cannot be listed are logged and skipped, as
+        are symlinks to directories that have already been walked, such as "loop -> .".
+
+        Args:
+            paths (set): Only list these relative paths, and everything beneath those that are
+                directories. Paths that no longer exist are left out.
+        """
+        if paths is None:
+            pending = [(str(self.source), "", None)]
+        else:
+            # Each path is found by scanning its parent, unless it is beneath another of the paths.
+            names = {}
+            for relative_path in paths:
+                parts = relative_path.split("/")
+                if not any("/".join(parts[:depth]) in paths for depth in range(1, len(parts))):
+                    names.setdefault("/".join(parts[:-1]), set()).add(parts[-1])
+            pending = [
+                (str(self.source / relative_directory), relative_directory, wanted)
+                for relative_directory, wanted in sorted(names.items(), reverse=True)
+            ]
+
+        # Directories already walked, by (st_dev, st_ino), so symlinks looping back are not followed.
+        visited = {(source_stat.st_dev, source_stat.st_ino) for source_stat in [os.stat(self.source)]}
+        while pending:
+            directory, relative_directory, wanted = pending.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as error:
+                if paths is None and not relative_directory:
+                    raise  # The source itself cannot be read.
+                if not isinstance(error, FileNotFoundError):
+                    logging.error("Could not list %s (%s), skipping it.", directory, error)
+                continue
+            with entries:
+                for entry in entries:
+                    # Hidden entries were never matched by the previous glob("**") listing.
+                    if entry.name.startswith("."):
+                        continue
+                    if wanted is not None and entry.name not in wanted:
+                        continue
 
-        return source_files
+                    relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                    is_dir = entry.is_dir()
+
+                    ignore_start = time.perf_counter()
+                    reason = self.ignore_rules.match(relative_path, entry.name, is_dir)
+                    self.metrics.time("ignore", time.perf_counter() - ignore_start)
+                    if reason is not None:
+                        self.metrics.skip(f"ignored_{reason}")
+                        if reason != "ext":
+                            logging.info("%s not created as it matches the ignored %s rules.", entry.path, reason)
+                        continue
+
+                    if is_dir:
+                        try:
+                            entry_stat = entry.stat()
+                        except OSError as error:
+                            logging.error("Could not read %s (%s), skipping it.", entry.path, error)
+                            continue
+                        if (entry_stat.st_dev, entry_stat.st_ino) in visited:
+                            logging.warning("%s is a directory that has already been backed up, skipping it.", entry.path)
+                            continue
+                        visited.add((entry_stat.st_dev, entry_stat.st_ino))
+                        pending.append((entry.path, relative_path, None))
+
+                    yield entry, relative_path
 
 
     def remove_start_path(self, file):
@@ -166,183 +2575,1071 @@ class Backup:
 
         return True
 
-    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-    def transfer_files(self):
-        """Transfers the files from the source to the directory, respecting the user inputs."""
+    def copy_destination(self, entry: os.DirEntry, new_path: str):
+        """Decides where a source file should be copied to, respecting the overwrite condition.
 
-        logging.info(
-            "Transfer process started with the following settings: {Source: %s, Target: %s, Overwrite: %s, Dry Run: %s}.",
-            self.source, self.target, self.overwrite, self.dry_run
-        )
+        Args:
+            entry (os.DirEntry): The source file.
+            new_path (str): The mirrored path of the file in the target.
+
+        Returns:
+            tuple: The path to copy the file to, or None and the reason if the file should be skipped.
+        """
+        file = entry.path
+
+        if self.overwrite:
+            # Check whether file was modified within the last x hours.
+            if self.overwrite_condition == "Recently Modified":
+                modified_within = 7 * 24  # 7 days.
+                if not self.check_file_last_modified(file, modified_within):
+                    return None, "not_recently_modified"
+            return new_path, None
+
+        # If set to ignore existing files.
+        if self.overwrite_condition == "Ignore":
+            if self.target_index.exists(new_path):
+                return None, "already_exists"
+            self.target_index.add(new_path, entry.stat().st_size)
+            return new_path, None
+
+        if self.overwrite_condition == "Duplicate":
+            if self.target_index.exists(new_path):
+                # Keeps the old file and writes the new one as "name (n).ext".
+                new_path = self.target_index.next_duplicate(new_path)
+            self.target_index.add(new_path, entry.stat().st_size)
+            return new_path, None
+
+        return new_path, None
+
+
+    def make_directory(self, new_path: str):
+        """Creates a directory in the target, if it is not already there."""
+        mkdir_start = time.perf_counter()
+        try:
+            os.mkdir(new_path)
+            self.target_index.created(new_path)
+            logging.info("New directory created: %s.", new_path)
+        except FileExistsError:
+            pass
+        self.metrics.time("mkdir", time.perf_counter() - mkdir_start)
+
+
+    def copy_file(self, file: str, destination: str) -> tuple:
+        """Copies a single file into the target. Run by the worker pool.
+
+        Large files that already exist in the target are updated with a DeltaTransfer when
+        delta_threshold is set.
+
+        Returns:
+            tuple: The strategy used, the seconds the copy took, the bytes written (None for the whole
+                file) and the bytes the copy takes up on disk.
+        """
+        start = time.perf_counter()
+        written = None
+        size = os.path.getsize(file)
+        large = self.delta is not None and size >= self.delta_threshold and size > 0  # Empty files cannot be mapped.
+        if large and os.path.exists(destination) and os.path.getsize(destination) > 0:
+            written, _ = self.delta.copy(file, destination)
+            if self.overwrite and self.overwrite_condition == "Recently Modified":
+                logging.info("%s has been overwritten to %s by a delta of %s bytes.", file, destination, written)
+            return "delta", time.perf_counter() - start, written, os.stat(destination).st_blocks * 512
+
+        temporary_path = partial_path(destination)
+        try:
+            strategy, allocated = self.copier.copy(file, temporary_path, preserve_times=self.preserve_times)
+            os.replace(temporary_path, destination)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temporary_path)
+            raise
+        if large:
+            # Saves reading the file back from the target to work out the next delta.
+            self.delta.store_signatures(destination, self.delta.signatures(file))
+        seconds = time.perf_counter() - start
+        if self.overwrite and self.overwrite_condition == "Recently Modified":
+            logging.info("%s has been overwritten to %s.", file, destination)
+        return strategy, seconds, written, allocated
+
+
+    def link_file(self, file: str, previous: str, destination: str) -> tuple:
+        """Hardlinks an unchanged file from the previous snapshot, copying it if that fails.
+
+        Run by the worker pool. Returns the same as copy_file(), with "hardlink" as the strategy.
+        """
         start = time.perf_counter()
+        try:
+            os.link(previous, destination)
+        except OSError as error:
+            # E.g. the filesystem does not support hardlinks, or the link count is at its limit.
+            logging.warning("Could not hardlink %s (%s), copying instead.", previous, error)
+            return self.copy_file(file, destination)
+        return "hardlink", time.perf_counter() - start, 0, 0
+
+
+    def snapshot_unchanged(self, relative_path: str, entry: os.DirEntry, manifest: Manifest, previous: Path) -> bool:
+        """Whether a file is the same as in the previous snapshot, so can be hardlinked to it."""
+        if previous is None:
+            return False
+        if manifest is not None:
+            return manifest.unchanged(relative_path, entry)
+        source_stat = entry.stat()
+        return self.target_index.stat(f"{previous}/{relative_path}") == (source_stat.st_size, source_stat.st_mtime_ns)
+
+
+    # Chunk sizes for the "chunked" target format: at least 16 KiB, about 64 KiB on average, at most 256 KiB.
+    CHUNK_SIZES = (16 * 1024, 16, 256 * 1024)
+
+    def dry_run_chunked(self, paths: set = None) -> dict:
+        """Counts the files a chunked backup would chunk, without writing to the store."""
+        store = ChunkStore(self.target) if (self.target / ChunkStore.DATABASE).exists() else None
+        files_to_copy = 0
+        bytes_to_copy = 0
+        unchanged = 0
+        try:
+            for entry, relative_path in self.list_files(paths):
+                if entry.is_dir():
+                    continue
+                if store is not None and store.unchanged(relative_path, entry):
+                    unchanged = unchanged + 1
+                    continue
+                logging.info("DRY RUN: File would be chunked: %s.", relative_path)
+                files_to_copy = files_to_copy + 1
+                bytes_to_copy = bytes_to_copy + entry.stat().st_size
+        finally:
+            if store is not None:
+                store.close()
+
+        output = self.output(0, 0)
+        output["files_unchanged"] = unchanged
+        output["plan"] = {"files_to_copy": files_to_copy, "bytes_to_copy": bytes_to_copy}
+        return output
 
+
+    # pylint: disable=too-many-locals,too-many-statements
+    def transfer_files_chunked(self, paths: set = None) -> dict:
+        """Backs the source up into a deduplicating ChunkStore in the target.
+
+        Files are chunked and hashed on a process pool using every core. Only chunks that
+        are not already in the store are written, by the thread pool, and a file's recipe is
+        only recorded once every chunk it uses has been written. A dry run only counts the
+        files that would be chunked.
+        """
+        logging.info("Chunked transfer process started with the following settings: {Source: %s, Target: %s}.", self.source, self.target)
+        start = time.perf_counter()
         self.check_ready()
-        source_files = self.list_files()
+        if self.dry_run:
+            return self.dry_run_chunked(paths)
+
+        count = 0
+        bytes_read = 0
+        bytes_written = 0
+        store = ChunkStore(self.target)
+        chunking = {}  # Maps each chunking job to the (relative_path, entry) being chunked.
+        writing = {}  # Maps each writing job to the (relative_path, entry, chunks, new) being written.
+        waiting = []  # Written files sharing chunks that another file is still writing.
+        max_in_flight = (os.cpu_count() or 1) * 4
+
+        def collect_chunked(finished):
+            """Hand the new chunks of each chunked file to the writers."""
+            nonlocal bytes_read
+            for future in finished:
+                relative_path, entry = chunking.pop(future)
+                chunks = future.result()
+                new = store.new_chunks(chunks)
+                writing[writers.submit(store.write_chunks, entry.path, new)] = (relative_path, entry, chunks, new)
+                bytes_read = bytes_read + entry.stat().st_size
+
+        def collect_written(finished):
+            """Record the recipe of each file whose chunks are all written."""
+            nonlocal bytes_written, count, waiting
+            for future in finished:
+                job = writing.pop(future)
+                try:
+                    bytes_written = bytes_written + future.result()
+                except BaseException:
+                    store.release(job[3])
+                    raise
+                store.written(job[3])
+                waiting.append(job)
+            still_waiting = []
+            for relative_path, entry, chunks, new in waiting:
+                if not store.complete(chunks):
+                    still_waiting.append((relative_path, entry, chunks, new))
+                    continue
+                store.add(relative_path, entry, chunks, new)
+                count = count + 1
+            waiting = still_waiting
 
-        count = 0  # Number of files replicated.
-        time_taken = 0
-        total_items = len(source_files)
-
-        # Used for the progress bar.
-        with alive_bar(total_items, bar="filling") as progress_bar:
-
-            # Create each directory and copy each file.
-            for file in source_files: # pylint: disable=too-many-nested-blocks
-                # Removes all directories from the path so just the file is left.
-
-                split_point = self.remove_start_path(file)
-                # print(split_point)
-                new_path = ""
-                for directory in split_point:
-                    new_path = new_path + "/" + directory
-                new_path = f"{self.target}/{new_path}"
-
-                if Path(file).is_dir():
-                    if file in self.ignored_directories:
-                        progress_bar() # pylint: disable=not-callable
-                        logging.info("%s not created as in ignored directories list.", file)
-                        new_path = ""
-                        continue
-                    if self.dry_run:
-                        logging.info("DRY RUN: New directory would be created:  %s.", new_path)
-                        progress_bar() # pylint: disable=not-callable
-                        new_path = ""
+        try:
+            with ProcessPoolExecutor() as chunkers, ThreadPoolExecutor(max_workers=self.workers) as writers:
+                for entry, relative_path in self.list_files(paths):
+                    if entry.is_dir() or store.unchanged(relative_path, entry):
                         continue
-                    try:
-                        os.mkdir(new_path)
-                        logging.info("New directory created: %s.", new_path)
-                    except FileExistsError:
-                        pass
+                    chunking[chunkers.submit(chunk_file, entry.path, *self.CHUNK_SIZES)] = (relative_path, entry)
+                    if len(chunking) >= max_in_flight:
+                        collect_chunked(wait(chunking, return_when=FIRST_COMPLETED)[0])
+                    if len(writing) >= max_in_flight:
+                        collect_written(wait(writing, return_when=FIRST_COMPLETED)[0])
+
+                collect_chunked(wait(chunking)[0])
+                collect_written(wait(writing)[0])
+        finally:
+            store.close()
+
+        time_taken = time.perf_counter() - start
+        output = self.output(time_taken, count)
+        output["bytes_read"] = bytes_read
+        output["bytes_written"] = bytes_written
+        output["dedup_ratio"] = round(bytes_read / bytes_written, 2) if bytes_written else None
+        logging.info("Chunked backup job completed in %0.4f seconds.", time_taken)
+        flush_logs()
+        return output
 
-                # If it is a file, not directory.
-                else:
-                    file_location = os.path.dirname(file)
-                    # print(f"file_location - {file_location}")
-                    # print(f"new_path - {new_path}")
-                    if self.dry_run:
-                        logging.info("DRY RUN: File would be copied to: %s.", new_path)
-                        progress_bar() # pylint: disable=not-callable
-                        new_path = ""
-                        continue
-                    if file_location in self.ignored_directories:
-                        progress_bar() # pylint: disable=not-callable
-                        logging.info("%s not created as in ignored directories list.", file)
-                        new_path = ""
-                        continue
-                    if file in self.ignored_files:
-                        progress_bar() # pylint: disable=not-callable
-                        logging.info("%s not created as in ignored files list.", file)
-                        new_path = ""
-                        continue
-                    if Path(file).suffix not in self.ignored_ext:
-
-                        # Check whether file was modified withint the last x hours.
-                        if self.overwrite:
-
-                            if self.overwrite_condition == "Recently Modified":
-
-                                modified_witin = 7 * 24  # 7 days.
-
-                                if self.check_file_last_modified(file, modified_witin):
-                                    shutil.copy(file, new_path)
-                                    count = count + 1
-                                    logging.info(
-                                        "%s has been overwritten to %s.",
-                                        file, new_path
-                                    )
-                                else:
-                                    progress_bar() # pylint: disable=not-callable
-                                    # logging.info(
-                                        # "%s not overwritten because not updated in the last %s hours.",
-                                        # file, modified_witin
-                                    # )
-                                    continue
-
-                            else:
-                                shutil.copy(file, new_path)
-
-                        # self.overwrite is set to false.
-                        else:
 
-                            # If set to ignore existin files
-                            if self.overwrite_condition == "Ignore":
+    def list_batches(self, paths: set = None):
+        """Groups list_files() by the directory scanned, yielding (directories, files) for each.
+
+        directories holds relative paths and files holds (entry, relative_path) pairs. A
+        directory is always in an earlier batch than its contents.
+        """
+        current = None
+        directories = []
+        files = []
+        for entry, relative_path in self.list_files(paths):
+            parent = relative_path.rpartition("/")[0]
+            if parent != current and (directories or files):
+                yield directories, files
+                directories = []
+                files = []
+            current = parent
+            if entry.is_dir():
+                directories.append(relative_path)
+            else:
+                files.append((entry, relative_path))
+        if directories or files:
+            yield directories, files
+
+
+    def backend_destinations(self, backend: TargetBackend, files: list):
+        """Decides where each file of a batch goes, looking the batch up with one stat_many.
+
+        Follows the same overwrite conditions as copy_destination(). Incremental runs also
+        skip files whose size and modification time in the target match the source.
+
+        Yields:
+            tuple: The entry and the relative path to put it at, for each file to send.
+        """
+        if not files:
+            return
+        if self.overwrite and not self.incremental:
+            existing = [None] * len(files)  # Nothing needs to be looked up.
+        else:
+            existing = backend.stat_many([relative_path for _, relative_path in files])
+
+        counters = None  # Highest "(n)" of each name in the batch's directory, listed when first needed.
+        for (entry, relative_path), target_stat in zip(files, existing):
+            if target_stat is not None:
+                source_stat = entry.stat()
+                if self.incremental and target_stat == (source_stat.st_size, source_stat.st_mtime_ns):
+                    self.metrics.skip("unchanged")
+                    continue
+                if not self.overwrite and self.overwrite_condition == "Ignore":
+                    self.metrics.skip("already_exists")
+                    continue
+                if not self.overwrite and self.overwrite_condition == "Duplicate":
+                    directory, _, name = relative_path.rpartition("/")
+                    if counters is None:
+                        counters = {}
+                        for existing_name in backend.list_directory(directory):
+                            TargetIndex.count_duplicate(counters, existing_name)
+                    stem, suffix = os.path.splitext(name)
+                    counters[(stem, suffix)] = counters.get((stem, suffix), 0) + 1
+                    name = f"{stem} ({counters[(stem, suffix)]}){suffix}"
+                    relative_path = f"{directory}/{name}" if directory else name
+            if self.overwrite and self.overwrite_condition == "Recently Modified":
+                if not self.check_file_last_modified(entry.path, 7 * 24):  # 7 days.
+                    self.metrics.skip("not_recently_modified")
+                    continue
+            yield entry, relative_path
+
+
+    def dry_run_backend(self, paths: set = None) -> dict:
+        """Counts the files transfer_files_backend() would put, without writing to the backend."""
+        files_to_copy = 0
+        bytes_to_copy = 0
+        for directories, files in self.list_batches(paths):
+            for directory in directories:
+                logging.info("DRY RUN: New directory would be created: %s.", directory)
+            # A new archive holds nothing yet, so every file would be added to it.
+            destinations = files if self.target_backend is None else self.backend_destinations(self.target_backend, files)
+            for entry, relative_path in destinations:
+                logging.info("DRY RUN: File would be put at: %s.", relative_path)
+                files_to_copy = files_to_copy + 1
+                bytes_to_copy = bytes_to_copy + entry.stat().st_size
+
+        output = self.output(0, 0)
+        output["files_skipped"] = self.metrics.skipped
+        output["plan"] = {"files_to_copy": files_to_copy, "bytes_to_copy": bytes_to_copy}
+        return output
+
+
+    # pylint: disable=too-many-locals
+    def transfer_files_backend(self, paths: set = None) -> dict:
+        """Backs the source up through a TargetBackend, such as a tar archive or a network share.
+
+        The source is walked a directory at a time. Each batch costs one mkdir_many for its
+        subdirectories and one stat_many for its files, and the files are then put by the
+        worker pool. Without a target_backend, a new archive is written to the target. A dry
+        run only looks the files up, creating and putting nothing.
+        """
+        logging.info(
+            "Backend transfer process started with the following settings: {Source: %s, Target: %s, Format: %s}.",
+            self.source, self.target, self.target_format
+        )
+        start = time.perf_counter()
+        self.check_ready()
+        self.metrics = Metrics()
+        if self.dry_run:
+            return self.dry_run_backend(paths)
+
+        backend = self.target_backend
+        if backend is None:
+            name = f"backup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.{self.target_format}"
+            try:
+                backend = ArchiveTarget(self.target / name, self.ARCHIVE_FORMATS[self.target_format])
+            except ImportError as error:
+                logging.error(error)
+                sys.exit(str(error))
+
+        count = 0
+        bytes_sent = 0
+        in_flight = set()
+
+        def collect(finished):
+            """Count the files that have been put."""
+            nonlocal count, bytes_sent
+            for future in finished:
+                bytes_sent = bytes_sent + future.result()
+                count = count + 1
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for directories, files in self.list_batches(paths):
+                    if directories:
+                        mkdir_start = time.perf_counter()
+                        backend.mkdir_many(directories)
+                        self.metrics.time("mkdir", time.perf_counter() - mkdir_start)
+                    for entry, relative_path in self.backend_destinations(backend, files):
+                        in_flight.add(executor.submit(backend.put, relative_path, entry.path))
+                        if len(in_flight) >= self.workers * 4:
+                            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                            collect(finished)
+                collect(wait(in_flight)[0])
+        finally:
+            backend.close()
+
+        time_taken = time.perf_counter() - start
+        output = self.output(time_taken, count)
+        output["bytes_sent"] = bytes_sent
+        output["files_skipped"] = self.metrics.skipped
+        if isinstance(backend, ArchiveTarget):
+            output["archive"] = str(backend.path)
+        logging.info("Backend backup job completed in %0.4f seconds.", time_taken)
+        flush_logs()
+        return output
+
 
-                                if not Path(new_path).exists():
-                                    shutil.copy(file, new_path)
-                                    count = count + 1
-                                else:
-                                    progress_bar() # pylint: disable=not-callable
-                                    # logging.info("%s not overwritten as it already exists.", file)
-                                    continue
+    def transfer_files(self, paths: set = None, manifest: Manifest = None):
+        """Transfers the files from the source to the directory, respecting the user inputs.
 
-                            elif self.overwrite_condition == "Duplicate":
-                                if not Path(new_path).exists():
-                                    shutil.copy(file, new_path)
-                                    count = count + 1
-                                else:
+        The plan is generated lazily while execute() carries it out, so deciding what to do
+        with each file overlaps with copying. A dry run only makes the plan.
 
-                                    new_path_split = new_path.split(".")
-                                    new_path_suffix = new_path_split.pop(len(new_path_split) - 1)
+        Args:
+            paths (set): Only transfer these paths relative to the source, as in list_files().
+            manifest (Manifest): An open manifest to use and leave open, as watch() does, rather
+                than opening the target's for this transfer alone.
+        """
+        if self.target_format == "chunked":
+            return self.transfer_files_chunked(paths)
+        if self.target_format in self.ARCHIVE_FORMATS or self.target_backend is not None:
+            return self.transfer_files_backend(paths)
 
-                                    new_path = ""
-                                    for directory in new_path_split:
-                                        new_path = new_path + directory
+        logging.info(
+            "Transfer process started with the following settings: {Source: %s, Target: %s, Overwrite: %s, Dry Run: %s, Workers: %s}.",
+            self.source, self.target, self.overwrite, self.dry_run, self.workers
+        )
+        self.metrics = Metrics()
+        if self.dry_run:
+            return self.dry_run_output(self.plan(paths))
+
+        own_manifest = manifest is None and self.incremental
+        if self.incremental:
+            self.check_ready()  # Before the manifest is created in the target.
+        if own_manifest:
+            manifest = Manifest(self.target)
+        try:
+            return self.execute(self.plan(paths, manifest, lazy=True), manifest)
+        finally:
+            if own_manifest:
+                manifest.close()
 
-                                    # Increases the (1) number until the number is not taken.
-                                    duplicate_number = 1
-                                    duplicate_exists = Path(
-                                        f"{new_path} ({str(duplicate_number)}).{new_path_suffix}"
-                                    ).exists()
-                                    while duplicate_exists:
-                                        duplicate_number = duplicate_number + 1
-                                        duplicate_exists = Path(
-                                            f"{new_path} ({str(duplicate_number)}).{new_path_suffix}"
-                                        ).exists()
 
-                                    new_path = f"{new_path} ({str(duplicate_number)}).{new_path_suffix}"
+    def plan(self, paths: set = None, manifest: Manifest = None, lazy: bool = False) -> BackupPlan:
+        """Works out what a backup would do, reading only the metadata of the source and target.
 
-                                    shutil.copy(file, new_path)
-                                    count = count + 1
+        Args:
+            paths (set): Only plan these paths relative to the source, as in list_files().
+            manifest (Manifest): The manifest to find unchanged files with, in which case the
+                target has already been checked. By default the target's manifest is read, if
+                there is one and the backup is incremental.
+            lazy (bool): Generate the operations as they are consumed, instead of all at once.
 
-                            else:
+        Returns:
+            BackupPlan: The plan, which execute() carries out.
+        """
+        start = time.perf_counter()
+        if manifest is None:
+            self.check_ready()
+        self.target_index = TargetIndex()  # The target may have changed since the last run.
+
+        # Snapshot runs link to the latest snapshot, or carry on writing it when resuming.
+        previous = None
+        snapshot = None
+        if self.snapshot:
+            snapshots = Snapshots(self.target)
+            previous = snapshots.latest()
+            if self.resume and (self.target / Journal.FILENAME).exists() and previous is not None:
+                snapshot = previous.name
+                previous = self.target / snapshots.names[-2] if len(snapshots.names) > 1 else None
+            logging.info("Planning a snapshot linking unchanged files to %s.", previous)
+
+        completed = Journal.read(self.target) if self.resume else set()
+        plan = BackupPlan(self.source, self.target, previous=previous, snapshot=snapshot)
+        if manifest is None and self.incremental and (self.target / Manifest.FILENAME).exists():
+            # The target's manifest is only open while planning.
+            manifest = Manifest(self.target)
+            try:
+                plan.operations = list(self.plan_operations(plan, paths, manifest, completed))
+                plan.throughput = manifest.throughput()
+            finally:
+                manifest.close()
+        else:
+            plan.operations = self.plan_operations(plan, paths, manifest, completed)
+            if manifest is not None:
+                plan.throughput = manifest.throughput()
+
+        if not lazy:
+            plan.operations = list(plan.operations)
+            logging.info("Plan made in %0.4f seconds: %s.", time.perf_counter() - start, plan.summary())
+        return plan
+
+
+    # pylint: disable=too-many-locals,too-many-branches
+    def plan_operations(self, plan: BackupPlan, paths: set, manifest: Manifest, completed: set):
+        """Generates the operations of a plan, walking the source and deciding what to do with each item.
+
+        In mirror mode, operations to delete whatever is no longer in the source come last.
+        """
+        metrics = self.metrics
+        source_paths = FileIndex() if self.mirror and paths is None else None
+        for entry, relative_path in self.list_files(paths):
+            if source_paths is not None:
+                source_paths.add(relative_path)
+            if entry.is_dir():
+                yield Operation("mkdir", relative_path)
+                continue
+
+            decide_start = time.perf_counter()
+            source_stat = entry.stat()
+            kind = "copy"
+            destination = relative_path
+            if relative_path in completed:
+                kind, destination = "skip", "copied_before_resume"
+            elif self.snapshot:
+                if self.snapshot_unchanged(relative_path, entry, manifest, plan.previous):
+                    kind = "link"
+            elif manifest is not None and manifest.unchanged(relative_path, entry):
+                kind, destination = "skip", "unchanged"
+            else:
+                new_path, reason = self.copy_destination(entry, f"{self.target}/{relative_path}")
+                if new_path is None:
+                    kind, destination = "skip", reason
+                elif new_path != f"{self.target}/{relative_path}":
+                    kind, destination = "duplicate", new_path[len(str(self.target)) + 1:]
+            metrics.time("decide", time.perf_counter() - decide_start)
+            yield Operation(kind, relative_path, source_stat.st_size, source_stat.st_mtime_ns, entry.inode(), destination)
+
+        if source_paths is None:
+            return
+        source_paths.finish()
+        orphans, orphaned_files, target_files = self.find_orphans(source_paths)
+        plan.mirror = {"orphans": orphans, "files_orphaned": orphaned_files, "removed": False}
+        # Too many orphans is more likely an unmounted or emptied source than real deletions.
+        if target_files and orphaned_files / target_files > self.mirror_threshold:
+            logging.error(
+                "Mirror aborted: %s of the %s files in the target would be removed, more than the threshold of %s.",
+                orphaned_files, target_files, self.mirror_threshold
+            )
+            plan.mirror["aborted"] = True
+            return
+        for orphan in orphans:
+            yield Operation("delete", orphan)
+
+
+    def dry_run_output(self, plan: BackupPlan) -> dict:
+        """Logs what a plan would do, returning the result of a run that copied nothing."""
+        for operation in plan.operations:
+            if operation.kind == "mkdir":
+                logging.info("DRY RUN: New directory would be created:  %s/%s.", self.target, operation.path)
+            elif operation.kind in ("copy", "duplicate", "link"):
+                logging.info("DRY RUN: File would be copied to: %s/%s.", self.target, operation.destination)
+            elif operation.kind == "delete":
+                logging.info("DRY RUN: %s would be removed from the target.", operation.path)
+
+        summary = plan.summary()
+        output = self.output(0, 0)
+        output["files_unchanged"] = summary["files_skipped"].get("unchanged", 0)
+        output["plan"] = summary
+        if plan.mirror is not None:
+            output["mirror"] = plan.mirror
+        output["metrics"] = self.metrics.as_dict()
+        return output
 
-                                shutil.copy(file, new_path)
-                                count = count + 1
 
-                progress_bar() # pylint: disable=not-callable
+    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    def execute(self, plan: BackupPlan, manifest: Manifest = None) -> dict:
+        """Carries out a plan, creating directories in order and copying files on the worker pool.
 
-                new_path = ""
+        Directories are created by the calling thread, so a directory always exists before
+        any of its files are handed to the worker pool for copying. Deletions wait until
+        every copy has finished. As with plan(), passing the manifest means the target has
+        already been checked.
+        """
+        if Path(plan.source) != self.source or Path(plan.target) != self.target:
+            logging.error("The plan is for backing up %s to %s.", plan.source, plan.target)
+            sys.exit(f"The plan is for backing up {plan.source} to {plan.target}.")
+        start = time.perf_counter()
+        if manifest is None:
+            self.check_ready()
+        metrics = self.metrics
 
+        count = 0  # Number of files replicated.
+        unchanged = 0  # Number of files skipped as unchanged since the last backup.
+        copied_size = 0  # Logical size of the files copied.
+        allocated_size = 0  # What the copies take up on disk, which is less for sparse files.
+        strategies = {}  # Number of files copied with each FileCopier strategy.
+        time_taken = 0
+        own_manifest = manifest is None and self.incremental
+        if own_manifest:
+            manifest = Manifest(self.target)
+        max_in_flight = self.workers * 4  # Bounds memory when the source is very large.
+        self.tuner = ConcurrencyTuner(self.workers, self.max_workers) if self.auto_tune else None
+        limiter = BandwidthLimiter(self.bandwidth_limit) if self.bandwidth_limit else None
+
+        # Progress is measured in bytes. A lazy plan's size is only known (roughly) from the
+        # manifest of the last backup.
+        if self.progress:
+            if isinstance(plan.operations, list):
+                total = sum(
+                    operation.size for operation in plan.operations
+                    if operation.kind != "skip" or operation.destination == "unchanged"
+                )
+            else:
+                total = manifest.total_size() if manifest is not None and manifest.records else None
+            from alive_progress import alive_bar  # pylint: disable=import-outside-toplevel
+            progress = alive_bar(total, bar="filling", unit="B", scale="IEC")
+        else:
+            progress = contextlib.nullcontext(NoProgressBar())
+
+        # Snapshot runs write into a new dated directory, or carry on with the one being resumed.
+        run_target = self.target
+        if self.snapshot:
+            snapshots = Snapshots(self.target)
+            run_target = self.target / plan.snapshot if plan.snapshot is not None else snapshots.create()
+            logging.info("Writing snapshot %s, linking unchanged files to %s.", run_target, plan.previous)
+
+        if (self.target / Journal.FILENAME).exists():
+            # The last run was interrupted, so its partial copies may be of files that have since changed or gone.
+            for stale in remove_partials(self.target):
+                logging.info("%s removed, as it is a partial copy left by an interrupted run.", stale)
+        journal = Journal(self.target, self.resume)
+        if self.delta_threshold is not None:
+            self.delta = DeltaTransfer(self.target)
+        # Copies are checksummed on a process pool as they finish, alongside the copying.
+        verifier = Verifier(self.target) if self.verify else None
+        verification = None
+        pipeline = None
+        if self.pipeline:
+            pipeline = SmallFilePipeline(
+                self.copy_file, self.memory_budget, readers=self.workers, writers=self.workers, preserve_times=self.preserve_times
+            )
+            max_in_flight = max(max_in_flight, pipeline.slots * 2)  # Enough queued to keep every slot busy.
+        in_flight = {}  # Maps each copy to the Operation being carried out.
+        done = queue.SimpleQueue()  # Finished copies, so waiting does not scan every copy in flight.
+        deletions = []
+        try:
+            with progress as progress_bar, \
+                    ThreadPoolExecutor(max_workers=self.max_workers if self.auto_tune else self.workers) as executor:
+
+                def collect(finished) -> int:
+                    """Waits on finished copies, returning how many succeeded (not counting hardlinks)."""
+                    nonlocal copied_size, allocated_size
+                    copied = 0
+                    for future in finished:
+                        strategy, seconds, written, allocated = future.result()  # Re-raises any error from the worker.
+                        strategies[strategy] = strategies.get(strategy, 0) + 1
+                        operation = in_flight.pop(future)
+                        size = operation.size
+                        source_file = f"{self.source}/{operation.path}"
+                        if strategy == "hardlink":
+                            copied = copied - 1  # Not counted as a transferred file.
+                            metrics.time("copy", seconds)
+                        else:
+                            metrics.copied(source_file, size if written is None else written, seconds)
+                            copied_size = copied_size + size
+                            allocated_size = allocated_size + allocated
+                            if verifier is not None:
+                                verifier.submit(operation.path, source_file, f"{run_target}/{operation.destination}")
+                        if self.tuner is not None:
+                            self.tuner.completed(size if written is None else written, seconds)
+                        journal.record(operation.path)
+                        if manifest is not None:
+                            manifest.record(operation.path, (size, operation.mtime_ns, operation.inode))
+                        progress_bar(size) # pylint: disable=not-callable
+                        copied = copied + 1
+                    return copied
+
+                def finished_copies() -> list:
+                    """Waits for a copy to finish, returning every copy that has."""
+                    wait_start = time.perf_counter()
+                    finished = [done.get()]
+                    with contextlib.suppress(queue.Empty):
+                        while True:
+                            finished.append(done.get_nowait())
+                    metrics.time("wait", time.perf_counter() - wait_start)
+                    return finished
+
+                made = False
+                if isinstance(plan.operations, list):
+                    # Every directory is made up front, so the copies never wait on one being made.
+                    for operation in plan.operations:
+                        if operation.kind == "mkdir":
+                            self.make_directory(f"{run_target}/{operation.path}")
+                    made = True
+
+                # Create each directory and copy each file.
+                operations = iter(plan.operations)
+                while True:
+                    scan_start = time.perf_counter()
+                    ignore_before = metrics.phases["ignore"]
+                    decide_before = metrics.phases["decide"]
+                    operation = next(operations, None)
+                    # A lazy plan walks the source as it goes, less the ignore checks and decisions.
+                    metrics.time("scan", time.perf_counter() - scan_start
+                                 - (metrics.phases["ignore"] - ignore_before) - (metrics.phases["decide"] - decide_before))
+                    if operation is None:
+                        break
+
+                    if operation.kind == "mkdir":
+                        if not made:
+                            self.make_directory(f"{run_target}/{operation.path}")
+                        continue
+
+                    if operation.kind == "skip":
+                        metrics.skip(operation.destination)
+                        if operation.destination == "unchanged":
+                            unchanged = unchanged + 1
+                            progress_bar(operation.size) # pylint: disable=not-callable
+                        continue
+
+                    if operation.kind == "delete":
+                        deletions.append(operation.path)
+                        continue
+
+                    source_file = f"{self.source}/{operation.path}"
+                    task = (self.copy_file, source_file)
+                    if operation.kind == "link":
+                        task = (self.link_file, source_file, f"{plan.previous}/{operation.path}")
+                    if limiter is not None:
+                        limiter.throttle(operation.size)
+                    small = (
+                        pipeline is not None and operation.kind != "link" and operation.size <= pipeline.slot_size
+                        and (self.delta is None or operation.size < self.delta_threshold)
+                    )
+                    if small:
+                        future = pipeline.submit(source_file, f"{run_target}/{operation.destination}")
+                    else:
+                        future = executor.submit(*task, f"{run_target}/{operation.destination}")
+                    in_flight[future] = operation
+                    future.add_done_callback(done.put)
+                    if len(in_flight) >= (self.tuner.limit if self.tuner is not None else max_in_flight):
+                        count = count + collect(finished_copies())
+
+                while in_flight:
+                    count = count + collect(finished_copies())
+
+            if verifier is not None:
+                verification = verifier.finish()
+            if deletions:
+                # The manifest goes first, so a crash part way through leaves files to copy again rather than missing ones.
+                if manifest is not None:
+                    manifest.forget(deletions)
+                else:
+                    Manifest.forget_paths(self.target, deletions)
+                self.remove_paths([self.target / deletion for deletion in deletions])
+                for deletion in deletions:
+                    logging.info("%s removed from the target as it is no longer in the source.", deletion)
+                plan.mirror["removed"] = True
             end = time.perf_counter()
             time_taken = end - start
 
+            journal.finish()
+            if manifest is not None:
+                manifest.record_throughput(copied_size, count, time_taken)
+            if self.snapshot:
+                for expired in snapshots.prune(self.keep_daily, self.keep_weekly, self.workers):
+                    logging.info("Snapshot %s removed by the retention policy.", expired)
+        finally:
+            if own_manifest:
+                manifest.close()
+            if self.delta is not None:
+                self.delta.close()
+                self.delta = None
+            if verifier is not None:
+                verifier.close()
+            if pipeline is not None:
+                pipeline.close()
+            # Copies that finished before an error are journaled so a resumed run skips them.
+            for future, operation in in_flight.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    journal.record(operation.path)
+            journal.close()
+
         output = self.output(time_taken, count)
+        output["files_unchanged"] = unchanged
+        output["copy_strategies"] = strategies
+        output["bytes_logical"] = copied_size
+        output["bytes_physical"] = allocated_size
+        if self.snapshot:
+            output["snapshot"] = str(run_target)
+            output["files_linked"] = strategies.get("hardlink", 0)
+        if verification is not None:
+            output["verify"] = verification
+        if self.tuner is not None:
+            output["concurrency"] = self.tuner.as_dict()
+        if plan.mirror is not None:
+            output["mirror"] = plan.mirror
+        output["metrics"] = metrics.as_dict()
+        if self.metrics_file is not None:
+            metrics.export(str(self.metrics_file), output)
 
         time_taken_4dp = f"{time_taken:0.4f}"
         logging.info("Backup job completed in %s seconds.", time_taken_4dp)
+        flush_logs()
         return output
 
 
-    def empty_directory(self, directory: str) -> bool:
-        """Remove all files in the given directory"""
-        files = glob.glob(f"{directory}/**", recursive=True)
-        files.pop(0)
-        for file in files:
-            # If a file, not a directory.
-            if os.path.isfile(file) or os.path.islink(file):
-                # Deletes the file.
-                os.unlink(file)
-
-            # If a directory
-            elif os.path.isdir(file):
-                # Deletes the directory and all its contents.
-                shutil.rmtree(file)
+    def watch(self, debounce: float = 2.0, max_delay: float = 30.0):
+        """Back up the source, then keep backing up whatever changes in it until stopped.
+
+        Changes are collected from inotify until none have arrived for debounce seconds (or
+        the oldest has waited max_delay seconds), then only the changed paths are transferred.
+        If events were lost, the whole source is transferred again instead. Incremental mirror
+        backups keep one manifest open for the whole session, written after each batch.
+
+        Yields:
+            dict: The result of the first full transfer, then of each batch.
+        """
+        watcher = SourceWatcher(self.source)
+        manifest = None
+        try:
+            # Watches are added before the first transfer, so nothing changed during it is missed.
+            watcher.add("")
+            for entry, relative_path in self.list_files():
+                if entry.is_dir():
+                    watcher.add(relative_path)
+            yield self.transfer_files()
+            if self.incremental and not self.dry_run and self.target_format == "mirror" and self.target_backend is None:
+                manifest = Manifest(self.target, track_updates=True)  # After the first transfer has checked the target.
+
+            changed = set()
+            overflowed = False
+            first = last = 0.0
+            while True:
+                timeout = None
+                if changed or overflowed:
+                    timeout = max(0.0, min(last + debounce, first + max_delay) - time.monotonic())
+                paths, new_directories, lost = watcher.read(timeout)
+                for entry, relative_path in self.list_files(new_directories):
+                    if entry.is_dir():
+                        watcher.add(relative_path)
+
+                if paths or lost:
+                    now = time.monotonic()
+                    if not (changed or overflowed):
+                        first = now
+                    last = now
+                    changed.update(paths)
+                    overflowed = overflowed or lost
+                    if now < first + max_delay:
+                        continue
+                if not (changed or overflowed):
+                    continue
+
+                if overflowed:
+                    logging.warning("Inotify events were lost, so the whole source is being rescanned.")
+                    result = self.transfer_files(manifest=manifest)
+                else:
+                    logging.info("Backing up %s changed paths.", len(changed))
+                    result = self.transfer_files(changed, manifest)
+                if manifest is not None:
+                    manifest.flush()
+                flush_logs()
+                yield result
+                changed = set()
+                overflowed = False
+        finally:
+            if manifest is not None:
+                manifest.close()
+            watcher.close()
+            flush_logs()
+
+
+    def verify_files(self, workers: int = None) -> dict:
+        """Checks every file in the source against its copy in the target, without copying anything.
+
+        A target holding snapshots is checked against the latest. Chunk stores cannot be
+        checked this way, as the target holds no copies of the files.
+
+        Returns:
+            dict: The number of files verified, source hashes reused from earlier runs and any mismatches.
+        """
+        start = time.perf_counter()
+        if not self.check_dir_exists():
+            logging.error("Source or target directory does not exist.")
+            sys.exit("Source or target directory does not exist.")
+        if self.target_format == "chunked" or (self.target / ChunkStore.DATABASE).exists():
+            logging.error("%s is a chunk store, which cannot be verified file by file.", self.target)
+            sys.exit(f"{self.target} is a chunk store, which cannot be verified file by file.")
+        root = Snapshots(self.target).latest() or self.target
+
+        verifier = Verifier(self.target, workers)
+        try:
+            for entry, relative_path in self.list_files():
+                if not entry.is_dir():
+                    verifier.submit(relative_path, entry.path, str(root / relative_path))
+            result = verifier.finish()
+        finally:
+            verifier.close()
+        logging.info("Verification completed in %0.4f seconds with %s mismatches.", time.perf_counter() - start, len(result["mismatches"]))
+        return result
+
 
+    @staticmethod
+    def newest_versions(entries: list) -> dict:
+        """The newest copy of each file in a directory of a backup, by the name it was backed up from.
+
+        "name (n).ext" is taken to be a copy kept by the Duplicate condition when "name.ext"
+        is in the directory too. The newest copy is the one modified last, as the numbers can
+        have gaps filled by other tools, with the highest n breaking ties.
+
+        Args:
+            entries (list): The DirEntry of each file in the directory.
+
+        Returns:
+            dict: The original name -> the DirEntry of its newest copy.
+        """
+        names = {entry.name for entry in entries}
+        newest = {}
+        orders = {}  # Original name -> (mtime_ns, n) of the newest copy so far.
+        for entry in entries:
+            original = entry.name
+            number = 0
+            match = TargetIndex.DUPLICATE_NAME.match(entry.name)
+            if match is not None and f"{match['stem']}{match['suffix'] or ''}" in names:
+                original = f"{match['stem']}{match['suffix'] or ''}"
+                number = int(match["number"])
+            order = (entry.stat(follow_symlinks=False).st_mtime_ns, number)
+            if original not in orders or order > orders[original]:
+                newest[original] = entry
+                orders[original] = order
+        return newest
+
+
+    def restore(self, destination: Path, pattern: str = "*") -> dict:
+        """Copies the files matching a glob pattern from the backup in the target back into destination.
+
+        A chunk store is rebuilt from its recipes. Otherwise files are copied from the latest
+        snapshot, or the target itself, by execute() on the worker pool. When the target has
+        a manifest the matching paths are looked up in it, so only the directories holding
+        them are listed, rather than walking the target. Where the Duplicate condition kept
+        "name (n).ext" copies, the newest is restored as "name.ext".
+
+        Args:
+            destination (Path): Directory to restore into, created if it does not exist.
+            pattern (str): Glob matched against the paths relative to the source, as in fnmatch.
+
+        Returns:
+            dict: The result of the restore, as from execute().
+        """
+        start = time.perf_counter()
+        destination = Path(os.path.expanduser(destination))
+        if not self.target.is_dir():
+            logging.error("Backup directory %s does not exist.", self.target)
+            sys.exit(f"Backup directory {self.target} does not exist.")
+        os.makedirs(destination, exist_ok=True)
+
+        if (self.target / ChunkStore.DATABASE).exists():
+            store = ChunkStore(self.target)
+            try:
+                count = store.restore(destination, pattern, self.workers)
+            finally:
+                store.close()
+            return self.output(time.perf_counter() - start, count)
+
+        root = Snapshots(self.target).latest() or self.target
+
+        def files_in(relative_directory: str) -> tuple:
+            """The visible files and subdirectories of a directory in the backup."""
+            files = []
+            directories = []
+            try:
+                with os.scandir(root / relative_directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        (directories if entry.is_dir(follow_symlinks=False) else files).append(entry)
+            except FileNotFoundError:
+                pass
+            return files, directories
+
+        selected = []  # (relative directory, original name, DirEntry of the newest copy).
+        matched = Manifest.matching(self.target, pattern)
+        if matched is not None:
+            wanted = {}
+            for relative_path in matched:
+                relative_directory, _, name = relative_path.rpartition("/")
+                wanted.setdefault(relative_directory, set()).add(name)
+            for relative_directory, names in wanted.items():
+                newest = self.newest_versions(files_in(relative_directory)[0])
+                selected.extend((relative_directory, name, newest[name]) for name in names if name in newest)
+        else:
+            # Without a manifest, only the part of the target the pattern can match is walked.
+            prefix = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+            pending = [prefix.rpartition("/")[0]]
+            while pending:
+                relative_directory = pending.pop()
+                files, directories = files_in(relative_directory)
+                for name, entry in self.newest_versions(files).items():
+                    relative_path = f"{relative_directory}/{name}" if relative_directory else name
+                    if fnmatch.fnmatchcase(relative_path, pattern):
+                        selected.append((relative_directory, name, entry))
+                for entry in directories:
+                    relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                    if relative_path.startswith(prefix) or prefix.startswith(f"{relative_path}/"):
+                        pending.append(relative_path)
+
+        directories = set()
+        copies = []
+        for relative_directory, name, entry in selected:
+            parts = relative_directory.split("/") if relative_directory else []
+            directories.update("/".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+            source_stat = entry.stat()
+            path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+            original = f"{relative_directory}/{name}" if relative_directory else name
+            copies.append(Operation(
+                "copy" if path == original else "duplicate", path,
+                source_stat.st_size, source_stat.st_mtime_ns, entry.inode(), original
+            ))
+        logging.info("Restoring %s files matching %s from %s to %s.", len(copies), pattern, root, destination)
+
+        # Parents sort before their subdirectories, so each is made in order.
+        operations = [Operation("mkdir", directory) for directory in sorted(directories)] + copies
+        # Restored files keep the modification times of the backup, as those from a chunk store do.
+        restorer = Backup(root, destination, overwrite=True, workers=self.workers, progress=self.progress, preserve_times=True)
+        return restorer.execute(BackupPlan(root, destination, operations))
+
+
+    def find_orphans(self, source_paths: FileIndex) -> tuple:
+        """Lists the target and takes away everything in the source.
+
+        Hidden entries, such as the manifest, and anything matched by the ignore rules are
+        kept. An orphaned directory is listed by itself, but the files beneath it are counted.
+        When keeping duplicates, "name (n).ext" is kept while "name.ext" is in the source.
+
+        Returns:
+            tuple: The orphaned relative paths, the number of files in them and the number of files in the target.
+        """
+        orphans = []
+        orphaned_files = 0
+        target_files = 0
+        pending = [(str(self.target), "", False)]
+        while pending:
+            directory, relative_directory, orphaned = pending.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not orphaned and self.ignore_rules.match(relative_path, entry.name, is_dir) is not None:
+                        continue
+
+                    orphan = orphaned or relative_path not in source_paths
+                    if orphan and not orphaned and self.overwrite_condition == "Duplicate":
+                        match = TargetIndex.DUPLICATE_NAME.match(entry.name)
+                        if match is not None:
+                            original = f"{match['stem']}{match['suffix'] or ''}"
+                            orphan = (f"{relative_directory}/{original}" if relative_directory else original) not in source_paths
+                    if orphan and not orphaned:
+                        orphans.append(relative_path)
+
+                    if is_dir:
+                        pending.append((entry.path, relative_path, orphan))
+                    else:
+                        target_files = target_files + 1
+                        orphaned_files = orphaned_files + orphan
+        return orphans, orphaned_files, target_files
+
+
+    def remove_paths(self, paths: list, batch_size: int = 256):
+        """Removes files and directory trees in batches spread across the workers."""
+        def remove_batch(batch):
+            for path in batch:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)  # Deletes the directory and all its contents.
+                else:
+                    os.unlink(path)
+
+        batches = [paths[start:start + batch_size] for start in range(0, len(paths), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(remove_batch, batches))
+
+
+    def empty_directory(self, directory: str) -> bool:
+        """Remove all files in the given directory, including hidden ones such as the manifest."""
+        with os.scandir(directory) as entries:
+            self.remove_paths([entry.path for entry in entries], batch_size=1)
         return True
-    
 
 
-@click.command()
+class DefaultGroup(click.Group):
+    """Command group that runs "run" when no command is named, so "backend.py SOURCE TARGET" still works."""
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ("--help", "-h"):
+            args.insert(0, "run")
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup)
+def cli():
+    """Automated Backup."""
+    setup_logging()
+
+
+@cli.command()
 @click.argument("source", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
 @click.argument("target", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
 @click.option("--overwrite", type=bool, default=False, help="Whether or not files in the target directory can be overwritten")
@@ -351,15 +3648,148 @@ class Backup:
 @click.option("--ignored_files", type=list,default=[], help="Specific filepaths to ignore")
 @click.option("--ignored_dir", type=list,default=[], help="Paths to directories to ignore")
 @click.option("--dry_run", type=bool, default=False, help="If set to 'true', no files will be written")
-def run(source, target, overwrite, condition, ignored_ext, ignored_files, ignored_dir, dry_run):
+@click.option("--workers", type=click.IntRange(min=1), default=1, help="Number of files to copy at once")
+@click.option("--incremental", type=bool, default=False, help="If set to 'true', files unchanged since the last backup are skipped")
+@click.option("--ignore", "ignore_patterns", multiple=True, help="Gitignore-style pattern to ignore, like '*.tmp' or '**/node_modules'. Can be repeated")
+@click.option("--ignore_file", type=click.Path(dir_okay=False), default=None, help="File of ignore patterns. Defaults to '.backupignore' in the source")
+@click.option("--metrics_file", type=click.Path(dir_okay=False), default=None, help="Append the result as JSON lines, or write a Prometheus textfile if it ends in '.prom'")
+@click.option("--progress", type=bool, default=None, help="Whether to draw the progress bar. Defaults to only when run in a terminal")
+@click.option("--resume", type=bool, default=False, help="If set to 'true', continue an interrupted backup instead of starting again")
+@click.option("--snapshot", type=bool, default=False, help="If set to 'true', write a new dated snapshot, hardlinking unchanged files to the previous one")
+@click.option("--keep_daily", type=click.IntRange(min=0), default=7, help="Number of daily snapshots to keep")
+@click.option("--keep_weekly", type=click.IntRange(min=0), default=4, help="Number of weekly snapshots to keep")
+@click.option("--target_format", type=click.Choice(["mirror", "chunked", "tar", "tar.zst"]), default="mirror", help="'mirror' for a plain copy, 'chunked' for a deduplicating chunk store, or 'tar'/'tar.zst' for an archive")
+@click.option("--delta_threshold", type=click.IntRange(min=0), default=None, help="Size in MB from which files already in the target are updated by copying only the changed blocks")
+@click.option("--verify", type=bool, default=False, help="If set to 'true', checksum each copied file against the source")
+@click.option("--auto_tune", type=bool, default=False, help="If set to 'true', tune the number of copies at once to the target, starting from --workers")
+@click.option("--max_workers", type=click.IntRange(min=1), default=64, help="Most copies at once when auto tuning")
+@click.option("--bandwidth_limit", type=click.FloatRange(min=0, min_open=True), default=None, help="Most MB/s to copy at, such as during the day")
+@click.option("--mirror", type=bool, default=False, help="If set to 'true', remove files from the target that are no longer in the source")
+@click.option("--mirror_threshold", type=click.FloatRange(min=0, max=1), default=0.5, help="Largest fraction of the target's files that mirror may remove")
+@click.option("--save_plan", type=click.Path(dir_okay=False), default=None, help="Only plan the backup, writing the plan to this file")
+@click.option("--plan", "plan_file", type=click.Path(exists=True, dir_okay=False), default=None, help="Carry out a plan written by --save_plan")
+@click.option("--plan_limit", type=click.IntRange(min=0), default=None, help="Most MB of files to copy from the plan, leaving the rest for the next run")
+@click.option("--pipeline", type=bool, default=False, help="If set to 'true', read small files ahead into memory while others are written")
+@click.option("--memory_budget", type=click.IntRange(min=1), default=64, help="MB of memory the pipeline can hold small files in")
+def run(  # pylint: disable=too-many-arguments,too-many-locals
+        source, target, overwrite, condition, ignored_ext, ignored_files, ignored_dir, dry_run, workers, incremental,
+        ignore_patterns, ignore_file, metrics_file, progress, resume, snapshot, keep_daily, keep_weekly, target_format,
+        delta_threshold, verify, auto_tune, max_workers, bandwidth_limit, mirror, mirror_threshold, save_plan, plan_file,
+        plan_limit, pipeline, memory_budget
+):
+    """Back up SOURCE to TARGET."""
+
+    unsupported = Backup.unsupported_options(
+        target_format, resume=resume, snapshot=snapshot, delta_threshold=delta_threshold, verify=verify,
+        auto_tune=auto_tune, bandwidth_limit=bandwidth_limit, pipeline=pipeline, metrics_file=metrics_file,
+        incremental=incremental
+    )
+    if unsupported:
+        raise click.UsageError(
+            f"--target_format {target_format} cannot be used with {', '.join(f'--{name}' for name in unsupported)}."
+        )
 
-    backup = Backup(source, target, overwrite, condition, ignored_ext, ignored_files, ignored_dir, dry_run)
-    print(backup.transfer_files())
+    # Lets cron or a dropped mount stop the job cleanly, so the journal is saved for --resume.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Backup interrupted."))
+
+    backup = Backup(
+        source,
+        target,
+        overwrite=overwrite,
+        overwrite_condition=condition,
+        ignored_ext=ignored_ext,
+        ignored_files=ignored_files,
+        ignored_directories=ignored_dir,
+        dry_run=dry_run,
+        workers=workers,
+        incremental=incremental,
+        ignore_patterns=ignore_patterns,
+        ignore_file=ignore_file,
+        metrics_file=metrics_file,
+        progress=progress,
+        resume=resume,
+        snapshot=snapshot,
+        keep_daily=keep_daily,
+        keep_weekly=keep_weekly,
+        target_format=target_format,
+        delta_threshold=None if delta_threshold is None else delta_threshold * 1024 * 1024,
+        verify=verify,
+        auto_tune=auto_tune,
+        max_workers=max_workers,
+        bandwidth_limit=None if bandwidth_limit is None else bandwidth_limit * 1024 * 1024,
+        mirror=mirror,
+        mirror_threshold=mirror_threshold,
+        pipeline=pipeline,
+        memory_budget=memory_budget * 1024 * 1024
+    )
+    if save_plan is None and plan_file is None and plan_limit is None:
+        print(backup.transfer_files())
+        return
+
+    plan = backup.plan() if plan_file is None else BackupPlan.load(plan_file)
+    if plan_limit is not None:
+        plan = plan.limit(plan_limit * 1024 * 1024)
+    if save_plan is not None:
+        plan.save(save_plan)
+        print(plan.summary())
+    else:
+        print(backup.execute(plan))
+
+
+@cli.command()
+@click.argument("source", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
+@click.argument("target", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
+@click.option("--overwrite", type=bool, default=True, help="Whether or not files in the target directory can be overwritten")
+@click.option("--condition", type=str, default="Target Empty", help="'Target Empty', 'Ignore', 'Duplicate', or 'Recently Modified'")
+@click.option("--workers", type=click.IntRange(min=1), default=1, help="Number of files to copy at once")
+@click.option("--ignore", "ignore_patterns", multiple=True, help="Gitignore-style pattern to ignore, like '*.tmp' or '**/node_modules'. Can be repeated")
+@click.option("--ignore_file", type=click.Path(dir_okay=False), default=None, help="File of ignore patterns. Defaults to '.backupignore' in the source")
+@click.option("--debounce", type=click.FloatRange(min=0), default=2.0, help="Seconds without changes to wait before backing up a batch")
+@click.option("--max_delay", type=click.FloatRange(min=0), default=30.0, help="Most seconds a change waits before being backed up")
+def watch(source, target, overwrite, condition, workers, ignore_patterns, ignore_file, debounce, max_delay):  # pylint: disable=too-many-arguments
+    """Back up SOURCE to TARGET, then keep backing up changes as they happen."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Watch stopped."))
+
+    backup = Backup(
+        source, target, overwrite=overwrite, overwrite_condition=condition, workers=workers, incremental=True,
+        ignore_patterns=ignore_patterns, ignore_file=ignore_file
+    )
+    for result in backup.watch(debounce, max_delay):
+        print(result)
+
+
+@cli.command("verify")
+@click.argument("source", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
+@click.argument("target", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
+@click.option("--ignore", "ignore_patterns", multiple=True, help="Gitignore-style pattern to ignore, like '*.tmp' or '**/node_modules'. Can be repeated")
+@click.option("--ignore_file", type=click.Path(dir_okay=False), default=None, help="File of ignore patterns. Defaults to '.backupignore' in the source")
+@click.option("--workers", type=click.IntRange(min=1), default=None, help="Number of processes hashing files. Defaults to one per core")
+def verify_command(source, target, ignore_patterns, ignore_file, workers):
+    """Check that every file in SOURCE matches its copy in TARGET."""
+    backup = Backup(source, target, ignore_patterns=ignore_patterns, ignore_file=ignore_file)
+    result = backup.verify_files(workers)
+    print(result)
+    if result["mismatches"]:
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("target", type=click.Path(exists=True, file_okay=False, dir_okay=True), required=True)
+@click.argument("destination", type=click.Path(file_okay=False, dir_okay=True), required=True)
+@click.option("--pattern", type=str, default="*", help="Only restore files whose path in the backup matches this glob")
+@click.option("--workers", type=click.IntRange(min=1), default=4, help="Number of files to restore at once")
+@click.option("--progress", type=bool, default=None, help="Whether to draw the progress bar. Defaults to only when run in a terminal")
+def restore(target, destination, pattern, workers, progress):
+    """Restore files from the backup in TARGET into DESTINATION."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Restore interrupted."))
+    # The backup being restored from is the "target" of the original Backup.
+    backup = Backup(destination, target, workers=workers, progress=progress)
+    print(backup.restore(destination, pattern))
 
 
 
 if __name__ == "__main__":
-    run()
+    cli()
     # source = Path("./Test_Source")
     # target = Path("./Test_Target")
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Runs the backup jobs listed in a TOML configuration file, all in one process.
+
+Replaces starting backend.py from a shell script once per job. Each job runs only when its
+schedule says it is due, and backend (with click, SQLite and the rest) is only imported
+once a job is, so a run with nothing to do returns straight away. Jobs that share a device
+run one after another so they do not compete for the same disk, while jobs on separate
+devices run at the same time. One report covering every job is printed at the end.
+
+Run with ` python3 backend/runner.py Frontend/backup_jobs.toml ` from cron, as often as
+the most frequent schedule.
+"""
+
+import argparse  # Rather than click, which takes longer to import than a no-op run should.
+import importlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import tomllib
+from datetime import datetime
+
+MEGABYTE = 1024 * 1024
+SCHEDULES = {"hourly": 60 * 60, "daily": 24 * 60 * 60, "weekly": 7 * 24 * 60 * 60}  # Seconds between runs.
+
+# Job setting -> (Backup argument, multiplier). Settings are named as on the command line,
+# with sizes in MB and bandwidth in MB/s.
+SETTINGS = {
+    "overwrite": ("overwrite", None),
+    "condition": ("overwrite_condition", None),
+    "ignored_ext": ("ignored_ext", None),
+    "ignored_files": ("ignored_files", None),
+    "ignored_dir": ("ignored_directories", None),
+    "dry_run": ("dry_run", None),
+    "workers": ("workers", None),
+    "incremental": ("incremental", None),
+    "ignore": ("ignore_patterns", None),
+    "ignore_file": ("ignore_file", None),
+    "metrics_file": ("metrics_file", None),
+    "resume": ("resume", None),
+    "snapshot": ("snapshot", None),
+    "keep_daily": ("keep_daily", None),
+    "keep_weekly": ("keep_weekly", None),
+    "target_format": ("target_format", None),
+    "delta_threshold": ("delta_threshold", MEGABYTE),
+    "verify": ("verify", None),
+    "auto_tune": ("auto_tune", None),
+    "max_workers": ("max_workers", None),
+    "bandwidth_limit": ("bandwidth_limit", MEGABYTE),
+    "mirror": ("mirror", None),
+    "mirror_threshold": ("mirror_threshold", None),
+    "pipeline": ("pipeline", None),
+    "memory_budget": ("memory_budget", MEGABYTE)
+}
+JOB_KEYS = {"name", "source", "target", "schedule", "host"}
+
+
+def load_jobs(path: str) -> tuple:
+    """Reads the jobs from a configuration file.
+
+    Settings in the [defaults] table apply to every [[job]] that does not set them itself.
+
+    Returns:
+        tuple: The list of jobs, each a dict of settings, and whether to send a desktop notification.
+    """
+    with open(path, "rb") as file:
+        config = tomllib.load(file)
+
+    defaults = config.get("defaults", {})
+    jobs = []
+    names = set()
+    for number, job in enumerate(config.get("job", []), start=1):
+        job = {**defaults, **job}
+        job.setdefault("name", f"job{number}")
+        unknown = set(job) - JOB_KEYS - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"Job {job['name']} has unknown settings: {', '.join(sorted(unknown))}.")
+        if "source" not in job or "target" not in job:
+            raise ValueError(f"Job {job['name']} needs a source and a target.")
+        if job["name"] in names:
+            raise ValueError(f"There is more than one job named {job['name']}.")
+        schedule = job.get("schedule")
+        named = isinstance(schedule, str) and schedule in SCHEDULES
+        minutes = isinstance(schedule, int) and not isinstance(schedule, bool) and schedule > 0  # True is an int too.
+        if schedule is not None and not named and not minutes:
+            raise ValueError(f"Job {job['name']} has a schedule that is not 'hourly', 'daily', 'weekly' or a number of minutes.")
+        names.add(job["name"])
+        jobs.append(job)
+    return jobs, config.get("notify", False)
+
+
+def is_due(job: dict, state: dict, now: float) -> bool:
+    """Whether a job's schedule has come round since it last completed. Jobs without a schedule always are."""
+    schedule = job.get("schedule")
+    last_run = state.get(job["name"])
+    if schedule is None or last_run is None:
+        return True
+    interval = SCHEDULES[schedule] if schedule in SCHEDULES else schedule * 60
+    return now - last_run >= interval
+
+
+def devices(job: dict) -> set:
+    """The devices holding the source and target of a job. Paths that cannot be found are left out."""
+    found = set()
+    for key in ("source", "target"):
+        try:
+            found.add(os.stat(os.path.expanduser(job[key])).st_dev)
+        except OSError:
+            pass
+    return found
+
+
+def group_by_device(jobs: list, job_devices: dict) -> list:
+    """Splits the jobs into lanes, where the jobs in a lane share a device, directly or through another job.
+
+    Args:
+        jobs (list): The jobs to run.
+        job_devices (dict): Job name -> the set of devices the job uses.
+
+    Returns:
+        list: The lanes, each a list of jobs in the order they were given.
+    """
+    lanes = []  # (devices, jobs) pairs.
+    for job in jobs:
+        used = set(job_devices.get(job["name"], ()))
+        merged = [job]
+        for lane in [lane for lane in lanes if lane[0] & used]:
+            lanes.remove(lane)
+            used = used | lane[0]
+            merged = lane[1] + merged
+        lanes.append((used, merged))
+    return [sorted(lane_jobs, key=jobs.index) for _, lane_jobs in lanes]
+
+
+def host_reachable(host: str) -> bool:
+    """Whether a host answers a single ping, as the bash script checked before each backup."""
+    try:
+        return subprocess.run(["ping", "-c", "1", "-W", "2", host], capture_output=True, check=False).returncode == 0
+    except OSError:
+        return False
+
+
+def load_backend():
+    """Imports backend.py, which sits beside this file, once a job is due.
+
+    Imported by name, since "import backend" here is read by pylint as the backend package
+    holding this file rather than the module that Python finds first on the path.
+    """
+    return importlib.import_module("backend")
+
+
+def run_job(job: dict) -> dict:
+    """Runs a single job, returning its part of the report. Errors are reported rather than raised."""
+    backend = load_backend()
+
+    start = time.perf_counter()
+    if "host" in job and not host_reachable(job["host"]):
+        return {"status": "failed", "error": f"No connection to {job['host']}."}
+    arguments = {}
+    for key, value in job.items():
+        if key in SETTINGS:
+            argument, multiplier = SETTINGS[key]
+            arguments[argument] = value * multiplier if multiplier is not None and value is not None else value
+    try:
+        result = backend.Backup(job["source"], job["target"], progress=False, **arguments).transfer_files()
+    except SystemExit as error:  # Backup exits with a message when its checks fail.
+        return {"status": "failed", "error": str(error.code), "seconds": time.perf_counter() - start}
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return {"status": "failed", "error": f"{type(error).__name__}: {error}", "seconds": time.perf_counter() - start}
+    return {"status": "completed", "result": result, "seconds": time.perf_counter() - start}
+
+
+def run_jobs(jobs: list, state_file: str = None, force: bool = False) -> dict:
+    """Runs every job that is due, with a thread per lane of jobs sharing a device.
+
+    Args:
+        jobs (list): The jobs, as from load_jobs().
+        state_file (str): JSON file recording when each job last completed, used for the schedules.
+        force (bool): Run every job, whether or not it is due.
+
+    Returns:
+        dict: The report, with an entry for each job.
+    """
+    start = time.perf_counter()
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file, encoding="utf-8") as file:
+            state = json.load(file)
+
+    now = time.time()
+    due = [job for job in jobs if force or is_due(job, state, now)]
+    report = {job["name"]: {"status": "not_due"} for job in jobs}
+    if due:
+        load_backend().setup_logging()
+
+        def run_lane(lane):
+            """Run the jobs of one lane in turn."""
+            for job in lane:
+                report[job["name"]] = run_job(job)
+                if report[job["name"]]["status"] == "completed":
+                    state[job["name"]] = time.time()
+
+        lanes = group_by_device(due, {job["name"]: devices(job) for job in due})
+        threads = [threading.Thread(target=run_lane, args=(lane,)) for lane in lanes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if state_file is not None:
+            with open(state_file, "w", encoding="utf-8") as file:
+                json.dump(state, file, indent=4)
+
+    statuses = [entry["status"] for entry in report.values()]
+    return {
+        "completed_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "time_taken": time.perf_counter() - start,
+        "jobs_completed": statuses.count("completed"),
+        "jobs_failed": statuses.count("failed"),
+        "jobs_not_due": statuses.count("not_due"),
+        "files_transferred": sum(
+            entry["result"].get("files_transferred", 0) for entry in report.values() if entry["status"] == "completed"
+        ),
+        "jobs": report
+    }
+
+
+def main(argv: list = None):
+    """Run the jobs in the configuration file given on the command line."""
+    parser = argparse.ArgumentParser(description="Run the backup jobs in a TOML configuration file.")
+    parser.add_argument("config", help="The configuration file")
+    parser.add_argument("--force", action="store_true", help="Run every job, whether or not it is due")
+    parser.add_argument("--state", default=None, help="Where to record when each job last ran. Defaults to the config file with '.state.json'")
+    parser.add_argument("--report", default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Backup jobs interrupted."))
+    try:
+        jobs, notify = load_jobs(args.config)
+    except (OSError, ValueError, tomllib.TOMLDecodeError) as error:
+        sys.exit(f"Could not read {args.config}: {error}")
+
+    state_file = args.state or f"{os.path.splitext(args.config)[0]}.state.json"
+    report = run_jobs(jobs, state_file, args.force)
+    print(json.dumps(report, indent=4, default=str))
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4, default=str)
+
+    ran = report["jobs_completed"] + report["jobs_failed"]
+    if notify and ran and shutil.which("notify-send"):
+        subprocess.run(
+            ["notify-send", "Automated Backup", f"{report['jobs_completed']} of {ran} backup jobs complete."], check=False
+        )
+    if report["jobs_failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()